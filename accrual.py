@@ -0,0 +1,98 @@
+"""
+bankRPC - Distributed Banking
+By: Imesh Nimsitha
+2025/02/05
+Accrual.py Batched Interest Accrual
+"""
+
+from os import getenv
+import bank_pb2_grpc
+import bank_pb2
+from storage import LAYOUTS, RedisStore
+import argparse
+import redis
+import grpc
+
+CHUNK_SIZE = 1000  # Default keys per SCAN chunk, also for AccrueInterest calls that do not set one
+
+class AccrualError(Exception):
+    """Raised when a run ID is reused with different rates"""
+
+class AccrualJob:
+    """Credits interest to every account whose type has a rate, one SCAN chunk at a time
+
+    Progress (cursor and counters) is committed atomically with each chunk under
+    the run ID, so running the same run ID again resumes where it stopped and never
+    credits an account twice.
+    """
+
+    def __init__(self, store, run_id, rates, batch_size=CHUNK_SIZE, match=None):
+        """Initialize a run with annual rates (percent) by account type"""
+        self.store = store
+        self.run_id = run_id
+        self.rates = {account_type.lower(): rate for account_type, rate in rates.items()}
+        self.batch_size = batch_size
+        self.match = match
+
+    def _check_rates(self, progress):
+        """Makes sure a resumed run uses the rates it was started with"""
+        if progress["rates"] != self.rates:
+            raise AccrualError(f"Run {self.run_id} was started with different rates: {progress['rates']}")
+
+    def run(self):
+        """Runs (or resumes) the job, yielding progress after every chunk"""
+        progress = self.store.start_accrual(self.run_id, self.rates)
+        self._check_rates(progress)
+        if progress["done"]:  # Already finished, nothing left to credit
+            yield progress
+            return
+
+        while not progress["done"]:  # Every chunk starts from the committed cursor (a (shard, cursor) pair when sharded)
+            cursor, keys = self.store.scan_accounts(progress["cursor"], self.batch_size, self.match)
+            self.store.accrue_chunk(self.run_id, keys, cursor, self.rates)
+            progress = self.store.start_accrual(self.run_id, self.rates)
+            yield progress
+
+    async def run_async(self):
+        """Same as run() on an AsyncRedisStore"""
+        progress = await self.store.start_accrual(self.run_id, self.rates)
+        self._check_rates(progress)
+        if progress["done"]:
+            yield progress
+            return
+
+        while not progress["done"]:
+            cursor, keys = await self.store.scan_accounts(progress["cursor"], self.batch_size, self.match)
+            await self.store.accrue_chunk(self.run_id, keys, cursor, self.rates)
+            progress = await self.store.start_accrual(self.run_id, self.rates)
+            yield progress
+
+def parse_rates(values):
+    """Parses TYPE=RATE command line values"""
+    rates = {}
+    for value in values:
+        account_type, _, rate = value.partition("=")
+        rates[account_type] = float(rate)
+    return rates
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Credit interest to all accounts of the given types")
+    parser.add_argument("--run-id", required=True, help="Run ID, reuse it to resume an interrupted run")
+    parser.add_argument("--rate", action="append", required=True, metavar="TYPE=RATE", help="Annual rate in percent per account type")
+    parser.add_argument("--batch-size", type=int, default=CHUNK_SIZE, help="Keys per SCAN chunk")
+    parser.add_argument("--server", help="Run through the AccrueInterest RPC on this server instead of Redis directly")
+    parser.add_argument("--storage", choices=LAYOUTS, default=getenv("ACCOUNT_STORAGE", "json"), help="Account storage layout")
+    args = parser.parse_args()
+    rates = parse_rates(args.rate)
+
+    if args.server:
+        stub = bank_pb2_grpc.BankServiceStub(grpc.insecure_channel(args.server))
+        request = bank_pb2.AccrualRequest(run_id=args.run_id, rates=rates, batch_size=args.batch_size)
+        progress_stream = ({"scanned": p.scanned, "credited": p.credited, "skipped": p.skipped, "done": p.done} for p in stub.AccrueInterest(request))
+    else:
+        store = RedisStore(redis.Redis(getenv("REDIS_HOST", "localhost"), port=6379, db=0), args.storage)
+        progress_stream = AccrualJob(store, args.run_id, rates, args.batch_size).run()
+
+    for progress in progress_stream:
+        print(f"Scanned {progress['scanned']} keys, credited {progress['credited']} accounts, skipped {progress['skipped']}...")
+    print("Done." if progress["done"] else "Stopped before the end of the keyspace.")
@@ -0,0 +1,228 @@
+"""
+bankRPC - Distributed Banking
+By: Imesh Nimsitha
+2025/02/05
+Async_client.py Asyncio Client Implementation
+"""
+
+from client import CHANNEL_OPTIONS, BankClient, BankError, TransactionResult, bank_error, batch_operation
+import bank_pb2
+import asyncio
+import time
+import uuid
+import grpc
+
+DEFAULT_CONCURRENCY = 1000  # Calls in flight at once in the bulk helpers
+
+class AsyncBankClient(BankClient):
+    """BankClient as coroutines on grpc.aio, for asyncio callers
+
+    Same surface, pooling, failover, retries, deadlines and hedging as
+    BankClient. One grpc.aio channel multiplexes any number of concurrent
+    calls over one HTTP/2 connection without a thread per call, so the
+    default single channel per address is usually enough. The bulk helpers
+    fan calls out with bounded concurrency. Create it inside the running
+    event loop (async with AsyncBankClient(...) as client).
+    """
+
+    def _channel(self, address):
+        """Opens one pooled grpc.aio channel"""
+        return grpc.aio.insecure_channel(address, options=CHANNEL_OPTIONS)
+
+    async def close(self):
+        """Closes every pooled channel"""
+        await asyncio.gather(*(channel.close() for channel in self.channels))
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *_):
+        await self.close()
+
+    async def _call(self, method, request, timeout=None):
+        """Runs a unary call, failing over to the next channel while servers are unavailable"""
+        deadline = time.monotonic() + (timeout or self.timeout)
+        for attempt in range(len(self.stubs)):
+            index, stub = self._stub()
+            try:
+                return await getattr(stub, method)(request, timeout=max(0.0, deadline - time.monotonic()))
+            except grpc.RpcError as e:
+                self._failed(index, e)
+                if e.code() != grpc.StatusCode.UNAVAILABLE or attempt == len(self.stubs) - 1 or time.monotonic() >= deadline:
+                    raise bank_error(e) from e
+
+    async def _stream(self, method, request, timeout=None):
+        """Runs a server streaming call, failing over like _call until the first response arrives"""
+        for attempt in range(len(self.stubs)):
+            index, stub = self._stub()
+            started = False
+            try:
+                async for response in getattr(stub, method)(request, timeout=timeout):
+                    started = True
+                    yield response
+                return
+            except grpc.RpcError as e:
+                self._failed(index, e)
+                if started or e.code() != grpc.StatusCode.UNAVAILABLE or attempt == len(self.stubs) - 1:
+                    raise bank_error(e) from e
+
+    async def _hedged(self, method, request, timeout=None):
+        """Runs a read with hedging: another copy goes out every hedge_delay until one replies"""
+        deadline = time.monotonic() + (timeout or self.timeout)
+        pending, sent, failed = {}, 0, 0  # pending: task -> channel index
+        try:
+            while True:
+                if sent < self.hedge_attempts:
+                    index, stub = self._stub()
+                    call = getattr(stub, method)(request, timeout=max(0.0, deadline - time.monotonic()))
+                    pending[asyncio.ensure_future(call)] = index
+                    sent += 1
+                done, _ = await asyncio.wait(pending, timeout=self.hedge_delay if sent < self.hedge_attempts else None,
+                                             return_when=asyncio.FIRST_COMPLETED)
+                for task in done:  # Nothing done: still waiting, send a hedge
+                    index = pending.pop(task)
+                    try:
+                        return task.result()
+                    except grpc.RpcError as e:
+                        self._failed(index, e)
+                        failed += 1
+                        if e.code() != grpc.StatusCode.UNAVAILABLE or failed == self.hedge_attempts:  # Any other status is the answer
+                            raise bank_error(e) from e
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def _read(self, method, request, timeout=None):
+        """Runs a read, hedged if enabled"""
+        if self.hedge_delay is not None and self.hedge_attempts > 1:
+            return await self._hedged(method, request, timeout)
+        return await self._call(method, request, timeout)
+
+    async def _transaction(self, method, request, timeout=None):
+        """Runs a mutation and returns its TransactionResult"""
+        response = await self._call(method, request, timeout)
+        return TransactionResult(response.account_id, response.balance, response.message)
+
+    async def create_account(self, account_id, account_type, timeout=None):
+        """Creates a new bank account, raises AccountExists if the ID is taken"""
+        return (await self._call("CreateAccount", bank_pb2.AccountRequest(account_id=account_id, account_type=account_type), timeout)).message
+
+    async def get_balance(self, account_id, timeout=None, max_staleness=None):
+        """Retrieves the account balance, raises AccountNotFound if it does not exist
+
+        max_staleness bounds how many seconds behind a replica serving the read may be,
+        0 reads the primary (read-your-writes); None leaves it to the server.
+        """
+        return (await self._read("GetBalance", bank_pb2.AccountRequest(account_id=account_id, max_staleness=max_staleness), timeout)).balance
+
+    async def get_balances(self, account_ids, timeout=None, max_staleness=None):
+        """Retrieves the balances of several accounts in one call, as {account_id: balance or None if not found}, see get_balance for max_staleness"""
+        response = await self._read("GetBalances", bank_pb2.BalancesRequest(account_ids=account_ids, max_staleness=max_staleness), timeout)
+        return {entry.account_id: entry.balance if entry.found else None for entry in response.balances}
+
+    async def stream_balances(self, account_ids, timeout=None, max_staleness=None):
+        """Streams the balances of a long list of accounts, yielding (account_id, balance or None if not found)"""
+        async for response in self._stream("StreamBalances", bank_pb2.BalancesRequest(account_ids=account_ids, max_staleness=max_staleness), timeout):
+            for entry in response.balances:
+                yield entry.account_id, entry.balance if entry.found else None
+
+    async def get_transactions(self, account_id, since="", limit=0, newest_first=False, timeout=None):
+        """Retrieves the account's transaction history after the since cursor, as a list of LedgerEntry messages"""
+        request = bank_pb2.TransactionsRequest(account_id=account_id, since=since, limit=limit, newest_first=newest_first)
+        return [entry async for entry in self._stream("GetTransactions", request, timeout or self.timeout)]
+
+    async def watch_balance(self, account_id, timeout=None):
+        """Yields the account's balance, then the new balance after each change, until timeout seconds (None: forever)"""
+        async for response in self._stream("WatchBalance", bank_pb2.AccountRequest(account_id=account_id), timeout):
+            yield response.balance
+
+    async def list_accounts(self, account_type=None, min_balance=None, max_balance=None, page_size=0, page_token="", timeout=None):
+        """Lists the accounts of a type and/or balance range from secondary indexes, as (AccountSnapshot list, next page token)"""
+        request = bank_pb2.ListAccountsRequest(
+            filter=bank_pb2.AccountFilter(account_type=account_type or "", min_balance=min_balance, max_balance=max_balance),
+            page_token=page_token, page_size=page_size)
+        accounts, token = [], ""
+        async for page in self._stream("ListAccounts", request, timeout or self.timeout):
+            accounts.extend(page.accounts)
+            token = page.next_page_token
+        return accounts, token
+
+    async def deposit(self, account_id, amount, request_id=None, timeout=None):
+        """Deposits the amount into the account, under a new request ID unless given"""
+        request = bank_pb2.DepositRequest(account_id=account_id, amount=amount, request_id=request_id or uuid.uuid4().hex)
+        return await self._transaction("Deposit", request, timeout)
+
+    async def withdraw(self, account_id, amount, request_id=None, timeout=None):
+        """Withdraws the amount from the account, raises InsufficientFunds if the balance is too low"""
+        request = bank_pb2.WithdrawRequest(account_id=account_id, amount=amount, request_id=request_id or uuid.uuid4().hex)
+        return await self._transaction("Withdraw", request, timeout)
+
+    async def calculate_interest(self, account_id, interest_rate, request_id=None, timeout=None):
+        """Calculates the interest for the account and deposits it"""
+        request = bank_pb2.InterestRequest(account_id=account_id, annual_interest_rate=interest_rate, request_id=request_id or uuid.uuid4().hex)
+        return await self._transaction("CalculateInterest", request, timeout)
+
+    async def transfer(self, from_account_id, to_account_id, amount, request_id=None, timeout=None):
+        """Moves the amount between two accounts, the result's balance is the source's"""
+        request = bank_pb2.TransferRequest(from_account_id=from_account_id, to_account_id=to_account_id, amount=amount,
+                                           request_id=request_id or uuid.uuid4().hex)
+        return await self._transaction("Transfer", request, timeout)
+
+    async def submit_batch(self, operations, timeout=None):
+        """Streams ("deposit" | "withdraw", account_id, amount[, request_id]) operations, from an iterable or async iterable,
+        yielding one BatchResult per operation in order
+        """
+        async def requests():
+            if hasattr(operations, "__aiter__"):
+                async for operation in operations:
+                    yield batch_operation(*operation)
+            else:
+                for operation in operations:
+                    yield batch_operation(*operation)
+
+        index, stub = self._stub()  # No failover: the operations may have been sent already
+        try:
+            async for result in stub.BatchTransactions(requests(), timeout=timeout):
+                yield result
+        except grpc.RpcError as e:
+            self._failed(index, e)
+            raise bank_error(e) from e
+
+    async def bulk(self, method, arguments, concurrency=DEFAULT_CONCURRENCY):
+        """Awaits method(*args) for every args tuple, at most concurrency calls at a time
+
+        Returns the results in input order. A failed call leaves its BankError
+        in its place instead of cancelling the others. Arguments are consumed
+        lazily, so millions of calls never create millions of tasks.
+        """
+        results = {}
+        arguments = enumerate(arguments)  # Shared by the workers, they run on one thread
+
+        async def worker():
+            for index, args in arguments:
+                try:
+                    results[index] = await method(*args)
+                except BankError as e:
+                    results[index] = e
+
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        return [results[index] for index in range(len(results))]
+
+    async def deposit_many(self, deposits, concurrency=DEFAULT_CONCURRENCY):
+        """Concurrent deposits of (account_id, amount[, request_id]) tuples, returns TransactionResults or BankErrors in order"""
+        return await self.bulk(self.deposit, deposits, concurrency)
+
+    async def withdraw_many(self, withdrawals, concurrency=DEFAULT_CONCURRENCY):
+        """Concurrent withdrawals of (account_id, amount[, request_id]) tuples, returns TransactionResults or BankErrors in order"""
+        return await self.bulk(self.withdraw, withdrawals, concurrency)
+
+    async def transfer_many(self, transfers, concurrency=DEFAULT_CONCURRENCY):
+        """Concurrent transfers of (from_account_id, to_account_id, amount[, request_id]) tuples, returns TransactionResults or BankErrors in order"""
+        return await self.bulk(self.transfer, transfers, concurrency)
+
+    async def get_balance_many(self, account_ids, concurrency=DEFAULT_CONCURRENCY):
+        """Concurrent GetBalance calls (hedged if enabled), returns balances or BankErrors in order
+
+        get_balances reads up to 10000 accounts in one call and is cheaper when hedging is not needed.
+        """
+        return await self.bulk(self.get_balance, ((account_id,) for account_id in account_ids), concurrency)
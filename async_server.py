@@ -0,0 +1,259 @@
+"""
+bankRPC - Distributed Banking
+By: Imesh Nimsitha
+2025/02/05
+Async_server.py Asyncio Server Implementation
+"""
+
+from os import getenv
+import bank_pb2_grpc
+import bank_pb2
+from storage import AsyncRedisStore
+from accrual import AccrualError
+from server import RECOVERY_INTERVAL, SHUTDOWN_GRACE, BankService
+from snapshot import account_snapshots, accounts_chunk
+from redis_pool import AsyncRoundTripInterceptor, create_async_client, create_async_shard_clients
+from sharding import AsyncShardedStore
+from metrics import AsyncMetricsInterceptor, start_metrics_server
+from ratelimit import AsyncRateLimiter, AsyncRateLimitInterceptor
+from watch import AsyncBalanceWatchers
+import asyncio
+import signal
+import grpc
+
+class AsyncBankService(BankService):
+    """Implements the gRPC bank service as coroutines on grpc.aio and redis.asyncio
+
+    Mutations always run as Lua scripts, so no coroutine holds a Redis
+    connection across a WATCH retry loop.
+    """
+
+    def __init__(self, store):
+        """Initialize with a connected AsyncRedisStore (or AsyncShardedStore)"""
+        self.redis = store.clients[0] if isinstance(store, AsyncShardedStore) else store.redis
+        self.exec_mode = "script"
+        self.store = store
+        self.cache = None  # The balance cache and write combiner are threaded mode only
+        self.combiner = None
+        self.watchers = AsyncBalanceWatchers(store.clients if isinstance(store, AsyncShardedStore) else [store.redis], max_watchers=0)  # Streams cost no thread
+
+    async def CreateAccount(self, request, context):
+        """Creates a new account"""
+        status, _ = await self.store.create(request.account_id, request.account_type)
+        if status == "EXISTS":  # Check if account already exists
+            context.set_code(grpc.StatusCode.ALREADY_EXISTS)
+            context.set_details('Account already exists.')
+            return bank_pb2.AccountResponse()
+
+        return bank_pb2.AccountResponse(account_id=request.account_id, message="Account created.")
+
+    async def GetBalance(self, request, context):
+        """Retrieves the balance for the account"""
+        account = await self.store.get(request.account_id)
+        if not account:  # Check if account exists
+            context.set_code(grpc.StatusCode.NOT_FOUND)
+            context.set_details('Account not found. Please check the account ID.')
+            return bank_pb2.BalanceResponse()
+
+        return bank_pb2.BalanceResponse(account_id=request.account_id, balance=account.balance, message="Balance retrieved.")
+
+    async def GetBalances(self, request, context):
+        """Retrieves the balances of several accounts with one Redis read, missing accounts are reported per ID"""
+        if self._too_many_balances(request, context):
+            return bank_pb2.BalancesResponse()
+
+        account_ids = list(request.account_ids)
+        return self._balances_response(account_ids, await self.store.get_many(account_ids))
+
+    async def StreamBalances(self, request, context):
+        """Streams the balances of a long list of accounts, one response per BATCH_SIZE IDs and Redis read"""
+        for start in range(0, len(request.account_ids), self.BATCH_SIZE):
+            account_ids = request.account_ids[start:start + self.BATCH_SIZE]
+            yield self._balances_response(account_ids, await self.store.get_many(account_ids))
+
+    async def WatchBalance(self, request, context):
+        """Streams the account's balance, then the new balance after each change, until the client cancels (which cancels this coroutine)"""
+        event = self.watchers.add(request.account_id)
+        try:
+            balance, changed = None, True
+            while True:
+                if changed:
+                    account = await self.store.get(request.account_id)
+                    if not account:
+                        self._account_not_found(context)
+                        return
+                    if account.balance != balance:
+                        message = "Balance retrieved." if balance is None else "Balance changed."
+                        balance = account.balance
+                        yield bank_pb2.BalanceResponse(account_id=request.account_id, balance=balance, message=message)
+                changed = await self.watchers.wait(event)
+        finally:
+            self.watchers.remove(request.account_id, event)
+
+    async def Deposit(self, request, context):
+        """Deposits the amount into the account"""
+        if request.amount <= 0:  # Check if amount is positive
+            context.set_code(grpc.StatusCode.INVALID_ARGUMENT)
+            context.set_details('Transaction amount must be positive.')
+            return bank_pb2.TransactionResponse()
+
+        status, balance = await self.store.apply("deposit", request.account_id, request.amount, request.request_id)
+        return self._transaction_response(status, request.account_id, balance, context, "Deposit successful.")
+
+    async def Withdraw(self, request, context):
+        """Withdraws the amount from the account"""
+        if request.amount <= 0:  # Check if amount is positive
+            context.set_code(grpc.StatusCode.INVALID_ARGUMENT)
+            context.set_details('Transaction amount must be positive.')
+            return bank_pb2.TransactionResponse()
+
+        status, balance = await self.store.apply("withdraw", request.account_id, request.amount, request.request_id)
+        return self._transaction_response(status, request.account_id, balance, context, "Withdraw successful.")
+
+    async def CalculateInterest(self, request, context):
+        """Calculates the interest on the account"""
+        if request.annual_interest_rate <= 0:  # Check if annual interest rate is positive
+            context.set_code(grpc.StatusCode.INVALID_ARGUMENT)
+            context.set_details('Annual interest rate must be a positive value.')
+            return bank_pb2.TransactionResponse()
+
+        status, balance = await self.store.apply("calculate_interest", request.account_id, request.annual_interest_rate, request.request_id)
+        return self._transaction_response(status, request.account_id, balance, context, "Interest calculated and deposited.")
+
+    async def Transfer(self, request, context):
+        """Moves the amount from one account to another atomically"""
+        if request.amount <= 0:  # Check if amount is positive
+            context.set_code(grpc.StatusCode.INVALID_ARGUMENT)
+            context.set_details('Transaction amount must be positive.')
+            return bank_pb2.TransactionResponse()
+
+        if request.from_account_id == request.to_account_id:
+            context.set_code(grpc.StatusCode.INVALID_ARGUMENT)
+            context.set_details('Cannot transfer to the same account.')
+            return bank_pb2.TransactionResponse()
+
+        status, balance = await self.store.transfer(request.from_account_id, request.to_account_id, request.amount, request.request_id)
+        return self._transaction_response(status, request.from_account_id, balance, context, "Transfer successful.")
+
+    async def recover_transfers(self):
+        """Background task finishing transfers between shards interrupted by a crash"""
+        while True:
+            await asyncio.sleep(RECOVERY_INTERVAL)
+            try:
+                recovered = await self.store.recover_transfers()
+            except Exception as e:  # Keep trying while Redis is unreachable
+                print(f"Transfer recovery failed: {e}")
+                continue
+            if recovered:
+                print(f"Recovered {recovered} interrupted transfers...")
+
+    async def _apply_batch(self, batch):
+        """Helper function for applying (index, BatchOperation) pairs in one pipeline"""
+        operations = self._batch_operations(batch)
+        results = await self.store.apply_many(operations) if operations else []
+        return list(self._batch_results(batch, operations, results))
+
+    async def BatchTransactions(self, request_iterator, context):
+        """Applies a stream of deposits and withdrawals, streaming back one result per operation"""
+        batch = []
+        index = 0
+        async for operation in request_iterator:
+            batch.append((index, operation))  # Empty operations too, rejected in their place among the results
+            index += 1
+
+            if len(batch) >= self.BATCH_SIZE:
+                for result in await self._apply_batch(batch):
+                    yield result
+                batch = []
+
+        if batch:
+            for result in await self._apply_batch(batch):
+                yield result
+
+    async def AccrueInterest(self, request, context):
+        """Credits interest to every account whose type has a rate, streaming progress after each chunk"""
+        job = self._accrual_job(request, context)
+        if job is None:
+            return
+
+        try:
+            async for progress in job.run_async():
+                yield self._accrual_progress(progress)
+        except AccrualError as e:
+            context.set_code(grpc.StatusCode.FAILED_PRECONDITION)
+            context.set_details(str(e))
+
+    async def ExportAccounts(self, request, context):
+        """Streams every account (optionally matching a glob pattern), one AccountsChunk per SCAN batch"""
+        async for batch in self.store.iter_accounts(min(request.batch_size or self.BATCH_SIZE, self.MAX_BALANCES), request.match or None):
+            yield accounts_chunk(batch)
+
+    async def ListAccounts(self, request, context):
+        """Streams the accounts matching the filter from the secondary indexes, one AccountsPage per BATCH_SIZE index entries"""
+        query = self._account_filter(request)
+        token, remaining = request.page_token, request.page_size or None
+        while True:
+            count = self._list_count(remaining)
+            try:
+                accounts, token = await self.store.list_accounts(query, token, count)
+            except ValueError:
+                self._invalid_page_token(context)
+                return
+            remaining = None if remaining is None else remaining - count
+            last = not token or (remaining is not None and remaining <= 0)
+            if accounts or last:
+                yield bank_pb2.AccountsPage(accounts=account_snapshots(accounts), next_page_token=token)
+            if last:
+                return
+
+    async def GetTransactions(self, request, context):
+        """Streams the account's ledger after the since cursor, reading BATCH_SIZE entries per Redis round trip"""
+        if self._invalid_cursor(request, context):
+            return
+
+        remaining = request.limit or None
+        cursor = request.since
+        while remaining is None or remaining > 0:
+            count = self.BATCH_SIZE if remaining is None else min(self.BATCH_SIZE, remaining)
+            transactions = await self.store.transactions(request.account_id, cursor, count, request.newest_first)
+            if not transactions:
+                if not cursor and await self.store.get(request.account_id) is None:
+                    self._account_not_found(context)
+                return
+
+            for transaction in transactions:
+                yield self._ledger_entry(transaction)
+            if len(transactions) < count:
+                return
+            cursor = transactions[-1].id
+            if remaining is not None:
+                remaining -= count
+
+async def create_service(storage=None, pool_options=None):
+    """Connects to Redis and returns an AsyncBankService"""
+    storage = storage or getenv("ACCOUNT_STORAGE", "json")
+    shard_clients, previous_shard_clients = create_async_shard_clients(pool_options)
+    if shard_clients:
+        store = AsyncShardedStore(shard_clients, storage, previous_shard_clients)
+    else:
+        store = AsyncRedisStore(create_async_client(pool_options), storage)
+    await store.connect()
+    return AsyncBankService(store)
+
+async def serve_async(storage=None, port=50051, max_concurrent_rpcs=4096, pool_options=None, reuse_port=False, metrics_port=0, rate_limits=None):
+    """Starts the asyncio gRPC server, SIGTERM stops it gracefully"""
+    if metrics_port:
+        start_metrics_server(metrics_port)
+    service = await create_service(storage, pool_options)
+    limiter = AsyncRateLimiter(service.redis, **(rate_limits or {}))
+    options = [("grpc.so_reuseport", 1 if reuse_port else 0)]
+    server = grpc.aio.server(maximum_concurrent_rpcs=max_concurrent_rpcs, options=options,  # Excess RPCs fail fast with RESOURCE_EXHAUSTED
+                             interceptors=[AsyncRateLimitInterceptor(limiter), AsyncRoundTripInterceptor(), AsyncMetricsInterceptor()])
+    bank_pb2_grpc.add_BankServiceServicer_to_server(service, server)
+    if isinstance(service.store, AsyncShardedStore):
+        service.recovery = asyncio.ensure_future(service.recover_transfers())  # Keeps a reference to the task
+    server.add_insecure_port(f'[::]:{port}')
+    await server.start()
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, lambda: asyncio.ensure_future(server.stop(SHUTDOWN_GRACE)))
+    print("Async server started...")
+    await server.wait_for_termination()
@@ -24,27 +24,63 @@ _sym_db = _symbol_database.Default()
 
 
 
-DESCRIPTOR = _descriptor_pool.Default().AddSerializedFile(b'\n\nbank.proto\":\n\x0e\x41\x63\x63ountRequest\x12\x12\n\naccount_id\x18\x01 \x01(\t\x12\x14\n\x0c\x61\x63\x63ount_type\x18\x02 \x01(\t\"6\n\x0f\x41\x63\x63ountResponse\x12\x12\n\naccount_id\x18\x01 \x01(\t\x12\x0f\n\x07message\x18\x02 \x01(\t\"G\n\x0f\x42\x61lanceResponse\x12\x12\n\naccount_id\x18\x01 \x01(\t\x12\x0f\n\x07\x62\x61lance\x18\x02 \x01(\x01\x12\x0f\n\x07message\x18\x03 \x01(\t\"4\n\x0e\x44\x65positRequest\x12\x12\n\naccount_id\x18\x01 \x01(\t\x12\x0e\n\x06\x61mount\x18\x02 \x01(\x01\"5\n\x0fWithdrawRequest\x12\x12\n\naccount_id\x18\x01 \x01(\t\x12\x0e\n\x06\x61mount\x18\x02 \x01(\x01\"C\n\x0fInterestRequest\x12\x12\n\naccount_id\x18\x01 \x01(\t\x12\x1c\n\x14\x61nnual_interest_rate\x18\x02 \x01(\x01\"K\n\x13TransactionResponse\x12\x12\n\naccount_id\x18\x01 \x01(\t\x12\x0f\n\x07message\x18\x02 \x01(\t\x12\x0f\n\x07\x62\x61lance\x18\x03 \x01(\x01\x32\x95\x02\n\x0b\x42\x61nkService\x12\x32\n\rCreateAccount\x12\x0f.AccountRequest\x1a\x10.AccountResponse\x12/\n\nGetBalance\x12\x0f.AccountRequest\x1a\x10.BalanceResponse\x12\x30\n\x07\x44\x65posit\x12\x0f.DepositRequest\x1a\x14.TransactionResponse\x12\x32\n\x08Withdraw\x12\x10.WithdrawRequest\x1a\x14.TransactionResponse\x12;\n\x11\x43\x61lculateInterest\x12\x10.InterestRequest\x1a\x14.TransactionResponseb\x06proto3')
+DESCRIPTOR = _descriptor_pool.Default().AddSerializedFile(b'\n\nbank.proto\"h\n\x0e\x41\x63\x63ountRequest\x12\x12\n\naccount_id\x18\x01 \x01(\t\x12\x14\n\x0c\x61\x63\x63ount_type\x18\x02 \x01(\t\x12\x1a\n\rmax_staleness\x18\x03 \x01(\x01H\x00\x88\x01\x01\x42\x10\n\x0e_max_staleness\"6\n\x0f\x41\x63\x63ountResponse\x12\x12\n\naccount_id\x18\x01 \x01(\t\x12\x0f\n\x07message\x18\x02 \x01(\t\"G\n\x0f\x42\x61lanceResponse\x12\x12\n\naccount_id\x18\x01 \x01(\t\x12\x0f\n\x07\x62\x61lance\x18\x02 \x01(\x01\x12\x0f\n\x07message\x18\x03 \x01(\t\"T\n\x0f\x42\x61lancesRequest\x12\x13\n\x0b\x61\x63\x63ount_ids\x18\x01 \x03(\t\x12\x1a\n\rmax_staleness\x18\x02 \x01(\x01H\x00\x88\x01\x01\x42\x10\n\x0e_max_staleness\"B\n\x0c\x42\x61lanceEntry\x12\x12\n\naccount_id\x18\x01 \x01(\t\x12\r\n\x05\x66ound\x18\x02 \x01(\x08\x12\x0f\n\x07\x62\x61lance\x18\x03 \x01(\x01\"3\n\x10\x42\x61lancesResponse\x12\x1f\n\x08\x62\x61lances\x18\x01 \x03(\x0b\x32\r.BalanceEntry\"H\n\x0e\x44\x65positRequest\x12\x12\n\naccount_id\x18\x01 \x01(\t\x12\x0e\n\x06\x61mount\x18\x02 \x01(\x01\x12\x12\n\nrequest_id\x18\x03 \x01(\t\"I\n\x0fWithdrawRequest\x12\x12\n\naccount_id\x18\x01 \x01(\t\x12\x0e\n\x06\x61mount\x18\x02 \x01(\x01\x12\x12\n\nrequest_id\x18\x03 \x01(\t\"W\n\x0fInterestRequest\x12\x12\n\naccount_id\x18\x01 \x01(\t\x12\x1c\n\x14\x61nnual_interest_rate\x18\x02 \x01(\x01\x12\x12\n\nrequest_id\x18\x03 \x01(\t\"e\n\x0fTransferRequest\x12\x17\n\x0f\x66rom_account_id\x18\x01 \x01(\t\x12\x15\n\rto_account_id\x18\x02 \x01(\t\x12\x0e\n\x06\x61mount\x18\x03 \x01(\x01\x12\x12\n\nrequest_id\x18\x04 \x01(\t\"K\n\x13TransactionResponse\x12\x12\n\naccount_id\x18\x01 \x01(\t\x12\x0f\n\x07message\x18\x02 \x01(\t\x12\x0f\n\x07\x62\x61lance\x18\x03 \x01(\x01\"g\n\x0e\x42\x61tchOperation\x12\"\n\x07\x64\x65posit\x18\x01 \x01(\x0b\x32\x0f.DepositRequestH\x00\x12$\n\x08withdraw\x18\x02 \x01(\x0b\x32\x10.WithdrawRequestH\x00\x42\x0b\n\toperation\"`\n\x0b\x42\x61tchResult\x12\r\n\x05index\x18\x01 \x01(\x04\x12\x12\n\naccount_id\x18\x02 \x01(\t\x12\x0c\n\x04\x63ode\x18\x03 \x01(\x05\x12\x0f\n\x07message\x18\x04 \x01(\t\x12\x0f\n\x07\x62\x61lance\x18\x05 \x01(\x01\"\x8d\x01\n\x0e\x41\x63\x63rualRequest\x12\x0e\n\x06run_id\x18\x01 \x01(\t\x12)\n\x05rates\x18\x02 \x03(\x0b\x32\x1a.AccrualRequest.RatesEntry\x12\x12\n\nbatch_size\x18\x03 \x01(\r\x1a,\n\nRatesEntry\x12\x0b\n\x03key\x18\x01 \x01(\t\x12\r\n\x05value\x18\x02 \x01(\x01:\x02\x38\x01\"c\n\x0f\x41\x63\x63rualProgress\x12\x0e\n\x06run_id\x18\x01 \x01(\t\x12\x0f\n\x07scanned\x18\x02 \x01(\x04\x12\x10\n\x08\x63redited\x18\x03 \x01(\x04\x12\x0f\n\x07skipped\x18\x04 \x01(\x04\x12\x0c\n\x04\x64one\x18\x05 \x01(\x08\"]\n\x13TransactionsRequest\x12\x12\n\naccount_id\x18\x01 \x01(\t\x12\r\n\x05since\x18\x02 \x01(\t\x12\r\n\x05limit\x18\x03 \x01(\r\x12\x14\n\x0cnewest_first\x18\x04 \x01(\x08\"q\n\x0bLedgerEntry\x12\n\n\x02id\x18\x01 \x01(\t\x12\x0c\n\x04type\x18\x02 \x01(\t\x12\x0e\n\x06\x61mount\x18\x03 \x01(\x01\x12\x0f\n\x07\x62\x61lance\x18\x04 \x01(\x01\x12\x14\n\x0ctimestamp_ms\x18\x05 \x01(\x03\x12\x11\n\treference\x18\x06 \x01(\t\"2\n\rExportRequest\x12\x12\n\nbatch_size\x18\x01 \x01(\r\x12\r\n\x05match\x18\x02 \x01(\t\"b\n\x0f\x41\x63\x63ountSnapshot\x12\x12\n\naccount_id\x18\x01 \x01(\t\x12\x14\n\x0c\x61\x63\x63ount_type\x18\x02 \x01(\t\x12\x0f\n\x07\x62\x61lance\x18\x03 \x01(\x01\x12\x14\n\x0clast_accrual\x18\x04 \x01(\t\"3\n\rAccountsChunk\x12\"\n\x08\x61\x63\x63ounts\x18\x01 \x03(\x0b\x32\x10.AccountSnapshot\"y\n\rAccountFilter\x12\x14\n\x0c\x61\x63\x63ount_type\x18\x01 \x01(\t\x12\x18\n\x0bmin_balance\x18\x02 \x01(\x01H\x00\x88\x01\x01\x12\x18\n\x0bmax_balance\x18\x03 \x01(\x01H\x01\x88\x01\x01\x42\x0e\n\x0c_min_balanceB\x0e\n\x0c_max_balance\"\\\n\x13ListAccountsRequest\x12\x1e\n\x06\x66ilter\x18\x01 \x01(\x0b\x32\x0e.AccountFilter\x12\x12\n\npage_token\x18\x02 \x01(\t\x12\x11\n\tpage_size\x18\x03 \x01(\r\"K\n\x0c\x41\x63\x63ountsPage\x12\"\n\x08\x61\x63\x63ounts\x18\x01 \x03(\x0b\x32\x10.AccountSnapshot\x12\x17\n\x0fnext_page_token\x18\x02 \x01(\t2\xfe\x05\n\x0b\x42\x61nkService\x12\x32\n\rCreateAccount\x12\x0f.AccountRequest\x1a\x10.AccountResponse\x12/\n\nGetBalance\x12\x0f.AccountRequest\x1a\x10.BalanceResponse\x12\x32\n\x0bGetBalances\x12\x10.BalancesRequest\x1a\x11.BalancesResponse\x12\x37\n\x0eStreamBalances\x12\x10.BalancesRequest\x1a\x11.BalancesResponse0\x01\x12\x30\n\x07\x44\x65posit\x12\x0f.DepositRequest\x1a\x14.TransactionResponse\x12\x32\n\x08Withdraw\x12\x10.WithdrawRequest\x1a\x14.TransactionResponse\x12;\n\x11\x43\x61lculateInterest\x12\x10.InterestRequest\x1a\x14.TransactionResponse\x12\x32\n\x08Transfer\x12\x10.TransferRequest\x1a\x14.TransactionResponse\x12\x36\n\x11\x42\x61tchTransactions\x12\x0f.BatchOperation\x1a\x0c.BatchResult(\x01\x30\x01\x12\x35\n\x0e\x41\x63\x63rueInterest\x12\x0f.AccrualRequest\x1a\x10.AccrualProgress0\x01\x12\x37\n\x0fGetTransactions\x12\x14.TransactionsRequest\x1a\x0c.LedgerEntry0\x01\x12\x32\n\x0e\x45xportAccounts\x12\x0e.ExportRequest\x1a\x0e.AccountsChunk0\x01\x12\x35\n\x0cListAccounts\x12\x14.ListAccountsRequest\x1a\r.AccountsPage0\x01\x12\x33\n\x0cWatchBalance\x12\x0f.AccountRequest\x1a\x10.BalanceResponse0\x01\x62\x06proto3')
 
 _globals = globals()
 _builder.BuildMessageAndEnumDescriptors(DESCRIPTOR, _globals)
 _builder.BuildTopDescriptorsAndMessages(DESCRIPTOR, 'bank_pb2', _globals)
 if not _descriptor._USE_C_DESCRIPTORS:
   DESCRIPTOR._loaded_options = None
+  _globals['_ACCRUALREQUEST_RATESENTRY']._loaded_options = None
+  _globals['_ACCRUALREQUEST_RATESENTRY']._serialized_options = b'8\001'
   _globals['_ACCOUNTREQUEST']._serialized_start=14
-  _globals['_ACCOUNTREQUEST']._serialized_end=72
-  _globals['_ACCOUNTRESPONSE']._serialized_start=74
-  _globals['_ACCOUNTRESPONSE']._serialized_end=128
-  _globals['_BALANCERESPONSE']._serialized_start=130
-  _globals['_BALANCERESPONSE']._serialized_end=201
-  _globals['_DEPOSITREQUEST']._serialized_start=203
-  _globals['_DEPOSITREQUEST']._serialized_end=255
-  _globals['_WITHDRAWREQUEST']._serialized_start=257
-  _globals['_WITHDRAWREQUEST']._serialized_end=310
-  _globals['_INTERESTREQUEST']._serialized_start=312
-  _globals['_INTERESTREQUEST']._serialized_end=379
-  _globals['_TRANSACTIONRESPONSE']._serialized_start=381
-  _globals['_TRANSACTIONRESPONSE']._serialized_end=456
-  _globals['_BANKSERVICE']._serialized_start=459
-  _globals['_BANKSERVICE']._serialized_end=736
+  _globals['_ACCOUNTREQUEST']._serialized_end=118
+  _globals['_ACCOUNTRESPONSE']._serialized_start=120
+  _globals['_ACCOUNTRESPONSE']._serialized_end=174
+  _globals['_BALANCERESPONSE']._serialized_start=176
+  _globals['_BALANCERESPONSE']._serialized_end=247
+  _globals['_BALANCESREQUEST']._serialized_start=249
+  _globals['_BALANCESREQUEST']._serialized_end=333
+  _globals['_BALANCEENTRY']._serialized_start=335
+  _globals['_BALANCEENTRY']._serialized_end=401
+  _globals['_BALANCESRESPONSE']._serialized_start=403
+  _globals['_BALANCESRESPONSE']._serialized_end=454
+  _globals['_DEPOSITREQUEST']._serialized_start=456
+  _globals['_DEPOSITREQUEST']._serialized_end=528
+  _globals['_WITHDRAWREQUEST']._serialized_start=530
+  _globals['_WITHDRAWREQUEST']._serialized_end=603
+  _globals['_INTERESTREQUEST']._serialized_start=605
+  _globals['_INTERESTREQUEST']._serialized_end=692
+  _globals['_TRANSFERREQUEST']._serialized_start=694
+  _globals['_TRANSFERREQUEST']._serialized_end=795
+  _globals['_TRANSACTIONRESPONSE']._serialized_start=797
+  _globals['_TRANSACTIONRESPONSE']._serialized_end=872
+  _globals['_BATCHOPERATION']._serialized_start=874
+  _globals['_BATCHOPERATION']._serialized_end=977
+  _globals['_BATCHRESULT']._serialized_start=979
+  _globals['_BATCHRESULT']._serialized_end=1075
+  _globals['_ACCRUALREQUEST']._serialized_start=1078
+  _globals['_ACCRUALREQUEST']._serialized_end=1219
+  _globals['_ACCRUALREQUEST_RATESENTRY']._serialized_start=1175
+  _globals['_ACCRUALREQUEST_RATESENTRY']._serialized_end=1219
+  _globals['_ACCRUALPROGRESS']._serialized_start=1221
+  _globals['_ACCRUALPROGRESS']._serialized_end=1320
+  _globals['_TRANSACTIONSREQUEST']._serialized_start=1322
+  _globals['_TRANSACTIONSREQUEST']._serialized_end=1415
+  _globals['_LEDGERENTRY']._serialized_start=1417
+  _globals['_LEDGERENTRY']._serialized_end=1530
+  _globals['_EXPORTREQUEST']._serialized_start=1532
+  _globals['_EXPORTREQUEST']._serialized_end=1582
+  _globals['_ACCOUNTSNAPSHOT']._serialized_start=1584
+  _globals['_ACCOUNTSNAPSHOT']._serialized_end=1682
+  _globals['_ACCOUNTSCHUNK']._serialized_start=1684
+  _globals['_ACCOUNTSCHUNK']._serialized_end=1735
+  _globals['_ACCOUNTFILTER']._serialized_start=1737
+  _globals['_ACCOUNTFILTER']._serialized_end=1858
+  _globals['_LISTACCOUNTSREQUEST']._serialized_start=1860
+  _globals['_LISTACCOUNTSREQUEST']._serialized_end=1952
+  _globals['_ACCOUNTSPAGE']._serialized_start=1954
+  _globals['_ACCOUNTSPAGE']._serialized_end=2029
+  _globals['_BANKSERVICE']._serialized_start=2032
+  _globals['_BANKSERVICE']._serialized_end=2798
 # @@protoc_insertion_point(module_scope)
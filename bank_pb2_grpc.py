@@ -44,6 +44,16 @@ class BankServiceStub(object):
                 request_serializer=bank__pb2.AccountRequest.SerializeToString,
                 response_deserializer=bank__pb2.BalanceResponse.FromString,
                 _registered_method=True)
+        self.GetBalances = channel.unary_unary(
+                '/BankService/GetBalances',
+                request_serializer=bank__pb2.BalancesRequest.SerializeToString,
+                response_deserializer=bank__pb2.BalancesResponse.FromString,
+                _registered_method=True)
+        self.StreamBalances = channel.unary_stream(
+                '/BankService/StreamBalances',
+                request_serializer=bank__pb2.BalancesRequest.SerializeToString,
+                response_deserializer=bank__pb2.BalancesResponse.FromString,
+                _registered_method=True)
         self.Deposit = channel.unary_unary(
                 '/BankService/Deposit',
                 request_serializer=bank__pb2.DepositRequest.SerializeToString,
@@ -59,6 +69,41 @@ class BankServiceStub(object):
                 request_serializer=bank__pb2.InterestRequest.SerializeToString,
                 response_deserializer=bank__pb2.TransactionResponse.FromString,
                 _registered_method=True)
+        self.Transfer = channel.unary_unary(
+                '/BankService/Transfer',
+                request_serializer=bank__pb2.TransferRequest.SerializeToString,
+                response_deserializer=bank__pb2.TransactionResponse.FromString,
+                _registered_method=True)
+        self.BatchTransactions = channel.stream_stream(
+                '/BankService/BatchTransactions',
+                request_serializer=bank__pb2.BatchOperation.SerializeToString,
+                response_deserializer=bank__pb2.BatchResult.FromString,
+                _registered_method=True)
+        self.AccrueInterest = channel.unary_stream(
+                '/BankService/AccrueInterest',
+                request_serializer=bank__pb2.AccrualRequest.SerializeToString,
+                response_deserializer=bank__pb2.AccrualProgress.FromString,
+                _registered_method=True)
+        self.GetTransactions = channel.unary_stream(
+                '/BankService/GetTransactions',
+                request_serializer=bank__pb2.TransactionsRequest.SerializeToString,
+                response_deserializer=bank__pb2.LedgerEntry.FromString,
+                _registered_method=True)
+        self.ExportAccounts = channel.unary_stream(
+                '/BankService/ExportAccounts',
+                request_serializer=bank__pb2.ExportRequest.SerializeToString,
+                response_deserializer=bank__pb2.AccountsChunk.FromString,
+                _registered_method=True)
+        self.ListAccounts = channel.unary_stream(
+                '/BankService/ListAccounts',
+                request_serializer=bank__pb2.ListAccountsRequest.SerializeToString,
+                response_deserializer=bank__pb2.AccountsPage.FromString,
+                _registered_method=True)
+        self.WatchBalance = channel.unary_stream(
+                '/BankService/WatchBalance',
+                request_serializer=bank__pb2.AccountRequest.SerializeToString,
+                response_deserializer=bank__pb2.BalanceResponse.FromString,
+                _registered_method=True)
 
 
 class BankServiceServicer(object):
@@ -76,6 +121,18 @@ class BankServiceServicer(object):
         context.set_details('Method not implemented!')
         raise NotImplementedError('Method not implemented!')
 
+    def GetBalances(self, request, context):
+        """Missing associated documentation comment in .proto file."""
+        context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+        context.set_details('Method not implemented!')
+        raise NotImplementedError('Method not implemented!')
+
+    def StreamBalances(self, request, context):
+        """Missing associated documentation comment in .proto file."""
+        context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+        context.set_details('Method not implemented!')
+        raise NotImplementedError('Method not implemented!')
+
     def Deposit(self, request, context):
         """Missing associated documentation comment in .proto file."""
         context.set_code(grpc.StatusCode.UNIMPLEMENTED)
@@ -94,6 +151,48 @@ class BankServiceServicer(object):
         context.set_details('Method not implemented!')
         raise NotImplementedError('Method not implemented!')
 
+    def Transfer(self, request, context):
+        """Missing associated documentation comment in .proto file."""
+        context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+        context.set_details('Method not implemented!')
+        raise NotImplementedError('Method not implemented!')
+
+    def BatchTransactions(self, request_iterator, context):
+        """Missing associated documentation comment in .proto file."""
+        context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+        context.set_details('Method not implemented!')
+        raise NotImplementedError('Method not implemented!')
+
+    def AccrueInterest(self, request, context):
+        """Missing associated documentation comment in .proto file."""
+        context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+        context.set_details('Method not implemented!')
+        raise NotImplementedError('Method not implemented!')
+
+    def GetTransactions(self, request, context):
+        """Missing associated documentation comment in .proto file."""
+        context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+        context.set_details('Method not implemented!')
+        raise NotImplementedError('Method not implemented!')
+
+    def ExportAccounts(self, request, context):
+        """Missing associated documentation comment in .proto file."""
+        context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+        context.set_details('Method not implemented!')
+        raise NotImplementedError('Method not implemented!')
+
+    def ListAccounts(self, request, context):
+        """Missing associated documentation comment in .proto file."""
+        context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+        context.set_details('Method not implemented!')
+        raise NotImplementedError('Method not implemented!')
+
+    def WatchBalance(self, request, context):
+        """Missing associated documentation comment in .proto file."""
+        context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+        context.set_details('Method not implemented!')
+        raise NotImplementedError('Method not implemented!')
+
 
 def add_BankServiceServicer_to_server(servicer, server):
     rpc_method_handlers = {
@@ -107,6 +206,16 @@ def add_BankServiceServicer_to_server(servicer, server):
                     request_deserializer=bank__pb2.AccountRequest.FromString,
                     response_serializer=bank__pb2.BalanceResponse.SerializeToString,
             ),
+            'GetBalances': grpc.unary_unary_rpc_method_handler(
+                    servicer.GetBalances,
+                    request_deserializer=bank__pb2.BalancesRequest.FromString,
+                    response_serializer=bank__pb2.BalancesResponse.SerializeToString,
+            ),
+            'StreamBalances': grpc.unary_stream_rpc_method_handler(
+                    servicer.StreamBalances,
+                    request_deserializer=bank__pb2.BalancesRequest.FromString,
+                    response_serializer=bank__pb2.BalancesResponse.SerializeToString,
+            ),
             'Deposit': grpc.unary_unary_rpc_method_handler(
                     servicer.Deposit,
                     request_deserializer=bank__pb2.DepositRequest.FromString,
@@ -122,6 +231,41 @@ def add_BankServiceServicer_to_server(servicer, server):
                     request_deserializer=bank__pb2.InterestRequest.FromString,
                     response_serializer=bank__pb2.TransactionResponse.SerializeToString,
             ),
+            'Transfer': grpc.unary_unary_rpc_method_handler(
+                    servicer.Transfer,
+                    request_deserializer=bank__pb2.TransferRequest.FromString,
+                    response_serializer=bank__pb2.TransactionResponse.SerializeToString,
+            ),
+            'BatchTransactions': grpc.stream_stream_rpc_method_handler(
+                    servicer.BatchTransactions,
+                    request_deserializer=bank__pb2.BatchOperation.FromString,
+                    response_serializer=bank__pb2.BatchResult.SerializeToString,
+            ),
+            'AccrueInterest': grpc.unary_stream_rpc_method_handler(
+                    servicer.AccrueInterest,
+                    request_deserializer=bank__pb2.AccrualRequest.FromString,
+                    response_serializer=bank__pb2.AccrualProgress.SerializeToString,
+            ),
+            'GetTransactions': grpc.unary_stream_rpc_method_handler(
+                    servicer.GetTransactions,
+                    request_deserializer=bank__pb2.TransactionsRequest.FromString,
+                    response_serializer=bank__pb2.LedgerEntry.SerializeToString,
+            ),
+            'ExportAccounts': grpc.unary_stream_rpc_method_handler(
+                    servicer.ExportAccounts,
+                    request_deserializer=bank__pb2.ExportRequest.FromString,
+                    response_serializer=bank__pb2.AccountsChunk.SerializeToString,
+            ),
+            'ListAccounts': grpc.unary_stream_rpc_method_handler(
+                    servicer.ListAccounts,
+                    request_deserializer=bank__pb2.ListAccountsRequest.FromString,
+                    response_serializer=bank__pb2.AccountsPage.SerializeToString,
+            ),
+            'WatchBalance': grpc.unary_stream_rpc_method_handler(
+                    servicer.WatchBalance,
+                    request_deserializer=bank__pb2.AccountRequest.FromString,
+                    response_serializer=bank__pb2.BalanceResponse.SerializeToString,
+            ),
     }
     generic_handler = grpc.method_handlers_generic_handler(
             'BankService', rpc_method_handlers)
@@ -187,6 +331,60 @@ class BankService(object):
             metadata,
             _registered_method=True)
 
+    @staticmethod
+    def GetBalances(request,
+            target,
+            options=(),
+            channel_credentials=None,
+            call_credentials=None,
+            insecure=False,
+            compression=None,
+            wait_for_ready=None,
+            timeout=None,
+            metadata=None):
+        return grpc.experimental.unary_unary(
+            request,
+            target,
+            '/BankService/GetBalances',
+            bank__pb2.BalancesRequest.SerializeToString,
+            bank__pb2.BalancesResponse.FromString,
+            options,
+            channel_credentials,
+            insecure,
+            call_credentials,
+            compression,
+            wait_for_ready,
+            timeout,
+            metadata,
+            _registered_method=True)
+
+    @staticmethod
+    def StreamBalances(request,
+            target,
+            options=(),
+            channel_credentials=None,
+            call_credentials=None,
+            insecure=False,
+            compression=None,
+            wait_for_ready=None,
+            timeout=None,
+            metadata=None):
+        return grpc.experimental.unary_stream(
+            request,
+            target,
+            '/BankService/StreamBalances',
+            bank__pb2.BalancesRequest.SerializeToString,
+            bank__pb2.BalancesResponse.FromString,
+            options,
+            channel_credentials,
+            insecure,
+            call_credentials,
+            compression,
+            wait_for_ready,
+            timeout,
+            metadata,
+            _registered_method=True)
+
     @staticmethod
     def Deposit(request,
             target,
@@ -267,3 +465,192 @@ class BankService(object):
             timeout,
             metadata,
             _registered_method=True)
+
+    @staticmethod
+    def Transfer(request,
+            target,
+            options=(),
+            channel_credentials=None,
+            call_credentials=None,
+            insecure=False,
+            compression=None,
+            wait_for_ready=None,
+            timeout=None,
+            metadata=None):
+        return grpc.experimental.unary_unary(
+            request,
+            target,
+            '/BankService/Transfer',
+            bank__pb2.TransferRequest.SerializeToString,
+            bank__pb2.TransactionResponse.FromString,
+            options,
+            channel_credentials,
+            insecure,
+            call_credentials,
+            compression,
+            wait_for_ready,
+            timeout,
+            metadata,
+            _registered_method=True)
+
+    @staticmethod
+    def BatchTransactions(request_iterator,
+            target,
+            options=(),
+            channel_credentials=None,
+            call_credentials=None,
+            insecure=False,
+            compression=None,
+            wait_for_ready=None,
+            timeout=None,
+            metadata=None):
+        return grpc.experimental.stream_stream(
+            request_iterator,
+            target,
+            '/BankService/BatchTransactions',
+            bank__pb2.BatchOperation.SerializeToString,
+            bank__pb2.BatchResult.FromString,
+            options,
+            channel_credentials,
+            insecure,
+            call_credentials,
+            compression,
+            wait_for_ready,
+            timeout,
+            metadata,
+            _registered_method=True)
+
+    @staticmethod
+    def AccrueInterest(request,
+            target,
+            options=(),
+            channel_credentials=None,
+            call_credentials=None,
+            insecure=False,
+            compression=None,
+            wait_for_ready=None,
+            timeout=None,
+            metadata=None):
+        return grpc.experimental.unary_stream(
+            request,
+            target,
+            '/BankService/AccrueInterest',
+            bank__pb2.AccrualRequest.SerializeToString,
+            bank__pb2.AccrualProgress.FromString,
+            options,
+            channel_credentials,
+            insecure,
+            call_credentials,
+            compression,
+            wait_for_ready,
+            timeout,
+            metadata,
+            _registered_method=True)
+
+    @staticmethod
+    def GetTransactions(request,
+            target,
+            options=(),
+            channel_credentials=None,
+            call_credentials=None,
+            insecure=False,
+            compression=None,
+            wait_for_ready=None,
+            timeout=None,
+            metadata=None):
+        return grpc.experimental.unary_stream(
+            request,
+            target,
+            '/BankService/GetTransactions',
+            bank__pb2.TransactionsRequest.SerializeToString,
+            bank__pb2.LedgerEntry.FromString,
+            options,
+            channel_credentials,
+            insecure,
+            call_credentials,
+            compression,
+            wait_for_ready,
+            timeout,
+            metadata,
+            _registered_method=True)
+
+    @staticmethod
+    def ExportAccounts(request,
+            target,
+            options=(),
+            channel_credentials=None,
+            call_credentials=None,
+            insecure=False,
+            compression=None,
+            wait_for_ready=None,
+            timeout=None,
+            metadata=None):
+        return grpc.experimental.unary_stream(
+            request,
+            target,
+            '/BankService/ExportAccounts',
+            bank__pb2.ExportRequest.SerializeToString,
+            bank__pb2.AccountsChunk.FromString,
+            options,
+            channel_credentials,
+            insecure,
+            call_credentials,
+            compression,
+            wait_for_ready,
+            timeout,
+            metadata,
+            _registered_method=True)
+
+    @staticmethod
+    def ListAccounts(request,
+            target,
+            options=(),
+            channel_credentials=None,
+            call_credentials=None,
+            insecure=False,
+            compression=None,
+            wait_for_ready=None,
+            timeout=None,
+            metadata=None):
+        return grpc.experimental.unary_stream(
+            request,
+            target,
+            '/BankService/ListAccounts',
+            bank__pb2.ListAccountsRequest.SerializeToString,
+            bank__pb2.AccountsPage.FromString,
+            options,
+            channel_credentials,
+            insecure,
+            call_credentials,
+            compression,
+            wait_for_ready,
+            timeout,
+            metadata,
+            _registered_method=True)
+
+    @staticmethod
+    def WatchBalance(request,
+            target,
+            options=(),
+            channel_credentials=None,
+            call_credentials=None,
+            insecure=False,
+            compression=None,
+            wait_for_ready=None,
+            timeout=None,
+            metadata=None):
+        return grpc.experimental.unary_stream(
+            request,
+            target,
+            '/BankService/WatchBalance',
+            bank__pb2.AccountRequest.SerializeToString,
+            bank__pb2.BalanceResponse.FromString,
+            options,
+            channel_credentials,
+            insecure,
+            call_credentials,
+            compression,
+            wait_for_ready,
+            timeout,
+            metadata,
+            _registered_method=True)
@@ -0,0 +1,1221 @@
+"""
+bankRPC - Distributed Banking
+By: Imesh Nimsitha
+2025/02/05
+Bench.py Benchmark Implementation
+"""
+
+from concurrent import futures
+from os import getenv
+import bank_pb2_grpc
+import bank_pb2
+import argparse
+import asyncio
+import bisect
+import json
+import multiprocessing
+import os
+import random
+import socket
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+import itertools
+import grpc
+import redis
+from collections import Counter
+from accrual import AccrualJob
+from async_client import AsyncBankClient
+from client import BalanceWatcher, BankClient, BankError
+from redis_pool import ROUND_TRIPS_HEADER, RoundTripInterceptor, create_client, parse_addresses
+from metrics import MetricsInterceptor
+from server import BankService
+from snapshot import export_server, export_store, import_store
+from storage import IDEMPOTENCY_KEY, Account, AccountFilter, RedisStore, filter_matches
+
+def percentile(samples, pct):
+    """Returns the pct-th percentile of a list of samples (nearest rank)"""
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, max(0, int(round(pct / 100 * len(ordered))) - 1))
+    return ordered[index]
+
+def start_server(service, max_workers=10, interceptors=None):
+    """Starts an in-process gRPC server on a free local port"""
+    interceptors = [RoundTripInterceptor()] if interceptors is None else interceptors
+    server = grpc.server(futures.ThreadPoolExecutor(max_workers=max_workers), interceptors=interceptors)
+    bank_pb2_grpc.add_BankServiceServicer_to_server(service, server)
+    port = server.add_insecure_port('127.0.0.1:0')
+    server.start()
+    return server, f"127.0.0.1:{port}"
+
+def round_trips(call):
+    """Reads the Redis round trip count from a call's trailing metadata"""
+    return int(dict(call.trailing_metadata()).get(ROUND_TRIPS_HEADER, -1))
+
+def free_port():
+    """Returns a free local TCP port"""
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def spawn_server(*server_args, script="server.py"):
+    """Starts server.py (or supervisor.py) in a subprocess and waits until it accepts connections"""
+    port = free_port()
+    process = subprocess.Popen([sys.executable, script, "--port", str(port), *server_args])
+    address = f"127.0.0.1:{port}"
+    with grpc.insecure_channel(address) as channel:
+        grpc.channel_ready_future(channel).result(timeout=30)
+    return process, address
+
+def stop_server(process):
+    """Stops a server started with spawn_server"""
+    process.terminate()
+    process.wait()
+
+def process_cpu(pid):
+    """CPU seconds (user + system) a process has used so far, from /proc (Linux)"""
+    with open(f"/proc/{pid}/stat") as f:
+        fields = f.read().rsplit(")", 1)[1].split()  # After the command name, which may contain spaces
+    return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+def run_threads(threads, work):
+    """Runs work(thread_index) on several threads and returns the wall-clock time"""
+    workers = [threading.Thread(target=work, args=(i,)) for i in range(threads)]
+    start = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return time.perf_counter() - start
+
+def contention(args):
+    """Hammers a few hot accounts with deposits under each execution mode, without and with write combining"""
+    print(f"{'mode':<8}{'combine':>9}{'ops':>8}{'ops/s':>10}{'aborted':>10}{'p50 ms':>10}{'p99 ms':>10}")
+    for mode, delay in itertools.product(args.modes, [None, *args.write_combine_delays]):
+        service = BankService(mode, args.storage, write_combine=delay is not None, write_combine_delay=delay or 0.0)
+        server, address = start_server(service, args.server_threads)
+        channel = grpc.insecure_channel(address)
+        stub = bank_pb2_grpc.BankServiceStub(channel)
+        run_id = uuid.uuid4().hex[:8]
+        accounts = [f"bench-{run_id}-{i}" for i in range(args.accounts)]
+        for account_id in accounts:
+            stub.CreateAccount(bank_pb2.AccountRequest(account_id=account_id, account_type="checking"))
+
+        latencies, aborted, lock = [], [0], threading.Lock()
+
+        def work(_):
+            local, local_aborted = [], 0
+            for _ in range(args.requests):
+                request = bank_pb2.DepositRequest(account_id=random.choice(accounts), amount=1.0)
+                start = time.perf_counter()
+                try:
+                    stub.Deposit(request)
+                except grpc.RpcError as e:
+                    if e.code() != grpc.StatusCode.ABORTED:
+                        raise
+                    local_aborted += 1
+                local.append(time.perf_counter() - start)
+            with lock:
+                latencies.extend(local)
+                aborted[0] += local_aborted
+
+        elapsed = run_threads(args.threads, work)
+        channel.close()
+        server.stop(None)
+
+        total = len(latencies)
+        combine = "off" if delay is None else f"{delay * 1000:g}ms"
+        print(f"{mode:<8}{combine:>9}{total:>8}{total / elapsed:>10.0f}{aborted[0] / total:>10.2%}"
+              f"{percentile(latencies, 50) * 1000:>10.2f}{percentile(latencies, 99) * 1000:>10.2f}")
+
+def transfers(args):
+    """Moves money between a few hot accounts with withdraw+deposit pairs and with the Transfer RPC"""
+    print(f"{'path':<20}{'ops':>8}{'ops/s':>10}{'aborted':>10}{'p50 ms':>10}{'p99 ms':>10}{'lost $':>10}")
+    for path in args.paths:
+        mode = args.exec_mode if path == "transfer" else "watch"
+        server, address = start_server(BankService(mode, args.storage))
+        channel = grpc.insecure_channel(address)
+        stub = bank_pb2_grpc.BankServiceStub(channel)
+        run_id = uuid.uuid4().hex[:8]
+        accounts = [f"bench-{{{run_id}}}-{i}" for i in range(args.accounts)]  # One hash tag: same shard when sharded
+        for account_id in accounts:
+            stub.CreateAccount(bank_pb2.AccountRequest(account_id=account_id, account_type="checking"))
+            stub.Deposit(bank_pb2.DepositRequest(account_id=account_id, amount=args.balance))
+
+        latencies, aborted, lock = [], [0], threading.Lock()
+
+        def work(_):
+            local, local_aborted = [], 0
+            for _ in range(args.requests):
+                from_id, to_id = random.sample(accounts, 2)
+                start = time.perf_counter()
+                try:
+                    if path == "transfer":
+                        stub.Transfer(bank_pb2.TransferRequest(from_account_id=from_id, to_account_id=to_id, amount=1.0))
+                    else:  # A failed deposit leaves the withdrawn money in neither account
+                        stub.Withdraw(bank_pb2.WithdrawRequest(account_id=from_id, amount=1.0))
+                        stub.Deposit(bank_pb2.DepositRequest(account_id=to_id, amount=1.0))
+                except grpc.RpcError as e:
+                    if e.code() != grpc.StatusCode.ABORTED:
+                        raise
+                    local_aborted += 1
+                local.append(time.perf_counter() - start)
+            with lock:
+                latencies.extend(local)
+                aborted[0] += local_aborted
+
+        elapsed = run_threads(args.threads, work)
+        balances = stub.GetBalances(bank_pb2.BalancesRequest(account_ids=accounts)).balances
+        lost = args.balance * len(accounts) - sum(entry.balance for entry in balances)  # Money must be conserved
+        channel.close()
+        server.stop(None)
+
+        total = len(latencies)
+        print(f"{path:<20}{total:>8}{total / elapsed:>10.0f}{aborted[0] / total:>10.2%}"
+              f"{percentile(latencies, 50) * 1000:>10.2f}{percentile(latencies, 99) * 1000:>10.2f}{lost:>10.2f}")
+
+def memory(args):
+    """Compares Redis memory used by JSON and hash account records"""
+    client = redis.Redis(getenv("REDIS_HOST", "localhost"), port=6379, db=0)
+    records = {
+        "json": lambda i: ("set", json.dumps({"account_type": "savings", "balance": 1234.56 + i})),
+        "hash": lambda i: ("hset", {"account_type": "savings", "balance": 123456 + i * 100}),
+    }
+    print(f"{'layout':<8}{'accounts':>10}{'used MB':>10}{'bytes/acct':>12}{'MEMORY USAGE':>14}")
+    for layout, record in records.items():
+        prefix = f"bench-mem-{layout}-{uuid.uuid4().hex[:8]}-"
+        before = client.info("memory")["used_memory"]
+        for start in range(0, args.accounts, args.batch_size):  # Pipelined bulk load
+            pipe = client.pipeline(transaction=False)
+            for i in range(start, min(start + args.batch_size, args.accounts)):
+                command, value = record(i)
+                if command == "set":
+                    pipe.set(prefix + str(i), value)
+                else:
+                    pipe.hset(prefix + str(i), mapping=value)
+            pipe.execute()
+        used = client.info("memory")["used_memory"] - before
+
+        sample = random.sample(range(args.accounts), min(args.sample, args.accounts))
+        pipe = client.pipeline(transaction=False)
+        for i in sample:
+            pipe.memory_usage(prefix + str(i))
+        per_key = sum(pipe.execute()) / len(sample)
+
+        print(f"{layout:<8}{args.accounts:>10}{used / 2**20:>10.1f}{used / args.accounts:>12.1f}{per_key:>14.1f}")
+
+        for start in range(0, args.accounts, args.batch_size):  # Clean up
+            client.delete(*[prefix + str(i) for i in range(start, min(start + args.batch_size, args.accounts))])
+
+def batch(args):
+    """Compares rows/sec of one unary Deposit per row against a BatchTransactions stream"""
+    server, address = start_server(BankService(args.exec_mode, args.storage))
+    client = BankClient(address)
+    account_id = f"bench-batch-{uuid.uuid4().hex[:8]}"
+    client.create_account(account_id, "checking")
+
+    start = time.perf_counter()
+    for _ in range(args.rows):
+        client.deposit(account_id, 1.0)
+    unary = args.rows / (time.perf_counter() - start)
+
+    start = time.perf_counter()
+    results = list(client.submit_batch(("deposit", account_id, 1.0) for _ in range(args.rows)))
+    streamed = len(results) / (time.perf_counter() - start)
+    failed = sum(1 for result in results if result.code)
+
+    client.close()
+    server.stop(None)
+    print(f"unary:  {unary:>10.0f} rows/s")
+    print(f"batch:  {streamed:>10.0f} rows/s ({streamed / unary:.1f}x, {failed} failed)")
+
+async def closed_loop(address, clients, duration, accounts):
+    """Runs clients concurrent closed-loop callers (50% GetBalance, 50% Deposit) over one grpc.aio channel"""
+    latencies, errors = [], [0]
+    async with grpc.aio.insecure_channel(address) as channel:
+        stub = bank_pb2_grpc.BankServiceStub(channel)
+        deadline = time.perf_counter() + duration
+
+        async def caller():
+            while time.perf_counter() < deadline:
+                account_id = random.choice(accounts)
+                start = time.perf_counter()
+                try:
+                    if random.random() < 0.5:
+                        await stub.GetBalance(bank_pb2.AccountRequest(account_id=account_id))
+                    else:
+                        await stub.Deposit(bank_pb2.DepositRequest(account_id=account_id, amount=1.0))
+                except grpc.aio.AioRpcError:
+                    errors[0] += 1
+                latencies.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(caller() for _ in range(clients)))
+        elapsed = time.perf_counter() - start
+    return latencies, errors[0], elapsed
+
+def load(args):
+    """Compares throughput and tail latency of the threaded and async serving modes"""
+    print(f"{'mode':<10}{'clients':>8}{'req/s':>10}{'errors':>8}{'p50 ms':>10}{'p99 ms':>10}{'p999 ms':>10}")
+    for mode in args.modes:
+        process, address = spawn_server("--mode", mode, "--exec-mode", "script", "--storage", args.storage)
+        try:
+            client = BankClient(address)
+            accounts = [f"bench-load-{uuid.uuid4().hex[:8]}-{i}" for i in range(args.accounts)]
+            for account_id in accounts:
+                client.create_account(account_id, "checking")
+            client.close()
+
+            for clients in args.clients:
+                latencies, errors, elapsed = asyncio.run(closed_loop(address, clients, args.duration, accounts))
+                print(f"{mode:<10}{clients:>8}{len(latencies) / elapsed:>10.0f}{errors:>8}"
+                      f"{percentile(latencies, 50) * 1000:>10.2f}{percentile(latencies, 99) * 1000:>10.2f}"
+                      f"{percentile(latencies, 99.9) * 1000:>10.2f}")
+        finally:
+            stop_server(process)
+
+def accrual(args):
+    """Measures AccrueInterest throughput over synthetic accounts"""
+    client = redis.Redis(getenv("REDIS_HOST", "localhost"), port=6379, db=0)
+    store = RedisStore(client, args.storage)
+    prefix = f"bench-accrual-{uuid.uuid4().hex[:8]}-"
+    for start in range(0, args.accounts, args.batch_size):  # Pipelined bulk load, half savings and half checking
+        pipe = client.pipeline(transaction=False)
+        for i in range(start, min(start + args.batch_size, args.accounts)):
+            store.layout.write(pipe, prefix + str(i), "savings" if i % 2 else "checking", store.layout.to_units(1000.0))
+        pipe.execute()
+
+    job = AccrualJob(store, prefix + "run", {"savings": 2.5, "checking": 0.1}, args.batch_size, match=prefix + "*")
+    start = time.perf_counter()
+    for progress in job.run():
+        pass
+    elapsed = time.perf_counter() - start
+    print(f"credited {progress['credited']} of {progress['scanned']} keys in {elapsed:.1f}s "
+          f"({progress['credited'] / elapsed:.0f} accounts/s, batch size {args.batch_size})")
+
+    for start in range(0, args.accounts, args.batch_size):  # Clean up
+        client.delete(*[prefix + str(i) for i in range(start, min(start + args.batch_size, args.accounts))])
+    client.delete(f"bankrpc:accrual:{prefix}run")
+
+def snapshot(args):
+    """Accounts/sec of snapshot export (direct and through ExportAccounts) and import, with the file size"""
+    client = create_client(instrumented=False)
+    store = RedisStore(client, args.storage)
+    prefix = f"bench-snapshot-{uuid.uuid4().hex[:8]}-"
+    for start in range(0, args.accounts, args.batch_size):  # Pipelined bulk load, half savings and half checking
+        store.put_many((prefix + str(i), Account("savings" if i % 2 else "checking", 1000.0 + i / 100, None))
+                       for i in range(start, min(start + args.batch_size, args.accounts)))
+    directory = tempfile.mkdtemp(prefix="bench-snapshot-")
+    path = os.path.join(directory, "accounts.snap")
+
+    def timed(name, work):
+        start = time.perf_counter()
+        count = work()
+        elapsed = time.perf_counter() - start
+        size = os.path.getsize(path)
+        print(f"{name:<8}{count:>10}{elapsed:>9.1f}{count / elapsed:>12.0f}{size / 2**20:>9.1f}{size / max(count, 1):>12.1f}"
+              f"{10_000_000 / (count / elapsed) / 60:>13.1f}")
+
+    print(f"{'step':<8}{'accounts':>10}{'secs':>9}{'accounts/s':>12}{'file MB':>9}{'bytes/acct':>12}{'10M (min)':>13}")
+    timed("export", lambda: export_store(store, path, args.batch_size, prefix + "*"))
+    process, address = spawn_server("--exec-mode", "script", "--storage", args.storage)
+    try:
+        timed("rpc", lambda: export_server(address, path, args.batch_size, prefix + "*"))
+    finally:
+        stop_server(process)
+    drop_accounts(store, prefix, args.accounts, args.batch_size)  # Import into an empty keyspace
+    timed("import", lambda: import_store(store, path))
+
+    restored = store.get(prefix + str(args.accounts - 1))
+    assert restored and abs(restored.balance - (1000.0 + (args.accounts - 1) / 100)) < 0.005, restored
+    drop_accounts(store, prefix, args.accounts, args.batch_size)
+    shutil.rmtree(directory)
+
+def drop_accounts(store, prefix, accounts, batch_size):
+    """Deletes synthetic accounts prefix0..prefixN-1 and their secondary index entries"""
+    for start in range(0, accounts, batch_size):
+        store.scripts["drop_accounts"](keys=[prefix + str(i) for i in range(start, min(start + batch_size, accounts))])
+
+def indexes(args):
+    """ListAccounts query latency from the secondary indexes against a SCAN and filter of every account"""
+    client = create_client(instrumented=False)
+    store = RedisStore(client, args.storage)
+    prefix = f"bench-index-{uuid.uuid4().hex[:8]}-"
+    types = ("savings", "checking", "business", "student")
+    for start in range(0, args.accounts, args.batch_size):  # Pipelined bulk load, balances spread over 0-9999.99
+        store.put_many((prefix + str(i), Account(types[i % len(types)], (i * 7919) % 1000000 / 100, None))
+                       for i in range(start, min(start + args.batch_size, args.accounts)))
+
+    queries = {
+        "type": AccountFilter("student"),
+        "balance": AccountFilter(max_balance=9.99),
+        "type+range": AccountFilter("savings", 100.0, 199.99),
+    }
+    print(f"{'query':<12}{'matches':>9}{'index ms':>10}{'scan ms':>10}{'speedup':>9}")
+    for name, query in queries.items():
+        index_times, scan_times = [], []
+        for _ in range(args.rounds):
+            start = time.perf_counter()
+            found, token = [], ""
+            while True:
+                accounts, token = store.list_accounts(query, token, args.batch_size)
+                found += [account_id for account_id, _ in accounts]
+                if not token:
+                    break
+            index_times.append(time.perf_counter() - start)
+
+            start = time.perf_counter()
+            scanned = [account_id for batch in store.iter_accounts(args.batch_size) for account_id, account in batch if filter_matches(query, account)]
+            scan_times.append(time.perf_counter() - start)
+        assert sorted(found) == sorted(scanned), f"{name}: index and scan disagree"
+        index_ms, scan_ms = percentile(index_times, 50) * 1000, percentile(scan_times, 50) * 1000
+        print(f"{name:<12}{len(found):>9}{index_ms:>10.1f}{scan_ms:>10.1f}{scan_ms / index_ms:>8.1f}x")
+
+    drop_accounts(store, prefix, args.accounts, args.batch_size)
+
+def load_process(address, clients, duration, accounts):
+    """Client process entry point: closed-loop load over its own channel (its own TCP connection)"""
+    return asyncio.run(closed_loop(address, clients, duration, accounts))
+
+def scaling(args):
+    """Measures requests/sec as the number of supervisor worker processes grows"""
+    print(f"{'workers':<8}{'req/s':>10}{'p50 ms':>10}{'p99 ms':>10}")
+    for workers in args.workers:
+        process, address = spawn_server("--workers", str(workers), "--mode", args.mode, "--exec-mode", "script",
+                                        "--storage", args.storage, script="supervisor.py")
+        try:
+            time.sleep(2)  # Let every worker bind before load starts
+            client = BankClient(address)
+            accounts = [f"bench-scaling-{uuid.uuid4().hex[:8]}-{i}" for i in range(args.accounts)]
+            for account_id in accounts:
+                client.create_account(account_id, "checking")
+            client.close()
+
+            # SO_REUSEPORT balances connections, not requests, so load comes from several client processes
+            with multiprocessing.get_context("spawn").Pool(args.client_processes) as pool:
+                results = pool.starmap(load_process, [(address, args.clients, args.duration, accounts)] * args.client_processes)
+            latencies = [latency for result in results for latency in result[0]]
+            elapsed = max(result[2] for result in results)
+            print(f"{workers:<8}{len(latencies) / elapsed:>10.0f}"
+                  f"{percentile(latencies, 50) * 1000:>10.2f}{percentile(latencies, 99) * 1000:>10.2f}")
+        finally:
+            stop_server(process)
+
+def shards(args):
+    """Measures requests/sec as accounts are sharded across more Redis nodes"""
+    nodes = parse_addresses(args.shards)
+    print(f"{'shards':<8}{'req/s':>10}{'p50 ms':>10}{'p99 ms':>10}")
+    for count in range(1, len(nodes) + 1):
+        process, address = spawn_server("--workers", str(args.workers), "--exec-mode", "script", "--storage", args.storage,
+                                        "--redis-shards", ",".join(nodes[:count]), script="supervisor.py")
+        try:
+            time.sleep(2)  # Let every worker bind before load starts
+            client = BankClient(address)
+            accounts = [f"bench-shards-{uuid.uuid4().hex[:8]}-{i}" for i in range(args.accounts)]
+            for account_id in accounts:
+                client.create_account(account_id, "checking")
+            client.close()
+
+            with multiprocessing.get_context("spawn").Pool(args.client_processes) as pool:
+                results = pool.starmap(load_process, [(address, args.clients, args.duration, accounts)] * args.client_processes)
+            latencies = [latency for result in results for latency in result[0]]
+            elapsed = max(result[2] for result in results)
+            print(f"{count:<8}{len(latencies) / elapsed:>10.0f}"
+                  f"{percentile(latencies, 50) * 1000:>10.2f}{percentile(latencies, 99) * 1000:>10.2f}")
+        finally:
+            stop_server(process)
+
+def drive_process(address, workload, clients, duration):
+    """Client process entry point: closed-loop drive() over its own channel"""
+    return asyncio.run(drive(address, workload, "closed", clients, 0, duration))
+
+def replicas(args):
+    """Measures GetBalance reads/sec as they are spread over the primary's replicas"""
+    nodes = parse_addresses(args.replicas)
+    print(f"{'replicas':<9}{'reads/s':>10}{'p50 ms':>10}{'p99 ms':>10}{'errors':>8}")
+    for count in range(len(nodes) + 1):
+        server_args = ("--redis-replicas", ",".join(nodes[:count])) if count else ()
+        process, address = spawn_server("--workers", str(args.workers), "--exec-mode", "script", "--storage", args.storage,
+                                        "--max-staleness", str(args.max_staleness), *server_args, script="supervisor.py")
+        try:
+            time.sleep(2)  # Let every worker bind and see its replicas' heartbeats before load starts
+            client = BankClient(address)
+            accounts = [f"bench-replicas-{uuid.uuid4().hex[:8]}-{i}" for i in range(args.accounts)]
+            for account_id in accounts:
+                client.create_account(account_id, "checking")
+            client.close()
+
+            with multiprocessing.get_context("spawn").Pool(args.client_processes) as pool:
+                results = pool.starmap(drive_process, [(address, Workload("read-only", accounts), args.clients, args.duration)] * args.client_processes)
+            latencies = [latency for result in results for latency in result[0]]
+            errors = sum(sum(result[1].values()) - result[1]["OK"] for result in results)
+            elapsed = max(result[2] for result in results)
+            print(f"{count:<9}{len(latencies) / elapsed:>10.0f}"
+                  f"{percentile(latencies, 50) * 1000:>10.2f}{percentile(latencies, 99) * 1000:>10.2f}{errors:>8}")
+        finally:
+            stop_server(process)
+
+def roundtrips(args):
+    """Prints the Redis round trips each RPC takes in every execution mode and storage layout"""
+    print(f"{'mode':<8}{'storage':<9}{'RPC':<22}{'round trips':>12}")
+    for mode in ("watch", "script"):
+        for storage in ("json", "hash"):
+            server, address = start_server(BankService(mode, storage))
+            channel = grpc.insecure_channel(address)
+            stub = bank_pb2_grpc.BankServiceStub(channel)
+            account_id = f"bench-rt-{uuid.uuid4().hex[:8]}"
+            calls = [
+                ("CreateAccount", stub.CreateAccount, bank_pb2.AccountRequest(account_id=account_id, account_type="savings")),
+                ("CreateAccount", stub.CreateAccount, bank_pb2.AccountRequest(account_id=account_id + "-to", account_type="checking")),
+                ("GetBalance", stub.GetBalance, bank_pb2.AccountRequest(account_id=account_id)),
+                ("GetBalances", stub.GetBalances, bank_pb2.BalancesRequest(account_ids=[account_id, account_id + "-missing"])),
+                ("Deposit", stub.Deposit, bank_pb2.DepositRequest(account_id=account_id, amount=100.0)),
+                ("Withdraw", stub.Withdraw, bank_pb2.WithdrawRequest(account_id=account_id, amount=10.0)),
+                ("CalculateInterest", stub.CalculateInterest, bank_pb2.InterestRequest(account_id=account_id, annual_interest_rate=1.0)),
+                ("Transfer", stub.Transfer, bank_pb2.TransferRequest(from_account_id=account_id, to_account_id=account_id + "-to", amount=1.0)),
+                ("Deposit (not found)", stub.Deposit, bank_pb2.DepositRequest(account_id=account_id + "-missing", amount=1.0)),
+            ]
+            for name, method, request in calls:
+                try:
+                    _, call = method.with_call(request)
+                except grpc.RpcError as error:  # Failed calls carry trailing metadata too
+                    call = error
+                print(f"{mode:<8}{storage:<9}{name:<22}{round_trips(call):>12}")
+            channel.close()
+            server.stop(None)
+
+WORKLOADS = {  # Operation mix of each workload, hot-key runs it on --hot-accounts accounts only
+    "read-heavy": {"get": 0.90, "deposit": 0.05, "withdraw": 0.05},
+    "write-heavy": {"get": 0.10, "deposit": 0.45, "withdraw": 0.45},
+    "mixed": {"get": 0.50, "deposit": 0.25, "withdraw": 0.25},
+    "hot-key": {"get": 0.20, "deposit": 0.40, "withdraw": 0.40},
+    "read-only": {"get": 1.0},
+}
+PERCENTILES = (50, 95, 99, 99.9)
+
+class Workload:
+    """Picks the next (operation, account_id) from an operation mix and an account distribution"""
+
+    def __init__(self, name, accounts, distribution="uniform", zipf_s=1.1):
+        """Initialize workload, zipf picks account k with weight 1/k^zipf_s"""
+        self.name = name
+        self.accounts = accounts
+        self.operations = list(WORKLOADS[name])
+        self.op_weights = list(itertools.accumulate(WORKLOADS[name].values()))
+        self.account_weights = None
+        if distribution == "zipf":
+            self.account_weights = list(itertools.accumulate(1 / k ** zipf_s for k in range(1, len(accounts) + 1)))
+
+    def next(self):
+        """Returns the next operation and account"""
+        op = self.operations[bisect.bisect(self.op_weights, random.random() * self.op_weights[-1])]
+        if self.account_weights is None:
+            return op, random.choice(self.accounts)
+        index = bisect.bisect(self.account_weights, random.random() * self.account_weights[-1])
+        return op, self.accounts[min(index, len(self.accounts) - 1)]
+
+async def timed_call(stub, op, account_id, started, latencies, codes, request_ids=False, ok_latencies=None):
+    """Runs one operation and records its latency since started and its status code (and in ok_latencies if it succeeded)"""
+    request_id = uuid.uuid4().hex if request_ids else ""
+    try:
+        if op == "get":
+            await stub.GetBalance(bank_pb2.AccountRequest(account_id=account_id))
+        elif op == "deposit":
+            await stub.Deposit(bank_pb2.DepositRequest(account_id=account_id, amount=1.0, request_id=request_id))
+        else:
+            await stub.Withdraw(bank_pb2.WithdrawRequest(account_id=account_id, amount=1.0, request_id=request_id))
+        codes["OK"] += 1
+        if ok_latencies is not None:
+            ok_latencies.append(time.perf_counter() - started)
+    except grpc.aio.AioRpcError as e:
+        codes[e.code().name] += 1
+    latencies.append(time.perf_counter() - started)
+
+async def drive(address, workload, loop, clients, rate, duration, request_ids=False, ok_latencies=None):
+    """Runs a workload closed-loop (clients callers back to back) or open-loop (Poisson arrivals at rate/s)
+
+    Open-loop latency is measured from each request's scheduled start, so a
+    slow server is not hidden by the load generator falling behind. With
+    request_ids, every mutation carries a fresh idempotency key. Latencies of
+    successful calls alone are also appended to ok_latencies if given.
+    """
+    latencies, codes = [], Counter()
+    async with grpc.aio.insecure_channel(address) as channel:
+        stub = bank_pb2_grpc.BankServiceStub(channel)
+        start = time.perf_counter()
+        deadline = start + duration
+
+        if loop == "closed":
+            async def caller():
+                while time.perf_counter() < deadline:
+                    await timed_call(stub, *workload.next(), time.perf_counter(), latencies, codes, request_ids, ok_latencies)
+            await asyncio.gather(*(caller() for _ in range(clients)))
+        else:
+            pending, scheduled = set(), start
+            while scheduled < deadline:
+                delay = scheduled - time.perf_counter()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                task = asyncio.ensure_future(timed_call(stub, *workload.next(), scheduled, latencies, codes, request_ids, ok_latencies))
+                pending.add(task)
+                task.add_done_callback(pending.discard)
+                scheduled += random.expovariate(rate)
+            if pending:
+                await asyncio.gather(*pending)
+        elapsed = time.perf_counter() - start
+    return latencies, codes, elapsed
+
+def summarize(latencies, codes, elapsed):
+    """Throughput, latency percentiles in ms and error rates of a run"""
+    total = sum(codes.values())
+    errors = total - codes["OK"]
+    return {
+        "requests": total,
+        "throughput": total / elapsed if elapsed else 0.0,
+        "latency_ms": {f"p{pct:g}".replace(".", ""): percentile(latencies, pct) * 1000 for pct in PERCENTILES},
+        "aborted_rate": codes["ABORTED"] / total if total else 0.0,
+        "error_rate": errors / total if total else 0.0,
+        "codes": dict(codes),
+    }
+
+def bench_client(backend):
+    """Redis client for a local benchmark: redis-server at $REDIS_HOST, or the fakeredis in-memory stand-in"""
+    if backend in ("redis", "memory"):
+        return None  # BankService builds its own pool from the environment, or needs none
+    try:
+        import fakeredis
+    except ImportError:
+        sys.exit("The fakeredis backend needs fakeredis (pip install fakeredis lupa).")
+    return fakeredis.FakeRedis()
+
+def run(args):
+    """Drives BankService with the selected workloads and reports throughput, latency and error rates"""
+    server = None
+    if args.server:
+        address = args.server
+    else:
+        engine = "memory" if args.backend == "memory" else "redis"
+        service = BankService(args.exec_mode, args.storage, bench_client(args.backend), engine=engine)
+        server, address = start_server(service, args.server_threads)
+
+    client = BankClient(address)
+    prefix = f"bench-run-{uuid.uuid4().hex[:8]}-"
+    accounts = [prefix + str(i) for i in range(args.accounts)]
+    for account_id in accounts:  # Large opening balances so withdrawals rarely run dry
+        client.create_account(account_id, "checking")
+    list(client.submit_batch(("deposit", account_id, 1000000.0) for account_id in accounts))
+    client.close()
+
+    results = []
+    print(f"{'workload':<13}{'loop':<8}{'req/s':>10}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'p999 ms':>9}{'aborted':>9}{'errors':>9}")
+    for name in args.workloads:
+        workload = Workload(name, accounts[:args.hot_accounts] if name == "hot-key" else accounts, args.distribution, args.zipf_s)
+        latencies, codes, elapsed = asyncio.run(drive(address, workload, args.loop, args.clients, args.rate, args.duration))
+        result = {
+            "workload": name, "loop": args.loop, "distribution": args.distribution,
+            "clients": args.clients if args.loop == "closed" else None, "rate": args.rate if args.loop == "open" else None,
+            "duration": args.duration, "accounts": len(workload.accounts), "exec_mode": args.exec_mode,
+            "storage": args.storage, "backend": "server" if args.server else args.backend,
+            **summarize(latencies, codes, elapsed),
+        }
+        results.append(result)
+        latency = result["latency_ms"]
+        print(f"{name:<13}{args.loop:<8}{result['throughput']:>10.0f}{latency['p50']:>9.2f}{latency['p95']:>9.2f}"
+              f"{latency['p99']:>9.2f}{latency['p999']:>9.2f}{result['aborted_rate']:>9.2%}{result['error_rate']:>9.2%}")
+
+    if server:
+        server.stop(None)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"created": time.strftime("%Y-%m-%dT%H:%M:%S"), "results": results}, f, indent=2)
+        print(f"Results saved to {args.output}")
+    if args.baseline:
+        compare(results, args.baseline)
+
+def compare(results, baseline_path):
+    """Prints throughput and p99 changes against a JSON file saved by an earlier run"""
+    with open(baseline_path) as f:
+        baseline = {(r["workload"], r["loop"]): r for r in json.load(f)["results"]}
+    print(f"\nAgainst {baseline_path}:")
+    for result in results:
+        before = baseline.get((result["workload"], result["loop"]))
+        if before is None:
+            continue
+        throughput = result["throughput"] / before["throughput"] - 1 if before["throughput"] else 0.0
+        p99 = result["latency_ms"]["p99"] / before["latency_ms"]["p99"] - 1 if before["latency_ms"]["p99"] else 0.0
+        print(f"{result['workload']:<13}{result['loop']:<8}req/s {throughput:>+8.1%}   p99 {p99:>+8.1%}")
+
+def metrics_overhead(args):
+    """Throughput and latency with the metrics interceptor and Redis command timing off and on, alternating rounds"""
+    runs = {"off": [], "on": []}
+    accounts = None
+    for _ in range(args.rounds):
+        for setting in ("off", "on"):
+            instrumented = setting == "on"
+            service = BankService(args.exec_mode, args.storage, create_client(instrumented=instrumented))
+            interceptors = [RoundTripInterceptor(), MetricsInterceptor()] if instrumented else [RoundTripInterceptor()]
+            server, address = start_server(service, interceptors=interceptors)
+            if accounts is None:
+                client = BankClient(address)
+                accounts = [f"bench-metrics-{uuid.uuid4().hex[:8]}-{i}" for i in range(args.accounts)]
+                for account_id in accounts:
+                    client.create_account(account_id, "checking")
+                    client.deposit(account_id, 1000000.0)
+                client.close()
+
+            workload = Workload("mixed", accounts)
+            runs[setting].append(asyncio.run(drive(address, workload, "closed", args.clients, 0, args.duration)))
+            server.stop(None)
+
+    print(f"{'metrics':<9}{'req/s':>10}{'p50 ms':>9}{'p99 ms':>9}")
+    throughput = {}
+    for setting, results in runs.items():
+        latencies = [latency for result in results for latency in result[0]]
+        throughput[setting] = len(latencies) / sum(result[2] for result in results)
+        print(f"{setting:<9}{throughput[setting]:>10.0f}{percentile(latencies, 50) * 1000:>9.2f}{percentile(latencies, 99) * 1000:>9.2f}")
+    print(f"overhead: {1 - throughput['on'] / throughput['off']:.2%} of throughput")
+
+def ledger_overhead(args):
+    """Write throughput and latency with the transaction ledger off and on, alternating rounds"""
+    runs = {"off": [], "on": []}
+    accounts = None
+    for _ in range(args.rounds):
+        for setting in ("off", "on"):
+            service = BankService(args.exec_mode, args.storage)
+            service.store = RedisStore(service.redis, args.storage, args.exec_mode, ledger=setting == "on")
+            server, address = start_server(service)
+            if accounts is None:
+                client = BankClient(address)
+                accounts = [f"bench-ledger-{uuid.uuid4().hex[:8]}-{i}" for i in range(args.accounts)]
+                for account_id in accounts:
+                    client.create_account(account_id, "checking")
+                    client.deposit(account_id, 1000000.0)
+                client.close()
+
+            workload = Workload("write-heavy", accounts)
+            runs[setting].append(asyncio.run(drive(address, workload, "closed", args.clients, 0, args.duration)))
+            server.stop(None)
+
+    print(f"{'ledger':<9}{'req/s':>10}{'p50 ms':>9}{'p99 ms':>9}")
+    throughput = {}
+    for setting, results in runs.items():
+        latencies = [latency for result in results for latency in result[0]]
+        throughput[setting] = len(latencies) / sum(result[2] for result in results)
+        print(f"{setting:<9}{throughput[setting]:>10.0f}{percentile(latencies, 50) * 1000:>9.2f}{percentile(latencies, 99) * 1000:>9.2f}")
+    print(f"overhead: {1 - throughput['on'] / throughput['off']:.2%} of throughput")
+
+def idempotency(args):
+    """Write latency without and with request IDs (alternating rounds), and the memory their dedup entries take"""
+    runs = {"off": [], "on": []}
+    accounts = None
+    for _ in range(args.rounds):
+        for setting in ("off", "on"):
+            service = BankService(args.exec_mode, args.storage)
+            server, address = start_server(service)
+            if accounts is None:
+                client = BankClient(address)
+                accounts = [f"bench-idem-{uuid.uuid4().hex[:8]}-{i}" for i in range(args.accounts)]
+                for account_id in accounts:
+                    client.create_account(account_id, "checking")
+                    client.deposit(account_id, 1000000.0)
+                client.close()
+
+            workload = Workload("write-heavy", accounts)
+            runs[setting].append(asyncio.run(drive(address, workload, args.loop, args.clients, args.rate, args.duration, setting == "on")))
+            server.stop(None)
+
+    print(f"{'request IDs':<13}{'req/s':>10}{'p50 ms':>9}{'p99 ms':>9}")
+    for setting, results in runs.items():
+        latencies = [latency for result in results for latency in result[0]]
+        throughput = len(latencies) / sum(result[2] for result in results)
+        print(f"{setting:<13}{throughput:>10.0f}{percentile(latencies, 50) * 1000:>9.2f}{percentile(latencies, 99) * 1000:>9.2f}")
+
+    keys = list(itertools.islice(service.redis.scan_iter(match=IDEMPOTENCY_KEY.format("bench-idem-*", "*"), count=1000), args.sample))
+    try:
+        service.redis.memory_usage(keys[0])
+    except redis.ResponseError:  # In-memory stand-ins lack MEMORY USAGE
+        print("MEMORY USAGE is not supported by this server, memory not measured.")
+        return
+    pipe = service.redis.pipeline(transaction=False)
+    for key in keys:
+        pipe.memory_usage(key)
+    per_entry = sum(pipe.execute()) / len(keys)
+    entries = args.tps * service.store.idempotency_ttl  # Each write keeps one entry for the TTL
+    print(f"{per_entry:.0f} bytes/entry (MEMORY USAGE over {len(keys)} keys): at {args.tps} TPS with a {service.store.idempotency_ttl}s TTL "
+          f"{entries} entries take {entries * per_entry / 2**30:.2f} GiB")
+
+def getbalance(args):
+    """GetBalance latency with the balance cache off and on, over a polled set of accounts"""
+    print(f"{'cache':<8}{'req/s':>10}{'p50 ms':>10}{'p99 ms':>10}{'hit rate':>10}")
+    for cache_size in (0, args.cache_size):
+        service = BankService("script", args.storage, cache_size=cache_size, cache_ttl=args.cache_ttl)
+        if service.cache:
+            deadline = time.monotonic() + 5
+            while not service.cache.enabled and time.monotonic() < deadline:  # Wait for the invalidation listener
+                time.sleep(0.05)
+        server, address = start_server(service)
+        channel = grpc.insecure_channel(address)
+        stub = bank_pb2_grpc.BankServiceStub(channel)
+        run_id = uuid.uuid4().hex[:8]
+        accounts = [f"bench-{run_id}-{i}" for i in range(args.accounts)]
+        for account_id in accounts:
+            stub.CreateAccount(bank_pb2.AccountRequest(account_id=account_id, account_type="checking"))
+
+        latencies, lock = [], threading.Lock()
+
+        def work(_):
+            local = []
+            for i in range(args.requests):
+                account_id = random.choice(accounts)
+                if args.write_every and i % args.write_every == 0:  # Occasional writes invalidate entries
+                    stub.Deposit(bank_pb2.DepositRequest(account_id=account_id, amount=1.0))
+                start = time.perf_counter()
+                stub.GetBalance(bank_pb2.AccountRequest(account_id=account_id))
+                local.append(time.perf_counter() - start)
+            with lock:
+                latencies.extend(local)
+
+        elapsed = run_threads(args.threads, work)
+        channel.close()
+        server.stop(None)
+
+        stats = service.cache.stats() if service.cache else {"hit_rate": 0.0}
+        print(f"{'on' if cache_size else 'off':<8}{len(latencies) / elapsed:>10.0f}"
+              f"{percentile(latencies, 50) * 1000:>10.2f}{percentile(latencies, 99) * 1000:>10.2f}{stats['hit_rate']:>10.1%}")
+        if service.cache:
+            service.cache_listener.stop()
+            print(json.dumps(stats))
+
+def durable(args):
+    """Write throughput and latency of the sqlite engine at several group-commit windows, against Redis"""
+    print(f"{'engine':<8}{'window':>8}{'req/s':>10}{'commits/s':>11}{'per commit':>12}{'p50 ms':>9}{'p99 ms':>9}{'errors':>8}")
+    directory = tempfile.mkdtemp(prefix="bench-durable-")
+    for engine, window in [("redis", None)] + [("sqlite", window) for window in args.windows]:
+        service = BankService("script", args.storage, engine=engine, sqlite_path=os.path.join(directory, f"{window}.db"), commit_window=window)
+        server, address = start_server(service, args.server_threads)
+        client = BankClient(address)
+        accounts = [f"bench-durable-{uuid.uuid4().hex[:8]}-{i}" for i in range(args.accounts)]
+        for account_id in accounts:
+            client.create_account(account_id, "checking")
+        list(client.submit_batch(("deposit", account_id, 1000000.0) for account_id in accounts))
+        client.close()
+
+        commits = getattr(service.store, "commits", 0)
+        latencies, codes, elapsed = asyncio.run(drive(address, Workload("write-heavy", accounts), "closed", args.clients, 0, args.duration))
+        commits = getattr(service.store, "commits", 0) - commits
+        server.stop(None)
+        result = summarize(latencies, codes, elapsed)
+        writes = 1 - WORKLOADS["write-heavy"]["get"]  # Share of requests that commit
+        per_second, per_commit = (f"{commits / elapsed:.0f}", f"{result['requests'] * writes / commits:.1f}") if commits else ("-", "-")
+        print(f"{engine:<8}{'-' if window is None else f'{window * 1000:g}ms':>8}{result['throughput']:>10.0f}{per_second:>11}{per_commit:>12}"
+              f"{result['latency_ms']['p50']:>9.2f}{result['latency_ms']['p99']:>9.2f}{result['error_rate']:>8.2%}")
+    shutil.rmtree(directory)
+
+    if args.crash:
+        crash_check(args)
+
+def crash_check(args):
+    """SIGKILLs a sqlite engine server under deposit load and checks every acknowledged deposit survived the restart"""
+    directory = tempfile.mkdtemp(prefix="bench-crash-")
+    path = os.path.join(directory, "crash.db")
+    server_args = ("--engine", "sqlite", "--sqlite-path", path, "--storage", args.storage)
+    process, address = spawn_server(*server_args)
+    client = BankClient(address, timeout=2)
+    client.create_account("crash", "checking")
+    acknowledged, stop, lock = [0], threading.Event(), threading.Lock()
+
+    def work(_):
+        while not stop.is_set():
+            try:
+                client.deposit("crash", 1.0)
+            except BankError:  # Killed mid-call: maybe applied, never acknowledged
+                return
+            with lock:
+                acknowledged[0] += 1
+
+    workers = [threading.Thread(target=work, args=(i,)) for i in range(args.clients)]
+    for worker in workers:
+        worker.start()
+    time.sleep(args.duration / 2)
+    process.kill()  # No chance to flush anything
+    process.wait()
+    stop.set()
+    for worker in workers:
+        worker.join()
+    client.close()
+
+    process, address = spawn_server(*server_args)
+    client = BankClient(address)
+    recovered = round(client.get_balance("crash"))
+    client.close()
+    stop_server(process)
+    shutil.rmtree(directory)
+    print(f"crash: {acknowledged[0]} deposits acknowledged before SIGKILL, {recovered} recovered, "
+          f"{max(0, acknowledged[0] - recovered)} acknowledged deposits lost")
+
+def clients(args):
+    """Calls/sec of the threaded sync BankClient vs AsyncBankClient's bulk helpers against one async server"""
+    process, address = spawn_server("--mode", "async", "--exec-mode", "script", "--storage", args.storage)
+    try:
+        client = BankClient(address)
+        accounts = [f"bench-client-{uuid.uuid4().hex[:8]}-{i}" for i in range(args.accounts)]
+        for account_id in accounts:
+            client.create_account(account_id, "checking")
+        calls = [("get_balance", (account_id,)) if i % 2 else ("deposit", (account_id, 1.0))
+                 for i, account_id in enumerate(random.choice(accounts) for _ in range(args.calls))]  # 50% reads, 50% deposits
+
+        def call(named):
+            name, call_args = named
+            try:
+                return getattr(client, name)(*call_args)
+            except BankError as e:  # Kept in place, as AsyncBankClient.bulk does
+                return e
+
+        print(f"{'client':<8}{'concurrency':>12}{'calls/s':>10}{'errors':>8}")
+        for threads in args.threads:
+            with futures.ThreadPoolExecutor(threads) as executor:
+                start = time.perf_counter()
+                results = list(executor.map(call, calls))
+                elapsed = time.perf_counter() - start
+            print(f"{'sync':<8}{threads:>12}{len(calls) / elapsed:>10.0f}{sum(isinstance(r, Exception) for r in results):>8}")
+        client.close()
+
+        async def run_async(concurrency):
+            async with AsyncBankClient(address) as client:
+                start = time.perf_counter()
+                results = await client.bulk(lambda name, call_args: getattr(client, name)(*call_args), calls, concurrency)
+                return results, time.perf_counter() - start
+
+        for concurrency in args.concurrency:
+            results, elapsed = asyncio.run(run_async(concurrency))
+            print(f"{'async':<8}{concurrency:>12}{len(calls) / elapsed:>10.0f}{sum(isinstance(r, Exception) for r in results):>8}")
+    finally:
+        stop_server(process)
+
+def overload(args):
+    """Served latency at factor x capacity with grpc's unbounded queue vs admission control and rate limits"""
+    settings = [("unbounded", ("--queue-depth", "0")), (f"queue {args.queue_depth}", ("--queue-depth", str(args.queue_depth)))]
+    if args.account_rate:
+        settings.append((f"+{args.account_rate:g}/s/acct", ("--queue-depth", str(args.queue_depth), "--account-rate", str(args.account_rate))))
+    capacity = None
+    print(f"{'server':<16}{'offered/s':>10}{'served/s':>10}{'shed':>8}{'p50 ms':>9}{'p99 ms':>9}{'p99 all':>9}")
+    for label, server_args in settings:
+        process, address = spawn_server("--engine", args.engine, "--exec-mode", "script", "--storage", args.storage, *server_args)
+        try:
+            client = BankClient(address)
+            accounts = [f"bench-overload-{uuid.uuid4().hex[:8]}-{i}" for i in range(args.accounts)]
+            for account_id in accounts:
+                client.create_account(account_id, "checking")
+            list(client.submit_batch(("deposit", account_id, 1000000.0) for account_id in accounts))
+            client.close()
+            workload = Workload("write-heavy", accounts)
+            if capacity is None:  # Measured once, closed-loop on the unbounded server
+                _, codes, elapsed = asyncio.run(drive(address, workload, "closed", args.clients, 0, args.duration))
+                capacity = codes["OK"] / elapsed
+                print(f"capacity: {capacity:.0f} req/s with {args.clients} callers, offering {args.factor:g}x")
+            served = []
+            latencies, codes, elapsed = asyncio.run(drive(address, workload, "open", 0, capacity * args.factor, args.duration, ok_latencies=served))
+        finally:
+            stop_server(process)
+        total = sum(codes.values())
+        shed = codes["RESOURCE_EXHAUSTED"] / total if total else 0.0
+        print(f"{label:<16}{total / args.duration:>10.0f}{len(served) / elapsed:>10.0f}{shed:>8.1%}{percentile(served, 50) * 1000:>9.2f}"
+              f"{percentile(served, 99) * 1000:>9.2f}{percentile(latencies, 99) * 1000:>9.2f}")
+
+UI_SETTINGS = ("writes only", "session poll", "shared poll", "shared watch")
+
+def ui_run(process, address, setting, accounts, args):
+    """One ui setting: returns channels, streams, GetBalance calls/s, server CPU share and update delays
+
+    Each session shows one account's balance while a writer deposits to
+    random accounts at --write-rate. Delays run from a deposit's reply to a
+    session showing its balance.
+    """
+    stop, lock = threading.Event(), threading.Lock()
+    written, delays, calls = {}, [], [0]
+    sessions = 0 if setting == "writes only" else args.sessions
+    shared = BankClient(address)
+    clients = [BankClient(address) for _ in range(sessions)] if setting == "session poll" else [shared] * sessions
+    watcher = BalanceWatcher(shared) if setting == "shared watch" else None
+
+    def writer():
+        client = BankClient(address)
+        while not stop.wait(random.expovariate(args.write_rate)):
+            account_id = random.choice(accounts)
+            balance = client.deposit(account_id, 1.0).balance
+            with lock:
+                written[(account_id, round(balance, 2))] = time.perf_counter()
+        client.close()
+
+    def session(index):
+        client, account_id = clients[index], accounts[index % len(accounts)]
+        shown, version = None, 0
+        stop.wait(random.uniform(0, args.poll_interval))  # Sessions were not all opened at once
+        while not stop.is_set():
+            started = time.perf_counter()
+            if watcher:
+                version, balance = watcher.wait(account_id, version, timeout=0.5)
+            else:
+                balance = client.get_balance(account_id)
+            with lock:
+                calls[0] += not watcher
+                at = written.get((account_id, round(balance, 2))) if balance is not None and balance != shown else None
+                if at is not None:
+                    delays.append(time.perf_counter() - at)
+            shown = balance
+            if not watcher:
+                stop.wait(max(0.0, args.poll_interval - (time.perf_counter() - started)))
+
+    threads = [threading.Thread(target=writer)] + [threading.Thread(target=session, args=(i,)) for i in range(sessions)]
+    for thread in threads:
+        thread.start()
+    time.sleep(args.poll_interval)  # Every session running, streams opened
+    with lock:
+        delays.clear()
+        calls[0] = 0
+    cpu, start = process_cpu(process.pid), time.perf_counter()
+    time.sleep(args.duration)
+    cpu, elapsed = process_cpu(process.pid) - cpu, time.perf_counter() - start
+    stop.set()
+    for thread in threads:
+        thread.join()
+    if watcher:
+        watcher.close()
+    for client in set(clients) | {shared}:
+        client.close()
+    channels = len(set(clients)) if sessions else 0
+    streams = min(sessions, len(accounts)) if watcher else 0
+    return channels, streams, calls[0] / elapsed, cpu / elapsed, delays
+
+def ui(args):
+    """Server load of --sessions simulated web UI sessions showing live balances, per client setup
+
+    session poll is the old UI (a client and channel per session, GetBalance
+    every --poll-interval), shared poll polls over one shared client, and
+    shared watch reads pushed updates from one WatchBalance stream per account
+    through BalanceWatcher. writes only is the writer's own share.
+    """
+    process, address = spawn_server("--engine", args.engine, "--exec-mode", "script", "--storage", args.storage)
+    try:
+        client = BankClient(address)
+        accounts = [f"bench-ui-{uuid.uuid4().hex[:8]}-{i}" for i in range(args.accounts)]
+        for account_id in accounts:
+            client.create_account(account_id, "checking")
+        client.close()
+
+        print(f"{args.sessions} sessions over {args.accounts} accounts, {args.write_rate:g} deposits/s, polling every {args.poll_interval:g}s")
+        print(f"{'setting':<14}{'channels':>9}{'streams':>9}{'polls/s':>9}{'server cpu':>12}{'delay p50':>11}{'delay p99':>11}{'updates':>9}")
+        for setting in UI_SETTINGS:
+            channels, streams, polls, cpu, delays = ui_run(process, address, setting, accounts, args)
+            p50, p99 = ("-", "-") if not delays else (f"{percentile(delays, 50) * 1000:.0f}ms", f"{percentile(delays, 99) * 1000:.0f}ms")
+            print(f"{setting:<14}{channels:>9}{streams:>9}{polls:>9.0f}{cpu:>12.1%}{p50:>11}{p99:>11}{len(delays):>9}")
+    finally:
+        stop_server(process)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="bankRPC benchmarks (needs a local redis-server, see $REDIS_HOST)")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = commands.add_parser("run", help="Workload driver: throughput, p50-p999 latency and error rates, saved as JSON")
+    run_parser.add_argument("--workloads", nargs="+", choices=WORKLOADS, default=["read-heavy", "write-heavy", "hot-key"], help="Workloads to run")
+    run_parser.add_argument("--distribution", choices=["uniform", "zipf"], default="uniform", help="How accounts are picked")
+    run_parser.add_argument("--zipf-s", type=float, default=1.1, help="Zipf exponent, higher is more skewed")
+    run_parser.add_argument("--loop", choices=["closed", "open"], default="closed", help="Closed loop (--clients) or open loop (--rate)")
+    run_parser.add_argument("--clients", type=int, default=32, help="Closed loop: concurrent callers")
+    run_parser.add_argument("--rate", type=float, default=1000.0, help="Open loop: requests/sec (Poisson arrivals)")
+    run_parser.add_argument("--duration", type=float, default=10.0, help="Seconds per workload")
+    run_parser.add_argument("--accounts", type=int, default=1000, help="Accounts spread across the load")
+    run_parser.add_argument("--hot-accounts", type=int, default=4, help="Accounts in the hot-key workload")
+    run_parser.add_argument("--exec-mode", choices=["watch", "script"], default="watch", help="Execution mode of the in-process server")
+    run_parser.add_argument("--storage", choices=["json", "hash"], default="json", help="Account storage layout")
+    run_parser.add_argument("--backend", choices=["redis", "fakeredis", "memory"], default="redis",
+                            help="redis-server at $REDIS_HOST, in-memory fakeredis, or the in-process memory engine (no Redis at all)")
+    run_parser.add_argument("--server-threads", type=int, default=10, help="Handler threads of the in-process server")
+    run_parser.add_argument("--server", help="Drive a running server at this address instead of an in-process one")
+    run_parser.add_argument("--output", help="Save results to this JSON file")
+    run_parser.add_argument("--baseline", help="Compare against results saved with --output")
+    run_parser.set_defaults(func=run)
+
+    contention_parser = commands.add_parser("contention", help="ABORTED rate and p99 latency on hot accounts")
+    contention_parser.add_argument("--modes", nargs="+", default=["watch", "script"], help="Execution modes to compare")
+    contention_parser.add_argument("--storage", choices=["json", "hash"], default="json", help="Account storage layout")
+    contention_parser.add_argument("--accounts", type=int, default=2, help="Number of hot accounts")
+    contention_parser.add_argument("--threads", type=int, default=32, help="Concurrent client threads")
+    contention_parser.add_argument("--requests", type=int, default=200, help="Deposits per client thread")
+    contention_parser.add_argument("--server-threads", type=int, default=32, help="Handler threads of the in-process server")
+    contention_parser.add_argument("--write-combine-delays", type=float, nargs="*", default=[0.0, 0.001],
+                                   help="Write combiner batch delays (seconds) to compare against no combining")
+    contention_parser.set_defaults(func=contention)
+
+    transfer_parser = commands.add_parser("transfer", help="Withdraw+deposit pairs vs the Transfer RPC on hot accounts")
+    transfer_parser.add_argument("--paths", nargs="+", choices=["withdraw+deposit", "transfer"], default=["withdraw+deposit", "transfer"], help="Paths to compare")
+    transfer_parser.add_argument("--exec-mode", choices=["watch", "script"], default="watch", help="Execution mode of the Transfer run (pairs always use watch)")
+    transfer_parser.add_argument("--storage", choices=["json", "hash"], default="json", help="Account storage layout")
+    transfer_parser.add_argument("--accounts", type=int, default=4, help="Number of hot accounts")
+    transfer_parser.add_argument("--balance", type=float, default=1000000.0, help="Starting balance of each account")
+    transfer_parser.add_argument("--threads", type=int, default=32, help="Concurrent client threads")
+    transfer_parser.add_argument("--requests", type=int, default=200, help="Transfers per client thread")
+    transfer_parser.set_defaults(func=transfers)
+
+    memory_parser = commands.add_parser("memory", help="MEMORY USAGE of JSON vs hash account records")
+    memory_parser.add_argument("--accounts", type=int, default=1000000, help="Accounts written per layout")
+    memory_parser.add_argument("--batch-size", type=int, default=10000, help="Writes per pipeline")
+    memory_parser.add_argument("--sample", type=int, default=1000, help="Keys sampled with MEMORY USAGE")
+    memory_parser.set_defaults(func=memory)
+
+    batch_parser = commands.add_parser("batch", help="Unary Deposit vs BatchTransactions rows/sec")
+    batch_parser.add_argument("--rows", type=int, default=10000, help="Deposits per path")
+    batch_parser.add_argument("--exec-mode", choices=["watch", "script"], default="watch", help="Execution mode of the unary path")
+    batch_parser.add_argument("--storage", choices=["json", "hash"], default="json", help="Account storage layout")
+    batch_parser.set_defaults(func=batch)
+
+    load_parser = commands.add_parser("load", help="Threaded vs async server throughput and tail latency")
+    load_parser.add_argument("--modes", nargs="+", default=["threaded", "async"], help="Serving modes to compare")
+    load_parser.add_argument("--clients", type=int, nargs="+", default=[10, 100, 1000], help="Concurrent client levels")
+    load_parser.add_argument("--duration", type=float, default=10.0, help="Seconds per client level")
+    load_parser.add_argument("--accounts", type=int, default=1000, help="Accounts spread across the load")
+    load_parser.add_argument("--storage", choices=["json", "hash"], default="hash", help="Account storage layout")
+    load_parser.set_defaults(func=load)
+
+    accrual_parser = commands.add_parser("accrual", help="Interest accrual throughput over synthetic accounts")
+    accrual_parser.add_argument("--accounts", type=int, default=1000000, help="Synthetic accounts")
+    accrual_parser.add_argument("--batch-size", type=int, default=1000, help="Keys per SCAN chunk")
+    accrual_parser.add_argument("--storage", choices=["json", "hash"], default="hash", help="Account storage layout")
+    accrual_parser.set_defaults(func=accrual)
+
+    snapshot_parser = commands.add_parser("snapshot", help="Snapshot export and import accounts/sec and file size")
+    snapshot_parser.add_argument("--accounts", type=int, default=100000, help="Synthetic accounts to export and import")
+    snapshot_parser.add_argument("--batch-size", type=int, default=1000, help="Accounts per SCAN batch, chunk and pipelined write")
+    snapshot_parser.add_argument("--storage", choices=["json", "hash"], default="hash", help="Account storage layout")
+    snapshot_parser.set_defaults(func=snapshot)
+
+    indexes_parser = commands.add_parser("indexes", help="ListAccounts latency from the secondary indexes vs a full SCAN")
+    indexes_parser.add_argument("--accounts", type=int, default=100000, help="Synthetic accounts, four types with balances spread over 0-9999.99")
+    indexes_parser.add_argument("--batch-size", type=int, default=1000, help="Accounts per index read, SCAN batch and pipelined write")
+    indexes_parser.add_argument("--rounds", type=int, default=5, help="Runs of each query, the median is reported")
+    indexes_parser.add_argument("--storage", choices=["json", "hash"], default="json", help="Account storage layout")
+    indexes_parser.set_defaults(func=indexes)
+
+    roundtrips_parser = commands.add_parser("roundtrips", help="Redis round trips per RPC (x-redis-round-trips trailer)")
+    roundtrips_parser.set_defaults(func=roundtrips)
+
+    metrics_parser = commands.add_parser("metrics", help="Throughput cost of the metrics interceptor and Redis timing")
+    metrics_parser.add_argument("--rounds", type=int, default=3, help="Alternating off/on rounds")
+    metrics_parser.add_argument("--duration", type=float, default=5.0, help="Seconds per round and setting")
+    metrics_parser.add_argument("--clients", type=int, default=32, help="Concurrent callers")
+    metrics_parser.add_argument("--accounts", type=int, default=1000, help="Accounts spread across the load")
+    metrics_parser.add_argument("--exec-mode", choices=["watch", "script"], default="script", help="Execution mode")
+    metrics_parser.add_argument("--storage", choices=["json", "hash"], default="hash", help="Account storage layout")
+    metrics_parser.set_defaults(func=metrics_overhead)
+
+    idempotency_parser = commands.add_parser("idempotency", help="Latency and memory cost of request ID deduplication")
+    idempotency_parser.add_argument("--rounds", type=int, default=3, help="Alternating off/on rounds")
+    idempotency_parser.add_argument("--duration", type=float, default=5.0, help="Seconds per round and setting")
+    idempotency_parser.add_argument("--loop", choices=["closed", "open"], default="closed", help="Closed loop (--clients) or open loop (--rate)")
+    idempotency_parser.add_argument("--clients", type=int, default=32, help="Closed loop: concurrent callers")
+    idempotency_parser.add_argument("--rate", type=float, default=1000.0, help="Open loop: requests/sec (Poisson arrivals)")
+    idempotency_parser.add_argument("--accounts", type=int, default=1000, help="Accounts spread across the load")
+    idempotency_parser.add_argument("--tps", type=int, default=10000, help="Write rate the memory estimate is made for")
+    idempotency_parser.add_argument("--sample", type=int, default=1000, help="Dedup entries sampled with MEMORY USAGE")
+    idempotency_parser.add_argument("--exec-mode", choices=["watch", "script"], default="script", help="Execution mode")
+    idempotency_parser.add_argument("--storage", choices=["json", "hash"], default="hash", help="Account storage layout")
+    idempotency_parser.set_defaults(func=idempotency)
+
+    ledger_parser = commands.add_parser("ledger", help="Write-path cost of recording every transaction in the ledger")
+    ledger_parser.add_argument("--rounds", type=int, default=3, help="Alternating off/on rounds")
+    ledger_parser.add_argument("--duration", type=float, default=5.0, help="Seconds per round and setting")
+    ledger_parser.add_argument("--clients", type=int, default=32, help="Concurrent callers")
+    ledger_parser.add_argument("--accounts", type=int, default=1000, help="Accounts spread across the load")
+    ledger_parser.add_argument("--exec-mode", choices=["watch", "script"], default="script", help="Execution mode")
+    ledger_parser.add_argument("--storage", choices=["json", "hash"], default="hash", help="Account storage layout")
+    ledger_parser.set_defaults(func=ledger_overhead)
+
+    getbalance_parser = commands.add_parser("getbalance", help="GetBalance latency with the balance cache off and on")
+    getbalance_parser.add_argument("--accounts", type=int, default=100, help="Accounts polled")
+    getbalance_parser.add_argument("--threads", type=int, default=16, help="Concurrent client threads")
+    getbalance_parser.add_argument("--requests", type=int, default=2000, help="GetBalance calls per client thread")
+    getbalance_parser.add_argument("--write-every", type=int, default=50, help="Deposit before every Nth read, 0 for read-only")
+    getbalance_parser.add_argument("--cache-size", type=int, default=10000, help="Cached accounts in the cache-on run")
+    getbalance_parser.add_argument("--cache-ttl", type=float, default=30.0, help="Seconds a cached balance may be served")
+    getbalance_parser.add_argument("--storage", choices=["json", "hash"], default="json", help="Account storage layout")
+    getbalance_parser.set_defaults(func=getbalance)
+
+    durable_parser = commands.add_parser("durable", help="sqlite engine writes/sec and latency per group-commit window, against Redis")
+    durable_parser.add_argument("--windows", type=float, nargs="+", default=[0.0, 0.001, 0.005], help="Group-commit windows (seconds) to compare")
+    durable_parser.add_argument("--duration", type=float, default=5.0, help="Seconds per setting")
+    durable_parser.add_argument("--clients", type=int, default=64, help="Concurrent callers")
+    durable_parser.add_argument("--accounts", type=int, default=1000, help="Accounts spread across the load")
+    durable_parser.add_argument("--server-threads", type=int, default=64, help="Handler threads, a group commit holds one per mutation")
+    durable_parser.add_argument("--storage", choices=["json", "hash"], default="hash", help="Account storage layout")
+    durable_parser.add_argument("--crash", action="store_true", help="Also SIGKILL a sqlite server under load and count lost acknowledged deposits")
+    durable_parser.set_defaults(func=durable)
+
+    client_parser = commands.add_parser("client", help="Calls/sec of the threaded sync client vs the asyncio client")
+    client_parser.add_argument("--calls", type=int, default=20000, help="Calls per run, half GetBalance and half Deposit")
+    client_parser.add_argument("--accounts", type=int, default=1000, help="Accounts spread across the calls")
+    client_parser.add_argument("--threads", type=int, nargs="+", default=[16, 64], help="Thread pool sizes of the sync runs")
+    client_parser.add_argument("--concurrency", type=int, nargs="+", default=[16, 64, 1000], help="Calls in flight of the async runs")
+    client_parser.add_argument("--storage", choices=["json", "hash"], default="hash", help="Account storage layout")
+    client_parser.set_defaults(func=clients)
+
+    overload_parser = commands.add_parser("overload", help="Served p99 under overload: unbounded queue vs admission control")
+    overload_parser.add_argument("--factor", type=float, default=2.0, help="Offered load as a multiple of the measured capacity")
+    overload_parser.add_argument("--duration", type=float, default=10.0, help="Seconds per setting")
+    overload_parser.add_argument("--clients", type=int, default=64, help="Closed-loop callers measuring the capacity")
+    overload_parser.add_argument("--accounts", type=int, default=1000, help="Accounts spread across the load")
+    overload_parser.add_argument("--queue-depth", type=int, default=50, help="Admission-controlled server's --queue-depth")
+    overload_parser.add_argument("--account-rate", type=float, default=0.0, help="Also run with this per-account rate limit (req/s), 0 skips it")
+    overload_parser.add_argument("--engine", choices=["redis", "memory"], default="redis", help="Storage engine of the server")
+    overload_parser.add_argument("--storage", choices=["json", "hash"], default="hash", help="Account storage layout")
+    overload_parser.set_defaults(func=overload)
+
+    ui_parser = commands.add_parser("ui", help="Server CPU and update delay of 100 web UI sessions: polling vs shared WatchBalance streams")
+    ui_parser.add_argument("--sessions", type=int, default=100, help="Simulated UI sessions")
+    ui_parser.add_argument("--accounts", type=int, default=20, help="Accounts shown, sessions share them round robin")
+    ui_parser.add_argument("--poll-interval", type=float, default=1.0, help="Seconds between GetBalance polls of a polling session")
+    ui_parser.add_argument("--write-rate", type=float, default=20.0, help="Deposits/sec to random accounts")
+    ui_parser.add_argument("--duration", type=float, default=10.0, help="Seconds measured per setting")
+    ui_parser.add_argument("--engine", choices=["redis", "memory"], default="redis", help="Storage engine of the server")
+    ui_parser.add_argument("--storage", choices=["json", "hash"], default="hash", help="Account storage layout")
+    ui_parser.set_defaults(func=ui)
+
+    cores = os.cpu_count() or 1
+    scaling_parser = commands.add_parser("scaling", help="Requests/sec vs supervisor worker count")
+    scaling_parser.add_argument("--workers", type=int, nargs="+", default=sorted({1, *range(2, cores + 1, 2), cores}), help="Worker counts to measure")
+    scaling_parser.add_argument("--mode", choices=["threaded", "async"], default="threaded", help="Serving mode of each worker")
+    scaling_parser.add_argument("--client-processes", type=int, default=cores, help="Load generating processes")
+    scaling_parser.add_argument("--clients", type=int, default=32, help="Concurrent callers per client process")
+    scaling_parser.add_argument("--duration", type=float, default=10.0, help="Seconds per worker count")
+    scaling_parser.add_argument("--accounts", type=int, default=1000, help="Accounts spread across the load")
+    scaling_parser.add_argument("--storage", choices=["json", "hash"], default="hash", help="Account storage layout")
+    scaling_parser.set_defaults(func=scaling)
+
+    shards_parser = commands.add_parser("shards", help="Requests/sec vs number of Redis shards")
+    shards_parser.add_argument("--shards", required=True, help="host:port,host:port... nodes, measured with the first 1, 2, ... N")
+    shards_parser.add_argument("--workers", type=int, default=cores, help="Supervisor worker processes")
+    shards_parser.add_argument("--client-processes", type=int, default=cores, help="Load generating processes")
+    shards_parser.add_argument("--clients", type=int, default=32, help="Concurrent callers per client process")
+    shards_parser.add_argument("--duration", type=float, default=10.0, help="Seconds per shard count")
+    shards_parser.add_argument("--accounts", type=int, default=1000, help="Accounts spread across the load")
+    shards_parser.add_argument("--storage", choices=["json", "hash"], default="hash", help="Account storage layout")
+    shards_parser.set_defaults(func=shards)
+
+    replicas_parser = commands.add_parser("replicas", help="GetBalance reads/sec vs number of Redis replicas serving them")
+    replicas_parser.add_argument("--replicas", required=True, help="host:port,host:port... replicas of $REDIS_HOST, measured with the first 0, 1, ... N")
+    replicas_parser.add_argument("--max-staleness", type=float, default=1.0, help="Seconds a replica may lag behind")
+    replicas_parser.add_argument("--workers", type=int, default=cores, help="Supervisor worker processes")
+    replicas_parser.add_argument("--client-processes", type=int, default=cores, help="Load generating processes")
+    replicas_parser.add_argument("--clients", type=int, default=32, help="Concurrent callers per client process")
+    replicas_parser.add_argument("--duration", type=float, default=10.0, help="Seconds per replica count")
+    replicas_parser.add_argument("--accounts", type=int, default=1000, help="Accounts spread across the reads")
+    replicas_parser.add_argument("--storage", choices=["json", "hash"], default="hash", help="Account storage layout")
+    replicas_parser.set_defaults(func=replicas)
+
+    args = parser.parse_args()
+    args.func(args)
@@ -0,0 +1,183 @@
+"""
+bankRPC - Distributed Banking
+By: Imesh Nimsitha
+2025/02/05
+Cache.py Balance Cache Implementation
+"""
+
+from collections import OrderedDict
+import threading
+import time
+import redis
+
+KEYSPACE_EVENTS = "Kg$hxe"  # Keyspace events for generic, string and hash commands, expiry and eviction
+KEYSPACE_PATTERN = "__keyspace@0__:*"
+
+class _Tombstone:
+    """Marks a recently invalidated key so an in-flight read cannot cache a stale value"""
+
+    __slots__ = ("seq",)
+
+    def __init__(self, seq):
+        self.seq = seq
+
+class BalanceCache:
+    """Bounded LRU cache of accounts with a TTL, read through on misses
+
+    Entries are dropped when an account changes (invalidate) and expire after ttl
+    seconds regardless. Every read remembers the invalidation sequence it started
+    at, and its result is only cached if the account was not invalidated meanwhile.
+    """
+
+    def __init__(self, max_entries=100000, ttl=30.0):
+        """Initialize an empty cache"""
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.enabled = True  # Disabled while invalidations may be missed
+        self._entries = OrderedDict()  # account_id -> (expires, account) or _Tombstone
+        self._lock = threading.Lock()
+        self._seq = 0  # Invalidation sequence number
+        self._evicted_seq = 0  # Highest sequence of an evicted tombstone
+        self.hits = self.misses = self.evictions = self.invalidations = 0
+
+    def get(self, account_id, load):
+        """Returns the cached account, or load(account_id) on a miss"""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(account_id)
+            if self.enabled and isinstance(entry, tuple) and entry[0] > now:
+                self._entries.move_to_end(account_id)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+            seq = self._seq
+
+        account = load(account_id)
+        if account is not None:
+            self._put(account_id, account, seq, now)
+        return account
+
+    def _put(self, account_id, account, seq, now):
+        """Caches a loaded account unless it was invalidated after the load started"""
+        with self._lock:
+            if not self.enabled:
+                return
+            entry = self._entries.get(account_id)
+            if isinstance(entry, _Tombstone) and entry.seq > seq:
+                return
+            if entry is None and self._evicted_seq > seq:  # Its tombstone may have been evicted
+                return
+            self._entries[account_id] = (now + self.ttl, account)
+            self._entries.move_to_end(account_id)
+            self._evict()
+
+    def _evict(self):
+        """Drops least recently used entries beyond max_entries"""
+        while len(self._entries) > self.max_entries:
+            _, entry = self._entries.popitem(last=False)
+            if isinstance(entry, _Tombstone):
+                self._evicted_seq = max(self._evicted_seq, entry.seq)
+            else:
+                self.evictions += 1
+
+    def invalidate(self, account_id):
+        """Drops an account after it changed"""
+        with self._lock:
+            self._seq += 1
+            self.invalidations += 1
+            self._entries[account_id] = _Tombstone(self._seq)
+            self._entries.move_to_end(account_id)
+            self._evict()
+
+    def clear(self):
+        """Drops every entry, and stops in-flight reads from being cached"""
+        with self._lock:
+            self._seq += 1
+            self._evicted_seq = self._seq
+            self._entries.clear()
+
+    def stats(self):
+        """Returns hit/miss counters and the current size"""
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+                "size": sum(1 for entry in self._entries.values() if isinstance(entry, tuple)),
+                "enabled": self.enabled,
+            }
+
+class InvalidationListener:
+    """Invalidates cached accounts from Redis keyspace notifications on background threads
+
+    One thread listens to each node (every shard when sharded). The cache is
+    disabled whenever a subscription is down (and cleared when it comes back),
+    since notifications sent in the meantime are lost. Any object with
+    invalidate(), clear() and enabled can take the cache's place (BalanceWatchers).
+    """
+
+    def __init__(self, clients, cache):
+        """Enables keyspace notifications if needed and starts listening to every client"""
+        self.clients = clients
+        self.cache = cache
+        self._stopped = threading.Event()
+        self._lock = threading.Lock()
+        self._subscribed = set()  # Indexes of the clients with a live subscription
+        self.notifying = all([self._enable_notifications(client) for client in clients])  # False: events may be off
+        self._threads = [threading.Thread(target=self._listen, args=(index,), name=f"balance-cache-invalidation-{index}", daemon=True)
+                         for index in range(len(clients))]
+        for thread in self._threads:
+            thread.start()
+
+    def _enable_notifications(self, client):
+        """Turns on the keyspace events the cache needs (managed Redis may refuse CONFIG SET), returns whether they are on"""
+        try:
+            current = next(iter(client.config_get("notify-keyspace-events").values()), "")
+            current = current.decode() if isinstance(current, bytes) else current
+            missing = "".join(flag for flag in KEYSPACE_EVENTS if flag not in current)
+            if missing:
+                client.config_set("notify-keyspace-events", current + missing)
+            return True
+        except redis.ResponseError as e:
+            print(f"Could not enable keyspace notifications ({e}), the balance cache relies on its TTL "
+                  f"and balance watchers poll across processes.")
+            return False
+
+    def _set_subscribed(self, index, subscribed):
+        """Tracks live subscriptions, the cache is only used while every node is subscribed"""
+        with self._lock:
+            if subscribed:
+                self._subscribed.add(index)
+            else:
+                self._subscribed.discard(index)
+            self.cache.clear()
+            self.cache.enabled = len(self._subscribed) == len(self.clients)
+
+    def _listen(self, index):
+        """Subscription loop for one client, reconnects after connection errors"""
+        while not self._stopped.is_set():
+            pubsub = self.clients[index].pubsub()
+            try:
+                pubsub.psubscribe(KEYSPACE_PATTERN)
+                while not self._stopped.is_set():
+                    message = pubsub.get_message(timeout=1.0)
+                    if message is None:
+                        continue
+                    if message["type"] == "psubscribe":  # Subscribed: nothing can be missed from now on
+                        self._set_subscribed(index, True)
+                    elif message["type"] == "pmessage":
+                        self.cache.invalidate(message["channel"].split(b":", 1)[1].decode())
+            except redis.RedisError:
+                self._set_subscribed(index, False)
+                self._stopped.wait(1.0)
+            finally:
+                pubsub.close()
+
+    def stop(self):
+        """Stops the listener threads"""
+        self._stopped.set()
+        for thread in self._threads:
+            thread.join()
@@ -5,66 +5,473 @@ By: Imesh Nimsitha
 Client.py Implementation
 """
 
+from collections import namedtuple
 import bank_pb2_grpc
 import bank_pb2
+import itertools
+import json
+import queue
+import threading
+import time
+import uuid
 import grpc
 
+RETRY_AFTER_HEADER = "retry-after-ms"  # Trailing metadata of a rate limited call
+
+DEFAULT_TIMEOUT = 5.0  # Seconds per call (deadline), across retries and failover
+
+# Retries run inside gRPC on the same channel with exponential backoff. Mutations always
+# carry a request ID, so a retried one is applied at most once. Throttling stops retrying
+# while most calls fail, so an overloaded server is not hit with a retry storm.
+SERVICE_CONFIG = {
+    "loadBalancingConfig": [{"round_robin": {}}],  # Spread over every address a DNS name resolves to
+    "methodConfig": [{
+        "name": [{"service": "BankService"}],
+        "retryPolicy": {
+            "maxAttempts": 4,
+            "initialBackoff": "0.05s",
+            "maxBackoff": "1s",
+            "backoffMultiplier": 2,
+            "retryableStatusCodes": ["ABORTED", "UNAVAILABLE"],
+        },
+    }],
+    "retryThrottling": {"maxTokens": 100, "tokenRatio": 0.1},
+}
+
+EJECT_TIME = 5.0  # Seconds a channel is skipped after its server was unavailable
+WATCH_IDLE_TIME = 30.0  # Seconds a shared WatchBalance stream stays open after its last reader
+WATCH_RETRY_DELAY = 1.0  # Seconds before a shared WatchBalance stream reconnects after a retryable failure
+
+CHANNEL_OPTIONS = [
+    ("grpc.service_config", json.dumps(SERVICE_CONFIG)),
+    ("grpc.enable_retries", 1),
+    ("grpc.use_local_subchannel_pool", 1),  # Each pooled channel gets its own connection
+    ("grpc.keepalive_time_ms", 30000),
+    ("grpc.keepalive_timeout_ms", 10000),
+]
+
+TransactionResult = namedtuple("TransactionResult", ["account_id", "balance", "message"])
+TransactionResult.__str__ = lambda self: f"{self.message} | New balance: {self.balance}"
+
+class BankError(Exception):
+    """A failed call, code is its grpc.StatusCode and retryable tells if trying again later may succeed"""
+
+    retryable = False
+
+    def __init__(self, code, details, retry_after=None):
+        """Initialize error from an RPC status, retry_after is the seconds the server asked to wait, if any"""
+        super().__init__(details)
+        self.code = code
+        self.details = details
+        self.retry_after = retry_after
+
+class AccountNotFound(BankError):
+    """The account does not exist"""
+
+class AccountExists(BankError):
+    """An account with this ID already exists"""
+
+class InsufficientFunds(BankError):
+    """The balance does not cover the withdrawal or transfer"""
+
+class InvalidRequest(BankError):
+    """The server rejected the arguments (amount, rate, request ID...)"""
+
+class Aborted(BankError):
+    """The account kept changing concurrently, still after the client's retries"""
+
+    retryable = True
+
+class Unavailable(BankError):
+    """No server could take the call, still after the client's retries"""
+
+    retryable = True
+
+class DeadlineExceeded(BankError):
+    """The call did not finish within its timeout"""
+
+    retryable = True
+
+class Overloaded(BankError):
+    """The server shed the call (too many in flight) or it went over a client or account rate limit"""
+
+    retryable = True
+
+ERRORS = {
+    grpc.StatusCode.NOT_FOUND: AccountNotFound,
+    grpc.StatusCode.ALREADY_EXISTS: AccountExists,
+    grpc.StatusCode.FAILED_PRECONDITION: InsufficientFunds,
+    grpc.StatusCode.INVALID_ARGUMENT: InvalidRequest,
+    grpc.StatusCode.ABORTED: Aborted,
+    grpc.StatusCode.UNAVAILABLE: Unavailable,
+    grpc.StatusCode.DEADLINE_EXCEEDED: DeadlineExceeded,
+    grpc.StatusCode.RESOURCE_EXHAUSTED: Overloaded,  # Not retried by gRPC, retrying at once would only add load
+}
+
+def bank_error(error):
+    """Typed exception for a grpc.RpcError"""
+    retry_after = None
+    for key, value in error.trailing_metadata() or ():
+        if key == RETRY_AFTER_HEADER:
+            retry_after = int(value) / 1000
+    return ERRORS.get(error.code(), BankError)(error.code(), error.details(), retry_after)
+
+def parse_addresses(server_address):
+    """Accepts "host:port", "host:port,host:port" or a list of addresses"""
+    if isinstance(server_address, str):
+        server_address = server_address.split(",")
+    return [address.strip() for address in server_address if address.strip()]
+
+def batch_operation(kind, account_id, amount, request_id=""):
+    """BatchOperation message for a ("deposit" | "withdraw", account_id, amount[, request_id]) tuple"""
+    if kind == "deposit":
+        return bank_pb2.BatchOperation(deposit=bank_pb2.DepositRequest(account_id=account_id, amount=amount, request_id=request_id))
+    if kind == "withdraw":
+        return bank_pb2.BatchOperation(withdraw=bank_pb2.WithdrawRequest(account_id=account_id, amount=amount, request_id=request_id))
+    raise ValueError(f"Unknown batch operation: {kind}")
+
 class BankClient:
-    """Client for the gRPC bank service"""
-
-    def __init__(self, server_address="localhost:50051"):
-        """Initializes new bank client"""
-        self.channel = grpc.insecure_channel(server_address)
-        self.stub = bank_pb2_grpc.BankServiceStub(self.channel)
-    
-    def create_account(self, account_id, account_type):
-        """Creates a new bank account with error handling"""
-        try:
-            response = self.stub.CreateAccount(bank_pb2.AccountRequest(account_id=account_id, account_type=account_type))
-            return response.message
-        except grpc.RpcError as e:
-            return f"Error: {e.details()}"
-    
-    def get_balance(self, account_id):
-        """Retrieves the account balance with error handling"""
-        try:
-            response = self.stub.GetBalance(bank_pb2.AccountRequest(account_id=account_id))
-            return response.balance
-        except grpc.RpcError as e:
-            return f"Error: {e.details()}"
-    
-    def deposit(self, account_id, amount):
-        """Deposits the amount into the account with error handling"""
-        try:
-            response = self.stub.Deposit(bank_pb2.DepositRequest(account_id=account_id, amount=amount))
-            return f"{response.message} | New balance: {response.balance}"
-        except grpc.RpcError as e:
-            return f"Error: {e.details()}"
+    """Client for the gRPC bank service
+
+    Calls are spread round robin over a pool of channels, channels_per_address
+    to each server address, and fail over to the next one when a server is
+    unavailable. Results are typed and failures raise BankError subclasses.
+    With hedge_delay set, balance reads that take longer than it are sent
+    again to another channel (up to hedge_attempts copies) and the first
+    reply wins, which cuts tail latency at the cost of a few extra reads.
+    """
+
+    def __init__(self, server_address="localhost:50051", channels_per_address=1, timeout=DEFAULT_TIMEOUT,
+                 hedge_delay=None, hedge_attempts=2):
+        """Initializes new bank client on one or several server addresses"""
+        self.addresses = parse_addresses(server_address)
+        if not self.addresses:
+            raise ValueError("At least one server address is required")
+        self.timeout = timeout
+        self.hedge_delay = hedge_delay
+        self.hedge_attempts = hedge_attempts
+        self.channels = [self._channel(address) for _ in range(channels_per_address) for address in self.addresses]
+        self.stubs = [bank_pb2_grpc.BankServiceStub(channel) for channel in self.channels]
+        self._next = itertools.count()  # Round robin position, next() is atomic
+        self._down = [0.0] * len(self.stubs)  # Per channel: skipped until this time
+
+    def _channel(self, address):
+        """Opens one pooled channel"""
+        return grpc.insecure_channel(address, options=CHANNEL_OPTIONS)
+
+    def close(self):
+        """Closes every pooled channel"""
+        for channel in self.channels:
+            channel.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
 
-    def withdraw(self, account_id, amount):
-        """Withdraws the amount from the account with error handling"""
+    def _stub(self):
+        """Next stub in round robin order, skipping channels that were just found unavailable"""
+        now = time.monotonic()
+        for _ in range(len(self.stubs)):
+            index = next(self._next) % len(self.stubs)
+            if self._down[index] <= now:
+                break
+        return index, self.stubs[index]  # Every channel down: try anyway
+
+    def _failed(self, index, error):
+        """Skips a channel for EJECT_TIME after it could not reach its server"""
+        if error.code() == grpc.StatusCode.UNAVAILABLE:
+            self._down[index] = time.monotonic() + EJECT_TIME
+
+    def _call(self, method, request, timeout=None):
+        """Runs a unary call, failing over to the next channel while servers are unavailable"""
+        deadline = time.monotonic() + (timeout or self.timeout)
+        for attempt in range(len(self.stubs)):
+            index, stub = self._stub()
+            try:
+                return getattr(stub, method)(request, timeout=max(0.0, deadline - time.monotonic()))
+            except grpc.RpcError as e:
+                self._failed(index, e)
+                if e.code() != grpc.StatusCode.UNAVAILABLE or attempt == len(self.stubs) - 1 or time.monotonic() >= deadline:
+                    raise bank_error(e) from e
+
+    def _stream(self, method, request, timeout=None):
+        """Runs a server streaming call, failing over like _call until the first response arrives"""
+        for attempt in range(len(self.stubs)):
+            index, stub = self._stub()
+            started = False
+            try:
+                for response in getattr(stub, method)(request, timeout=timeout):
+                    started = True
+                    yield response
+                return
+            except grpc.RpcError as e:
+                self._failed(index, e)
+                if started or e.code() != grpc.StatusCode.UNAVAILABLE or attempt == len(self.stubs) - 1:
+                    raise bank_error(e) from e
+
+    def _hedged(self, method, request, timeout=None):
+        """Runs a read with hedging: another copy goes out every hedge_delay until one replies"""
+        deadline = time.monotonic() + (timeout or self.timeout)
+        done = queue.Queue()
+        calls, failed = [], 0
         try:
-            response = self.stub.Withdraw(bank_pb2.WithdrawRequest(account_id=account_id, amount=amount))
-            return f"{response.message} | New balance: {response.balance}"
-        except grpc.RpcError as e:
-            return f"Error: {e.details()}"
+            while True:
+                if len(calls) < self.hedge_attempts:
+                    index, stub = self._stub()
+                    call = getattr(stub, method).future(request, timeout=max(0.0, deadline - time.monotonic()))
+                    call.add_done_callback(done.put)
+                    calls.append((index, call))
+                try:
+                    call = done.get(timeout=self.hedge_delay if len(calls) < self.hedge_attempts else None)
+                except queue.Empty:  # Still waiting: send a hedge
+                    continue
+                try:
+                    return call.result()
+                except grpc.RpcError as e:
+                    self._failed(next(index for index, sent in calls if sent is call), e)
+                    failed += 1
+                    if e.code() != grpc.StatusCode.UNAVAILABLE or failed == self.hedge_attempts:  # Any other status is the answer
+                        raise bank_error(e) from e
+        finally:
+            for _, call in calls:
+                call.cancel()  # No-op for finished calls
+
+    def _read(self, method, request, timeout=None):
+        """Runs a read, hedged if enabled"""
+        if self.hedge_delay is not None and self.hedge_attempts > 1:
+            return self._hedged(method, request, timeout)
+        return self._call(method, request, timeout)
+
+    def _transaction(self, method, request, timeout=None):
+        """Runs a mutation and returns its TransactionResult"""
+        response = self._call(method, request, timeout)
+        return TransactionResult(response.account_id, response.balance, response.message)
+
+    def create_account(self, account_id, account_type, timeout=None):
+        """Creates a new bank account, raises AccountExists if the ID is taken"""
+        return self._call("CreateAccount", bank_pb2.AccountRequest(account_id=account_id, account_type=account_type), timeout).message
+
+    def get_balance(self, account_id, timeout=None, max_staleness=None):
+        """Retrieves the account balance, raises AccountNotFound if it does not exist
+
+        max_staleness bounds how many seconds behind a replica serving the read may be,
+        0 reads the primary (read-your-writes); None leaves it to the server.
+        """
+        return self._read("GetBalance", bank_pb2.AccountRequest(account_id=account_id, max_staleness=max_staleness), timeout).balance
+
+    def get_balances(self, account_ids, timeout=None, max_staleness=None):
+        """Retrieves the balances of several accounts in one call, as {account_id: balance or None if not found}, see get_balance for max_staleness"""
+        response = self._read("GetBalances", bank_pb2.BalancesRequest(account_ids=account_ids, max_staleness=max_staleness), timeout)
+        return {entry.account_id: entry.balance if entry.found else None for entry in response.balances}
+
+    def stream_balances(self, account_ids, timeout=None, max_staleness=None):
+        """Streams the balances of a long list of accounts, yielding (account_id, balance or None if not found)"""
+        for response in self._stream("StreamBalances", bank_pb2.BalancesRequest(account_ids=account_ids, max_staleness=max_staleness), timeout):
+            for entry in response.balances:
+                yield entry.account_id, entry.balance if entry.found else None
+
+    def get_transactions(self, account_id, since="", limit=0, newest_first=False, timeout=None):
+        """Retrieves the account's transaction history after the since cursor
+
+        Returns a list of LedgerEntry messages; pass the last one's id as since to get the next page.
+        """
+        request = bank_pb2.TransactionsRequest(account_id=account_id, since=since, limit=limit, newest_first=newest_first)
+        return list(self._stream("GetTransactions", request, timeout or self.timeout))
+
+    def watch_balance(self, account_id, timeout=None):
+        """Yields the account's balance, then the new balance after each change, until timeout seconds (None: forever)
+
+        Changes are pushed by the server, several quick ones may arrive as one
+        update. Raises AccountNotFound if the account does not exist.
+        """
+        for response in self._stream("WatchBalance", bank_pb2.AccountRequest(account_id=account_id), timeout):
+            yield response.balance
+
+    def list_accounts(self, account_type=None, min_balance=None, max_balance=None, page_size=0, page_token="", timeout=None):
+        """Lists the accounts of a type and/or balance range in dollars (bounds included), served from secondary indexes
+
+        Returns a list of AccountSnapshot messages and the next page token: pass it
+        back with the same filter for the next page of about page_size accounts
+        ("" once the listing is complete). page_size=0 lists them all in one call.
+        """
+        request = bank_pb2.ListAccountsRequest(
+            filter=bank_pb2.AccountFilter(account_type=account_type or "", min_balance=min_balance, max_balance=max_balance),
+            page_token=page_token, page_size=page_size)
+        accounts, token = [], ""
+        for page in self._stream("ListAccounts", request, timeout or self.timeout):
+            accounts.extend(page.accounts)
+            token = page.next_page_token
+        return accounts, token
 
-    def calculate_interest(self, account_id, interest_rate):
-        """Calculates the interest for the account with error handling"""
+    def deposit(self, account_id, amount, request_id=None, timeout=None):
+        """Deposits the amount into the account
+
+        Every mutation carries a request ID (a new one unless given) so retries,
+        the client's own included, apply it only once.
+        """
+        request = bank_pb2.DepositRequest(account_id=account_id, amount=amount, request_id=request_id or uuid.uuid4().hex)
+        return self._transaction("Deposit", request, timeout)
+
+    def withdraw(self, account_id, amount, request_id=None, timeout=None):
+        """Withdraws the amount from the account, raises InsufficientFunds if the balance is too low"""
+        request = bank_pb2.WithdrawRequest(account_id=account_id, amount=amount, request_id=request_id or uuid.uuid4().hex)
+        return self._transaction("Withdraw", request, timeout)
+
+    def calculate_interest(self, account_id, interest_rate, request_id=None, timeout=None):
+        """Calculates the interest for the account and deposits it"""
+        request = bank_pb2.InterestRequest(account_id=account_id, annual_interest_rate=interest_rate, request_id=request_id or uuid.uuid4().hex)
+        return self._transaction("CalculateInterest", request, timeout)
+
+    def transfer(self, from_account_id, to_account_id, amount, request_id=None, timeout=None):
+        """Moves the amount between two accounts, the result's balance is the source's"""
+        request = bank_pb2.TransferRequest(from_account_id=from_account_id, to_account_id=to_account_id, amount=amount,
+                                           request_id=request_id or uuid.uuid4().hex)
+        return self._transaction("Transfer", request, timeout)
+
+    def submit_batch(self, operations, timeout=None):
+        """Streams ("deposit" | "withdraw", account_id, amount[, request_id]) operations, yielding one BatchResult per operation in order
+
+        Failures of single operations are reported in their BatchResult, not raised.
+        """
+        index, stub = self._stub()  # No failover: the operations may have been sent already
         try:
-            response = self.stub.CalculateInterest(bank_pb2.InterestRequest(account_id=account_id, annual_interest_rate=interest_rate))
-            return f"{response.message} | New balance: {response.balance}"
+            yield from stub.BatchTransactions((batch_operation(*operation) for operation in operations), timeout=timeout)
         except grpc.RpcError as e:
-            return f"Error: {e.details()}"
+            self._failed(index, e)
+            raise bank_error(e) from e
+
+class _Feed:
+    """Latest balance of one shared WatchBalance stream"""
+
+    def __init__(self):
+        self.version = 0  # Version of the latest update, unique across the watcher's feeds
+        self.balance = None
+        self.readers = 0  # Readers waiting for an update
+        self.error = None  # BankError that ended the stream
+        self.call = None
+        self.closed = False
+        self.last_read = time.monotonic()
+
+class BalanceWatcher:
+    """Shares WatchBalance streams between the threads of a process (web sessions, dashboard widgets)
+
+    The first reader of an account opens one stream on a daemon thread and
+    later readers share it, so the server sees one stream per account and
+    process however many readers there are. Readers pass the version they
+    last saw and get the latest balance once it changes; a slow reader skips
+    to the newest balance instead of queueing updates. A stream is closed
+    idle_time seconds after its last read, and reconnects on its own after
+    retryable failures (server restart, overload).
+    """
+
+    def __init__(self, client, idle_time=WATCH_IDLE_TIME):
+        """Initialize on a BankClient"""
+        self.client = client
+        self.idle_time = idle_time
+        self._feeds = {}  # account_id -> _Feed
+        self._versions = itertools.count(1)  # Readers of a replaced feed still see newer versions
+        self._changed = threading.Condition()
+
+    def _run(self, account_id, feed):
+        """Stream thread: publishes every update to the feed until it is closed or fails for good"""
+        while not feed.closed:
+            index, stub = self.client._stub()
+            try:
+                feed.call = stub.WatchBalance(bank_pb2.AccountRequest(account_id=account_id))
+                if feed.closed:  # Closed before the call could be cancelled
+                    feed.call.cancel()
+                for response in feed.call:
+                    with self._changed:
+                        feed.version = next(self._versions)
+                        feed.balance = response.balance
+                        self._changed.notify_all()
+            except grpc.RpcError as e:
+                if feed.closed:
+                    return
+                self.client._failed(index, e)
+                error = bank_error(e)
+                if not error.retryable:
+                    with self._changed:
+                        feed.error = error
+                        feed.closed = True
+                        if self._feeds.get(account_id) is feed:  # The next reader tries again
+                            del self._feeds[account_id]
+                        self._changed.notify_all()
+                    return
+            time.sleep(WATCH_RETRY_DELAY)  # Server went away or shed the stream
+
+    def _close(self, account_id, feed):
+        """Cancels a feed's stream (condition held)"""
+        feed.closed = True
+        del self._feeds[account_id]
+        if feed.call is not None:
+            feed.call.cancel()
+
+    def _close_idle(self, now):
+        """Cancels the streams nobody read for idle_time seconds (condition held)"""
+        for account_id, feed in list(self._feeds.items()):
+            if not feed.readers and now - feed.last_read > self.idle_time:
+                self._close(account_id, feed)
+
+    def wait(self, account_id, version=0, timeout=None):
+        """Returns (version, balance) once the account's balance is newer than version, or after timeout seconds
+
+        Pass 0 first, then the returned version. On timeout the same version
+        and balance (None before the first one) come back. Raises the stream's
+        BankError, e.g. AccountNotFound.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._changed:
+            now = time.monotonic()
+            self._close_idle(now)
+            feed = self._feeds.get(account_id)
+            if feed is None:
+                feed = self._feeds[account_id] = _Feed()
+                threading.Thread(target=self._run, args=(account_id, feed), name=f"watch-{account_id}", daemon=True).start()
+            feed.readers += 1
+            try:
+                while feed.version <= version and feed.error is None:
+                    remaining = None if deadline is None else deadline - time.monotonic()
+                    if remaining is not None and remaining <= 0:
+                        break
+                    self._changed.wait(remaining)
+            finally:
+                feed.readers -= 1
+                feed.last_read = time.monotonic()
+            if feed.error is not None and feed.version <= version:
+                raise feed.error
+            return feed.version, feed.balance
+
+    def close(self):
+        """Cancels every stream"""
+        with self._changed:
+            for account_id, feed in list(self._feeds.items()):
+                self._close(account_id, feed)
 
 if __name__ == '__main__':
     client = BankClient()  # Initializes new bank client
     print("Client connected...")
 
     print("\nTEST CODE")  # Testing basic functionality
-    print(client.create_account('admin123', 'Savings'))
+    for account_id, account_type in (('admin123', 'Savings'), ('admin456', 'Checking')):
+        try:
+            print(client.create_account(account_id, account_type))
+        except AccountExists as e:
+            print(f"Error: {e}")
     print(f"Balance: {client.get_balance('admin123')}")
     print(client.deposit('admin123', 1000.0))
     print(client.withdraw('admin123', 200.0))
     print(client.calculate_interest('admin123', 5.0))
+    print(client.transfer('admin123', 'admin456', 100.0))
+    try:
+        client.withdraw('admin123', 1e12)
+    except InsufficientFunds as e:
+        print(f"Error: {e}")
+    for entry in client.get_transactions('admin123', limit=10, newest_first=True):
+        print(f"{entry.id} {entry.type} {entry.amount} -> {entry.balance} {entry.reference}")
     print(f"New Balance: {client.get_balance('admin123')}")
+    print(f"Balances: {client.get_balances(['admin123', 'missing123'])}")
+    accounts, _ = client.list_accounts('Savings', min_balance=100.0, page_size=10)
+    print(f"Savings accounts over 100: {[account.account_id for account in accounts]}")
@@ -5,19 +5,40 @@ By: Imesh Nimsitha
 Client_ui.py Web Interface Implementation
 """
 
-import bank_pb2_grpc
-from client import BankClient
-import grpc
+from client import BalanceWatcher, BankClient, BankError
 import streamlit as st
 
+LIVE_REFRESH = 1.0  # Seconds a live balance waits for an update before handing control back to Streamlit
+
+@st.cache_resource
+def shared_client(server_address):
+    """One BankClient (and channel pool) per server address, shared by every session of this process"""
+    return BankClient(server_address)
+
+@st.cache_resource
+def shared_watcher(server_address):
+    """One BalanceWatcher per server address, so sessions showing the same account share one WatchBalance stream"""
+    return BalanceWatcher(shared_client(server_address))
+
+def live_balance(server_address, account_id):
+    """Shows the account's balance and updates it as the server pushes changes, until the session reruns"""
+    watcher, placeholder = shared_watcher(server_address), st.empty()
+    version = 0
+    while True:  # Streamlit stops the loop at the next element update once the session reruns
+        version, balance = watcher.wait(account_id, version, LIVE_REFRESH)
+        if balance is None:
+            placeholder.info("Waiting for the balance...")
+        else:
+            placeholder.metric("Current Balance", f"${balance:.2f}")
+
 def main():
     """Run the Streamlit web interface"""
 
     st.title("🏦 bankRPC — Distributed Banking")  # title and description
     st.markdown("Connect and interact with the [gRPC](https://grpc.io/) Banking Service. Powered by [Redis](https://redis.io/). Developed by [Nimsitha](https://www.nimsitha.com).")
 
-    if 'client' not in st.session_state:  # initializes new client with empty session state
-        st.session_state.client = None
+    if 'server_address' not in st.session_state:  # Sessions only remember the address, clients are shared
+        st.session_state.server_address = None
 
     with st.sidebar:  # Create sidebar to connect to server
         st.header("Service Connection")
@@ -29,21 +50,19 @@ def main():
         
         if st.button("Connect to Bank Service"):
             try:
-                st.session_state.client = BankClient()
-                st.session_state.client.channel = grpc.insecure_channel(server_address)
-                st.session_state.client.stub = bank_pb2_grpc.BankServiceStub(
-                    st.session_state.client.channel
-                )
+                shared_client(server_address)  # Comma-separated addresses are load balanced
+                st.session_state.server_address = server_address
                 st.success("Connected to bank service...")
             except Exception as e:
                 st.error(f"Connection failed: {str(e)}")
 
-    if st.session_state.client:  # If client is connected -> show management UI
+    if st.session_state.server_address:  # If client is connected -> show management UI
+        client = shared_client(st.session_state.server_address)
         st.header("Bank Account Management")
         operation = st.selectbox(
             "Choose Operation",
             ["Create Account", "Deposit", "Withdraw", 
-             "Calculate Interest", "Check Balance"]
+             "Calculate Interest", "Check Balance", "Live Balance"]
         )
 
         # Choosing between different operations
@@ -54,11 +73,10 @@ def main():
                 submitted = st.form_submit_button("Create Account")
                 
                 if submitted:
-                    result = st.session_state.client.create_account(account_id, account_type)
-                    if "Error" in result:
-                        st.error(result)
-                    else:
-                        st.success(result)
+                    try:
+                        st.success(str(client.create_account(account_id, account_type)))
+                    except BankError as e:
+                        st.error(f"Error: {e}")
 
         elif operation == "Deposit":
             with st.form("deposit"):
@@ -67,11 +85,10 @@ def main():
                 submitted = st.form_submit_button("Deposit")
                 
                 if submitted:
-                    result = st.session_state.client.deposit(account_id, amount)
-                    if "Error" in result:
-                        st.error(result)
-                    else:
-                        st.success(result)
+                    try:
+                        st.success(str(client.deposit(account_id, amount)))
+                    except BankError as e:
+                        st.error(f"Error: {e}")
 
         elif operation == "Withdraw":
             with st.form("withdraw"):
@@ -80,11 +97,10 @@ def main():
                 submitted = st.form_submit_button("Withdraw")
                 
                 if submitted:
-                    result = st.session_state.client.withdraw(account_id, amount)
-                    if "Error" in result:
-                        st.error(result)
-                    else:
-                        st.success(result)
+                    try:
+                        st.success(str(client.withdraw(account_id, amount)))
+                    except BankError as e:
+                        st.error(f"Error: {e}")
 
         elif operation == "Calculate Interest":
             with st.form("interest"):
@@ -93,11 +109,10 @@ def main():
                 submitted = st.form_submit_button("Calculate Interest")
                 
                 if submitted:
-                    result = st.session_state.client.calculate_interest(account_id, rate)
-                    if "Error" in result:
-                        st.error(result)
-                    else:
-                        st.success(result)
+                    try:
+                        st.success(str(client.calculate_interest(account_id, rate)))
+                    except BankError as e:
+                        st.error(f"Error: {e}")
 
         elif operation == "Check Balance":
             with st.form("balance"):
@@ -105,11 +120,18 @@ def main():
                 submitted = st.form_submit_button("Check Balance")
                 
                 if submitted:
-                    result = st.session_state.client.get_balance(account_id)
-                    if "Error" in str(result):
-                        st.error(result)
-                    else:
-                        st.metric("Current Balance", f"${result:.2f}")
+                    try:
+                        st.metric("Current Balance", f"${client.get_balance(account_id):.2f}")
+                    except BankError as e:
+                        st.error(f"Error: {e}")
+
+        elif operation == "Live Balance":
+            account_id = st.text_input("Account ID")
+            if account_id and st.checkbox("Watch for changes", value=True):
+                try:
+                    live_balance(st.session_state.server_address, account_id)
+                except BankError as e:
+                    st.error(f"Error: {e}")
 
     else:  # Must connect to server before using management UI
         st.warning("Please connect to the bank service using the sidebar first.")
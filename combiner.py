@@ -0,0 +1,88 @@
+"""
+bankRPC - Distributed Banking
+By: Imesh Nimsitha
+2025/02/05
+Combiner.py Per-Account Write Combining
+"""
+
+from metrics import COMBINED_BATCH
+import threading
+import time
+
+class _Pending:
+    """A queued mutation and, once applied, its (status, balance) result"""
+
+    __slots__ = ("operation", "result", "lead", "done")
+
+    def __init__(self, operation):
+        self.operation = operation  # (op, value, request_id)
+        self.result = None
+        self.lead = False  # Handed the next batch instead of a result
+        self.done = threading.Event()
+
+class WriteCombiner:
+    """Queues concurrent mutations of the same account and applies them as one atomic update
+
+    The first caller for an idle account becomes its leader: it waits up to
+    max_delay seconds for more callers to queue, then applies up to max_batch
+    operations with store.apply_combined() and hands every caller its own
+    result. Callers arriving meanwhile queue for the next batch, which the
+    first of them leads as soon as the previous one is written. At most one
+    update per account is in flight, so handler threads no longer invalidate
+    each other's WATCH, and a hot account takes one write per batch.
+    """
+
+    def __init__(self, store, max_delay=0.0, max_batch=500):
+        """Initialize on a store with apply_combined(), max_delay=0 only combines callers already waiting"""
+        self.store = store
+        self.max_delay = max_delay
+        self.max_batch = max_batch
+        self._lock = threading.Lock()
+        self._queues = {}  # account_id -> [_Pending], present while a batch is being led
+
+    def apply(self, op, account_id, value, request_id=""):
+        """Same as store.apply(), combined with concurrent mutations of the account"""
+        pending = _Pending((op, value, request_id))
+        with self._lock:
+            queue = self._queues.get(account_id)
+            lead = queue is None
+            if lead:  # Idle account: lead the first batch
+                self._queues[account_id] = [pending]
+            else:
+                queue.append(pending)
+
+        if not lead:
+            pending.done.wait()
+            lead = pending.lead  # Handed the next batch, already queued up: no need to wait
+        elif self.max_delay > 0:
+            time.sleep(self.max_delay)
+        if lead:
+            self._lead(account_id)
+
+        if isinstance(pending.result, Exception):  # Every caller of a failed batch sees the error
+            raise pending.result
+        return pending.result
+
+    def _lead(self, account_id):
+        """Applies the next batch of an account, then hands the rest of its queue to the first caller in it"""
+        with self._lock:
+            queue = self._queues[account_id]
+            batch = queue[:self.max_batch]  # Starts with the leader's own operation
+            del queue[:self.max_batch]
+
+        COMBINED_BATCH.observe(len(batch))
+        try:
+            results = self.store.apply_combined(account_id, [pending.operation for pending in batch])
+        except Exception as e:  # Redis errors fail the whole batch, nothing was written
+            results = [e] * len(batch)
+
+        with self._lock:
+            queue = self._queues[account_id]
+            if queue:
+                queue[0].lead = True
+                queue[0].done.set()
+            else:
+                del self._queues[account_id]
+        for pending, result in zip(batch, results):
+            pending.result = result
+            pending.done.set()
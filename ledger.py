@@ -0,0 +1,54 @@
+"""
+bankRPC - Distributed Banking
+By: Imesh Nimsitha
+2025/02/05
+Ledger.py Transaction Ledger Retention
+"""
+
+from redis_pool import add_redis_arguments, create_client, create_shard_clients, redis_options
+from storage import LEDGER_KEY
+import argparse
+import time
+
+def trim(client, older_than=None, maxlen=None, batch_size=1000):
+    """Trims every account ledger on one node to entries newer than older_than seconds and/or the last maxlen ones
+
+    Ledgers are found with SCAN and trimmed with one pipeline of XTRIMs per
+    batch. Returns the number of ledgers scanned and of entries removed.
+    """
+    minid = f"{int((time.time() - older_than) * 1000)}-0" if older_than else None  # Entry IDs start with their time in ms
+    cursor = ledgers = removed = 0
+    while True:
+        cursor, keys = client.scan(cursor=cursor, match=LEDGER_KEY.format("*"), count=batch_size)
+        if keys:
+            pipe = client.pipeline(transaction=False)
+            for key in keys:
+                if minid:
+                    pipe.xtrim(key, minid=minid, approximate=False)
+                if maxlen is not None:
+                    pipe.xtrim(key, maxlen=maxlen, approximate=False)
+            removed += sum(pipe.execute())
+            ledgers += len(keys)
+
+        if cursor == 0:  # Full pass over the node
+            return ledgers, removed
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Apply a retention policy to the transaction ledgers of all accounts")
+    parser.add_argument("--older-than-days", type=float, help="Drop entries older than this many days")
+    parser.add_argument("--maxlen", type=int, help="Keep at most this many entries per account")
+    parser.add_argument("--batch-size", type=int, default=1000, help="Keys per SCAN batch")
+    add_redis_arguments(parser)  # Every shard is trimmed with --redis-shards
+    args = parser.parse_args()
+    if args.older_than_days is None and args.maxlen is None:
+        parser.error("give --older-than-days and/or --maxlen")
+
+    options = redis_options(args)
+    shard_clients, _ = create_shard_clients(options)
+    clients = shard_clients or {"redis": create_client(options)}
+    older_than = args.older_than_days * 24 * 3600 if args.older_than_days is not None else None
+
+    for node, client in clients.items():
+        ledgers, removed = trim(client, older_than, args.maxlen, args.batch_size)
+        print(f"{node}: trimmed {ledgers} ledgers, removed {removed} entries...")
+    print("Done.")
@@ -0,0 +1,279 @@
+"""
+bankRPC - Distributed Banking
+By: Imesh Nimsitha
+2025/02/05
+Memory_store.py In-Memory Storage Engine
+"""
+
+from collections import deque
+from fnmatch import fnmatchcase
+from storage import IDEMPOTENCY_TTL, LAYOUTS, LEDGER_OPS, Account, Store, Transaction, ledger_maxlen
+from os import getenv
+import threading
+import time
+
+STRIPES = 64  # Account locks, concurrent mutations only wait on accounts sharing one
+
+class AccountRecord:
+    """Mutable account record, __slots__ keeps it to a few pointers per account"""
+
+    __slots__ = ("account_type", "balance", "last_accrual")
+
+    def __init__(self, account_type, balance, last_accrual=None):
+        self.account_type = account_type
+        self.balance = balance  # In layout units
+        self.last_accrual = last_accrual
+
+class _Stripe:
+    """Accounts hashed to one lock, with their ledgers and remembered request IDs"""
+
+    __slots__ = ("lock", "accounts", "ledgers", "requests")
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.accounts = {}  # account_id -> AccountRecord
+        self.ledgers = {}  # account_id -> deque of ((ms, seq), op, amount, balance, ref)
+        self.requests = {}  # (account_id, request_id) -> (expires, fingerprint, balance), oldest first
+
+class MemoryStore(Store):
+    """Lock-striped in-process storage engine with the same semantics as RedisStore
+
+    Accounts live in STRIPES dicts, each guarded by its own lock, so updates
+    to different accounts rarely wait on each other and no operation ever
+    aborts. Balances use the same layouts (float dollars or integer cents),
+    the ledger keeps about ledger_maxlen entries per account and request IDs
+    are remembered for idempotency_ttl seconds. Nothing is persisted: it is
+    meant for tests, local benchmarks and as a baseline for Redis' own cost.
+    """
+
+    def __init__(self, layout="json", ledger=True, stripes=STRIPES):
+        """Initialize an empty store, ledger=False stops recording transaction history"""
+        if layout not in LAYOUTS:
+            raise ValueError(f"Unknown storage layout: {layout}")
+        self.layout = LAYOUTS[layout]()
+        self.exec_mode = "memory"
+        self.ledger_maxlen = ledger_maxlen() if ledger else None
+        self.idempotency_ttl = int(getenv("IDEMPOTENCY_TTL", IDEMPOTENCY_TTL))
+        self._stripes = [_Stripe() for _ in range(stripes)]
+        self._ids = []  # Account IDs in creation order, scan cursors index it (accounts are never deleted)
+        self._ids_lock = threading.Lock()
+        self._accruals = {}  # run_id -> progress dict
+        self._accruals_lock = threading.Lock()
+
+    def _stripe(self, account_id):
+        """Stripe holding an account"""
+        return self._stripes[hash(account_id) % len(self._stripes)]
+
+    def _account(self, record):
+        """Account with its balance in dollars for a record, or None"""
+        if record is None:
+            return None
+        return Account(record.account_type, self.layout.from_units(record.balance), record.last_accrual)
+
+    def _replay(self, stripe, account_id, request_id, fingerprint):
+        """Outcome of a request ID already applied to the account, or None (stripe locked)"""
+        if not request_id:
+            return None
+        saved = stripe.requests.get((account_id, request_id))
+        if saved is None or saved[0] < time.monotonic():
+            return None
+        if saved[1] != fingerprint:
+            return "REQUEST_ID_REUSED", None
+        return "OK", self.layout.from_units(saved[2])
+
+    def _remember(self, stripe, account_id, request_id, fingerprint, balance):
+        """Remembers an applied request ID and forgets expired ones (stripe locked)"""
+        if not request_id:
+            return
+        now = time.monotonic()
+        requests = stripe.requests
+        while requests:  # Same TTL for all, so the oldest entries expire first
+            oldest = next(iter(requests))
+            if requests[oldest][0] >= now:
+                break
+            del requests[oldest]
+        requests.pop((account_id, request_id), None)  # Keep insertion order equal to expiry order
+        requests[(account_id, request_id)] = (now + self.idempotency_ttl, fingerprint, balance)
+
+    def _record(self, stripe, account_id, op, amount, balance, ref=""):
+        """Appends a ledger entry with a stream-like ms-seq ID (stripe locked)"""
+        if self.ledger_maxlen is None:
+            return
+        ledger = stripe.ledgers.get(account_id)
+        if ledger is None:
+            ledger = stripe.ledgers[account_id] = deque(maxlen=self.ledger_maxlen or None)
+        ms = int(time.time() * 1000)
+        entry_id = (ms, 0)
+        if ledger and ledger[-1][0] >= entry_id:  # Same millisecond (or clock went back): next sequence
+            entry_id = (ledger[-1][0][0], ledger[-1][0][1] + 1)
+        ledger.append((entry_id, op, amount, balance, ref))
+
+    def get(self, account_id):
+        """Returns the account with its balance in dollars, or None if it does not exist"""
+        return self._account(self._stripe(account_id).accounts.get(account_id))  # Single dict read, no lock needed
+
+    def get_many(self, account_ids):
+        """Returns the accounts (None for missing ones) in order"""
+        return [self.get(account_id) for account_id in account_ids]
+
+    def create(self, account_id, account_type):
+        """Creates a new account with a zero balance"""
+        stripe = self._stripe(account_id)
+        with stripe.lock:
+            if account_id in stripe.accounts:
+                return "EXISTS", None
+            stripe.accounts[account_id] = AccountRecord(account_type, self.layout.to_units(0))
+        with self._ids_lock:
+            self._ids.append(account_id)
+        return "OK", 0.0
+
+    def _apply_locked(self, stripe, op, account_id, value, request_id):
+        """Applies one operation with value in units (stripe locked)"""
+        fingerprint = f"{LEDGER_OPS[op]}:{account_id}:{value!r}"  # Same format as RedisStore
+        saved = self._replay(stripe, account_id, request_id, fingerprint)
+        if saved:
+            return saved
+        record = stripe.accounts.get(account_id)
+        if record is None:
+            return "NOT_FOUND", None
+
+        if op == "deposit":
+            delta = value
+        elif op == "withdraw":
+            if record.balance < value:
+                return "INSUFFICIENT_FUNDS", None
+            delta = -value
+        else:
+            delta = self.layout.interest(record.balance, value)
+        record.balance += delta
+        self._record(stripe, account_id, LEDGER_OPS[op], value if op != "calculate_interest" else delta, record.balance)
+        self._remember(stripe, account_id, request_id, fingerprint, record.balance)
+        return "OK", self.layout.from_units(record.balance)
+
+    def _units(self, op, value):
+        """Converts an operation's value to balance units (interest rates are kept as is)"""
+        return value if op == "calculate_interest" else self.layout.to_units(value)
+
+    def apply(self, op, account_id, value, request_id=""):
+        """Applies a deposit, withdraw or calculate_interest operation to the account"""
+        value = self._units(op, value)
+        if value <= 0:
+            return "INVALID_AMOUNT", None
+        stripe = self._stripe(account_id)
+        with stripe.lock:
+            return self._apply_locked(stripe, op, account_id, value, request_id)
+
+    def apply_combined(self, account_id, operations):
+        """Applies (op, value, request_id) operations to one account under one lock, results in order"""
+        operations = [(op, self._units(op, value), request_id) for op, value, request_id in operations]
+        stripe = self._stripe(account_id)
+        with stripe.lock:
+            return [self._apply_locked(stripe, op, account_id, value, request_id) if value > 0 else ("INVALID_AMOUNT", None)
+                    for op, value, request_id in operations]
+
+    def transfer(self, from_account_id, to_account_id, amount, request_id=""):
+        """Moves an amount in dollars between two accounts, locking their stripes in a fixed order"""
+        value = self._units("transfer", amount)
+        if value <= 0:
+            return "INVALID_AMOUNT", None
+        source_stripe, target_stripe = self._stripe(from_account_id), self._stripe(to_account_id)
+        locks = sorted({id(stripe): stripe.lock for stripe in (source_stripe, target_stripe)}.items())  # No deadlocks
+        for _, lock in locks:
+            lock.acquire()
+        try:
+            fingerprint = f"transfer:{from_account_id}:{to_account_id}:{value!r}"
+            saved = self._replay(source_stripe, from_account_id, request_id, fingerprint)
+            if saved:
+                return saved
+            source = source_stripe.accounts.get(from_account_id)
+            target = target_stripe.accounts.get(to_account_id)
+            if source is None or target is None:
+                return "NOT_FOUND", None
+            if source.balance < value:
+                return "INSUFFICIENT_FUNDS", None
+
+            target.balance += value
+            self._record(target_stripe, to_account_id, "transfer_in", value, target.balance, from_account_id)
+            source.balance -= value
+            self._record(source_stripe, from_account_id, "transfer_out", value, source.balance, to_account_id)
+            self._remember(source_stripe, from_account_id, request_id, fingerprint, source.balance)
+            return "OK", self.layout.from_units(source.balance)
+        finally:
+            for _, lock in reversed(locks):
+                lock.release()
+
+    def transactions(self, account_id, since="", count=100, newest_first=False):
+        """Returns up to count ledger entries of the account after the since cursor (an entry ID), oldest first by default"""
+        stripe = self._stripe(account_id)
+        with stripe.lock:
+            entries = list(stripe.ledgers.get(account_id, ()))
+        if since:
+            ms, _, seq = since.partition("-")
+            cursor = (int(ms), int(seq) if seq else (-1 if newest_first else float("inf")))  # Like XRANGE's incomplete IDs
+            entries = [entry for entry in entries if (entry[0] < cursor if newest_first else entry[0] > cursor)]
+        if newest_first:
+            entries.reverse()
+        return [
+            Transaction(f"{entry_id[0]}-{entry_id[1]}", op, self.layout.from_units(amount), self.layout.from_units(balance), ref)
+            for entry_id, op, amount, balance, ref in entries[:count]
+        ]
+
+    def scan_accounts(self, cursor=0, count=1000, match=None):
+        """Returns the next cursor (0 when done) and the account IDs in that batch"""
+        with self._ids_lock:
+            keys = self._ids[cursor:cursor + count]
+            cursor = cursor + count if cursor + count < len(self._ids) else 0
+        if match:
+            keys = [key for key in keys if fnmatchcase(key, match)]
+        return cursor, keys
+
+    def put_many(self, accounts):
+        """Writes (account_id, Account) records as they are, replacing existing accounts"""
+        added = []
+        for account_id, account in accounts:
+            stripe = self._stripe(account_id)
+            with stripe.lock:
+                if account_id not in stripe.accounts:
+                    added.append(account_id)
+                stripe.accounts[account_id] = AccountRecord(account.account_type, self.layout.to_units(account.balance), account.last_accrual)
+        with self._ids_lock:
+            self._ids.extend(added)
+
+    def start_accrual(self, run_id, rates):
+        """Records the rates of an accrual run (kept if the run already exists) and returns its progress"""
+        with self._accruals_lock:
+            progress = self._accruals.setdefault(run_id, {
+                "run_id": run_id, "cursor": 0, "scanned": 0, "credited": 0, "skipped": 0, "done": False,
+                "rates": {account_type: rate for account_type, rate in sorted(rates.items())},
+            })
+            return dict(progress)
+
+    def accrue_chunk(self, run_id, keys, next_cursor, rates):
+        """Credits interest to a chunk of accounts once per run and records the run's progress, returns the number credited
+
+        Each account is credited under its stripe's lock and the progress under
+        the accrual lock, so chunks are not atomic as a whole; accounts already
+        credited by the run are skipped, which makes replaying a chunk harmless.
+        """
+        credited = 0
+        for key in keys:
+            stripe = self._stripe(key)
+            with stripe.lock:
+                record = stripe.accounts.get(key)
+                rate = record and rates.get(record.account_type.lower())
+                if not rate or record.last_accrual == run_id:
+                    continue
+                record.last_accrual = run_id
+                earned = self.layout.interest(record.balance, rate)
+                record.balance += earned
+                self._record(stripe, key, "interest", earned, record.balance, run_id)
+                credited += 1
+
+        with self._accruals_lock:
+            progress = self._accruals[run_id]
+            progress["cursor"] = next_cursor
+            progress["scanned"] += len(keys)
+            progress["credited"] += credited
+            progress["skipped"] += len(keys) - credited
+            progress["done"] = next_cursor == 0
+        return credited
@@ -0,0 +1,188 @@
+"""
+bankRPC - Distributed Banking
+By: Imesh Nimsitha
+2025/02/05
+Metrics.py Prometheus Metrics
+"""
+
+from contextvars import ContextVar
+import asyncio
+import time
+import grpc
+from prometheus_client import Counter, Gauge, Histogram, start_http_server
+
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+RPC_DURATION = Histogram("bankrpc_rpc_duration_seconds", "RPC handling time", ["method"], buckets=LATENCY_BUCKETS)
+RPC_REDIS_DURATION = Histogram("bankrpc_rpc_redis_duration_seconds", "Part of each RPC spent waiting on Redis", ["method"], buckets=LATENCY_BUCKETS)
+RPC_IN_FLIGHT = Gauge("bankrpc_rpc_in_flight", "RPCs being handled", ["method"])
+RPC_COMPLETED = Counter("bankrpc_rpcs", "Completed RPCs by status code", ["method", "code"])
+REDIS_DURATION = Histogram("bankrpc_redis_command_duration_seconds", "Redis command (or pipeline) round trip time", ["command"], buckets=LATENCY_BUCKETS)
+WATCH_RETRIES = Counter("bankrpc_watch_retries", "WATCH conflicts, each one retries the operation or aborts it", ["operation"])
+COMBINED_BATCH = Histogram("bankrpc_write_combiner_batch_size", "Mutations applied per combined account update", buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256, 512))
+GROUP_COMMIT_SIZE = Histogram("bankrpc_group_commit_size", "Mutations per SQLite group commit", buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1000))
+COMMIT_DURATION = Histogram("bankrpc_commit_duration_seconds", "SQLite group commit time, fsync included", buckets=LATENCY_BUCKETS)
+RATE_LIMITED = Counter("bankrpc_rate_limited", "RPCs rejected by the rate limiter", ["scope"])
+REPLICA_READS = Counter("bankrpc_balance_reads", "Balance reads with replica routing by where they were served", ["target"])
+REPLICA_STALENESS = Gauge("bankrpc_replica_staleness_seconds", "Upper bound of how far each Redis replica lags behind", ["replica"])
+ABORTED = Counter("bankrpc_aborted", "Operations given up after MAX_RETRIES WATCH conflicts", ["operation"])
+
+_CODE_NAMES = {code.value[0]: code.name for code in grpc.StatusCode}
+
+_children = {}  # (metric, labels) -> child, labels() takes a lock and validates on every call
+
+def _child(metric, *labels):
+    """Cached metric.labels(*labels)"""
+    key = (metric, labels)
+    child = _children.get(key)
+    if child is None:
+        child = _children[key] = metric.labels(*labels)
+    return child
+
+_redis_time = ContextVar("redis_time", default=None)  # [seconds] spent in Redis by the RPC running in this thread/task
+
+def observe_redis(command, seconds):
+    """Records one Redis command (or pipeline) and adds it to the current RPC's Redis time"""
+    _child(REDIS_DURATION, command).observe(seconds)
+    total = _redis_time.get()
+    if total is not None:
+        total[0] += seconds
+
+def start_metrics_server(port):
+    """Serves the metrics on http://0.0.0.0:port/metrics from a daemon thread"""
+    start_http_server(port)
+    print(f"Metrics on port {port}...")
+
+def _method_name(handler_call_details):
+    """/BankService/GetBalance -> GetBalance"""
+    return handler_call_details.method.rsplit("/", 1)[-1]
+
+def _status_code(context, error):
+    """Name of the status code an RPC finished with"""
+    code = context.code()
+    if code is not None:  # Set by the handler (or context.abort)
+        return code.name if isinstance(code, grpc.StatusCode) else _CODE_NAMES.get(code, "UNKNOWN")
+    if error is None:
+        return "OK"
+    if isinstance(error, (GeneratorExit, asyncio.CancelledError)):  # Client went away mid-stream
+        return "CANCELLED"
+    return "UNKNOWN"
+
+class _RpcTimer:
+    """Per-RPC timings, shared by the sync and asyncio interceptors"""
+
+    __slots__ = ("method", "start", "redis_time")
+
+    def __init__(self, method):
+        """Starts timing an RPC"""
+        self.method = method
+        self.start = time.perf_counter()
+        self.redis_time = [0.0]
+        _child(RPC_IN_FLIGHT, method).inc()
+
+    def finish(self, context, error=None):
+        """Records the finished RPC"""
+        _child(RPC_IN_FLIGHT, self.method).dec()
+        _child(RPC_DURATION, self.method).observe(time.perf_counter() - self.start)
+        _child(RPC_REDIS_DURATION, self.method).observe(self.redis_time[0])
+        _child(RPC_COMPLETED, self.method, _status_code(context, error)).inc()
+
+class MetricsInterceptor(grpc.ServerInterceptor):
+    """Records latency, in-flight count, status codes and Redis time of every RPC"""
+
+    def intercept_service(self, continuation, handler_call_details):
+        handler = continuation(handler_call_details)
+        if handler is None:
+            return None
+        method = _method_name(handler_call_details)
+
+        def unary_response(behavior):
+            def wrapper(request, context):
+                timer = _RpcTimer(method)
+                token = _redis_time.set(timer.redis_time)
+                error = None
+                try:
+                    return behavior(request, context)
+                except BaseException as e:
+                    error = e
+                    raise
+                finally:
+                    _redis_time.reset(token)
+                    timer.finish(context, error)
+            return wrapper
+
+        def stream_response(behavior):
+            def wrapper(request, context):
+                timer = _RpcTimer(method)
+                error = None
+                try:
+                    responses = behavior(request, context)
+                    while True:  # The generator body runs lazily, so time Redis around every step
+                        token = _redis_time.set(timer.redis_time)
+                        try:
+                            response = next(responses)
+                        except StopIteration:
+                            return
+                        finally:
+                            _redis_time.reset(token)
+                        yield response
+                except BaseException as e:
+                    error = e
+                    raise
+                finally:
+                    timer.finish(context, error)
+            return wrapper
+
+        if handler.unary_unary:
+            return handler._replace(unary_unary=unary_response(handler.unary_unary))
+        if handler.stream_unary:
+            return handler._replace(stream_unary=unary_response(handler.stream_unary))
+        if handler.unary_stream:
+            return handler._replace(unary_stream=stream_response(handler.unary_stream))
+        return handler._replace(stream_stream=stream_response(handler.stream_stream))
+
+class AsyncMetricsInterceptor(grpc.aio.ServerInterceptor):
+    """MetricsInterceptor for grpc.aio servers"""
+
+    async def intercept_service(self, continuation, handler_call_details):
+        handler = await continuation(handler_call_details)
+        if handler is None:
+            return None
+        method = _method_name(handler_call_details)
+
+        def unary_response(behavior):
+            async def wrapper(request, context):
+                timer = _RpcTimer(method)
+                _redis_time.set(timer.redis_time)  # Each RPC runs in its own task and context
+                error = None
+                try:
+                    return await behavior(request, context)
+                except BaseException as e:
+                    error = e
+                    raise
+                finally:
+                    timer.finish(context, error)
+            return wrapper
+
+        def stream_response(behavior):
+            async def wrapper(request, context):
+                timer = _RpcTimer(method)
+                _redis_time.set(timer.redis_time)
+                error = None
+                try:
+                    async for response in behavior(request, context):
+                        yield response
+                except BaseException as e:
+                    error = e
+                    raise
+                finally:
+                    timer.finish(context, error)
+            return wrapper
+
+        if handler.unary_unary:
+            return handler._replace(unary_unary=unary_response(handler.unary_unary))
+        if handler.stream_unary:
+            return handler._replace(stream_unary=unary_response(handler.stream_unary))
+        if handler.unary_stream:
+            return handler._replace(unary_stream=stream_response(handler.unary_stream))
+        return handler._replace(stream_stream=stream_response(handler.stream_stream))
@@ -0,0 +1,109 @@
+"""
+bankRPC - Distributed Banking
+By: Imesh Nimsitha
+2025/02/05
+Migrate.py JSON to Hash Storage Migration
+"""
+
+from os import getenv
+from storage import INTERNAL_PREFIX, TRANSFER_KEY
+import scripts
+import argparse
+import redis
+
+CURSOR_KEY = "bankrpc:migrate:cursor"  # SCAN cursor of the last completed batch
+REQUESTS_KEY = scripts.MIGRATE_REQUESTS_PREFIX + "{}"  # An account's request ID keys and transfer records, converted with it
+REQUESTS_TTL = 24 * 3600  # Seconds the groups of accounts converted before (or deleted) are kept
+
+def request_accounts(key, saved):
+    """Accounts a remembered request ID may belong to, from its key and saved fingerprint
+
+    Keys are <prefix><account>:<request ID> and fingerprints <op>:<account>:<value>,
+    or transfer:<from>:<to>:<value> with the source account in the key. Only
+    transfers between IDs with colons can leave more than one candidate.
+    """
+    rest = key[len(scripts.IDEMPOTENCY_PREFIX):]
+    op, _, accounts = saved.rpartition(" ")[0].partition(":")
+    if op != "transfer":
+        account_id = accounts.rpartition(":")[0]
+        return [account_id] if rest.startswith(account_id + ":") else []
+    return [accounts[:i] for i, char in enumerate(accounts) if char == ":" and rest.startswith(accounts[:i + 1])]
+
+def group_requests(client, batch_size=1000):
+    """Lists each account's remembered request IDs and transfer records under REQUESTS_KEY, returns how many
+
+    Their fingerprints, replies and amounts are in the account's units, so
+    the script converting the account converts them too.
+    """
+    grouped = 0
+    for match in (scripts.IDEMPOTENCY_PREFIX + "*", TRANSFER_KEY.format("*")):
+        keys = []
+        for key in client.scan_iter(match=match, count=batch_size):
+            keys.append(key)
+            if len(keys) == batch_size:
+                grouped += _group_batch(client, keys)
+                keys = []
+        grouped += _group_batch(client, keys)
+    return grouped
+
+def _group_batch(client, keys):
+    """Adds a batch of request ID keys or transfer records (grouped by source account) to their account's group"""
+    if not keys:
+        return 0
+    requests = keys[0].startswith(scripts.IDEMPOTENCY_PREFIX.encode())
+    pipe = client.pipeline(transaction=False)
+    for key in keys:
+        if requests:
+            pipe.get(key)
+        else:
+            pipe.hget(key, "from")
+    grouped = 0
+    for key, value in zip(keys, pipe.execute()):
+        if value is None:  # Expired in between
+            continue
+        candidates = request_accounts(key.decode(), value.decode()) if requests else [value.decode()]
+        if len(candidates) > 1:  # The account that exists
+            candidates = [account_id for account_id in candidates if client.exists(account_id)]
+        if len(candidates) == 1:
+            account_id = candidates[0]
+            pipe.sadd(REQUESTS_KEY.format(account_id), key)
+            pipe.expire(REQUESTS_KEY.format(account_id), REQUESTS_TTL)
+            grouped += 1
+    pipe.execute()
+    return grouped
+
+def migrate(client, batch_size=1000, restart=False):
+    """Converts every JSON account to a hash with integer cents, resuming from the saved cursor"""
+    migrate_batch = client.register_script(scripts.MIGRATE_JSON_TO_HASH)
+    if restart:
+        client.delete(CURSOR_KEY)
+
+    cursor = int(client.get(CURSOR_KEY) or 0)
+    if cursor:
+        print(f"Resuming from cursor {cursor}...")
+    print(f"Grouped {group_requests(client, batch_size)} request IDs and transfer records by account...")
+
+    scanned = migrated = 0
+    while True:
+        cursor, keys = client.scan(cursor=cursor, count=batch_size)
+        keys = [key for key in keys if not key.startswith(INTERNAL_PREFIX)]
+        if keys:
+            migrated += migrate_batch(keys=keys)  # Each batch is converted atomically
+        scanned += len(keys)
+
+        if cursor == 0:  # Full pass over the keyspace
+            client.delete(CURSOR_KEY)
+            break
+        client.set(CURSOR_KEY, cursor)  # Only saved once the batch is committed
+        print(f"Scanned {scanned} keys, migrated {migrated} accounts...")
+
+    print(f"Done: scanned {scanned} keys, migrated {migrated} accounts.")
+    return migrated
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Migrate JSON accounts to the hash storage layout")
+    parser.add_argument("--batch-size", type=int, default=1000, help="Keys per SCAN batch")
+    parser.add_argument("--restart", action="store_true", help="Ignore a saved cursor and start over")
+    args = parser.parse_args()
+
+    migrate(redis.Redis(getenv("REDIS_HOST", "localhost"), port=6379, db=0), args.batch_size, args.restart)
@@ -0,0 +1,286 @@
+"""
+bankRPC - Distributed Banking
+By: Imesh Nimsitha
+2025/02/05
+Ratelimit.py Per-Client and Per-Account Rate Limiting
+"""
+
+from metrics import RATE_LIMITED
+from scripts import RATE_LIMIT_PREFIX, TOKEN_BUCKET
+from os import getenv
+import threading
+import time
+import redis
+import grpc
+
+CLIENT_ID_HEADER = "x-client-id"  # Metadata naming the caller, its peer IP is used without it
+RETRY_AFTER_HEADER = "retry-after-ms"  # Trailing metadata of a rejected RPC: when its bucket has a token again
+LOCAL_BUCKETS = 100000  # Buckets kept by a limiter without Redis before full ones are dropped
+
+def client_identity(context):
+    """Rate limited identity of the caller: its x-client-id metadata, or its IP address"""
+    for key, value in context.invocation_metadata() or ():
+        if key == CLIENT_ID_HEADER and value:
+            return value
+    peer = context.peer() or ""  # "ipv4:10.0.0.1:53412", "ipv6:[::1]:53412", "unix:..."
+    kind, _, address = peer.partition(":")
+    if kind in ("ipv4", "ipv6"):
+        return address.rpartition(":")[0]  # Without the port, every connection of a host shares its bucket
+    return peer
+
+def request_account(request):
+    """The account an RPC is about, "" for RPCs over several accounts or streamed requests"""
+    return getattr(request, "account_id", None) or getattr(request, "from_account_id", None) or ""
+
+class RateLimiter:
+    """Token buckets per client and per account, shared through Redis by every server process
+
+    Each bucket refills at rate tokens per second up to burst tokens and an
+    RPC takes one token from its client's bucket and, when it names one,
+    its account's bucket. Both buckets are checked and taken by one Lua
+    script, so processes sharing the Redis node share the limits. Without a
+    Redis client (embedded engines) the buckets live in this process. If
+    Redis fails the call is let through: losing the limiter must not take
+    the bank down with it.
+    """
+
+    def __init__(self, client=None, client_rate=0, client_burst=None, account_rate=0, account_burst=None):
+        """Initialize limits in requests per second (0 disables one), bursts default to one second's worth"""
+        self.redis = client
+        self.limits = {}  # scope -> (rate, burst)
+        if client_rate > 0:
+            self.limits["client"] = (client_rate, max(1, client_burst or client_rate))
+        if account_rate > 0:
+            self.limits["account"] = (account_rate, max(1, account_burst or account_rate))
+        self._script = client.register_script(TOKEN_BUCKET) if client is not None and self.limits else None
+        self._buckets = {}  # key -> [tokens, last refill], without Redis
+        self._lock = threading.Lock()
+
+    def _buckets_for(self, client_id, account_id):
+        """(scope, key, rate, burst) of the buckets an RPC takes a token from"""
+        names = {"client": client_id, "account": account_id}
+        return [(scope, f"{RATE_LIMIT_PREFIX}{scope}:{names[scope]}", rate, burst)
+                for scope, (rate, burst) in self.limits.items() if names[scope]]
+
+    @staticmethod
+    def _script_args(buckets):
+        """KEYS and ARGV of the token bucket script"""
+        args = [int(time.time() * 1000)]  # Server processes are expected to keep their clocks in sync (NTP)
+        for _, _, rate, burst in buckets:
+            args += [rate, burst]
+        return [key for _, key, _, _ in buckets], args
+
+    @staticmethod
+    def _verdict(buckets, reply):
+        """None if allowed, else (scope, seconds until a token is available) from a script reply"""
+        wait, index = int(reply[0]), int(reply[1])
+        if not wait:
+            return None
+        scope = buckets[index - 1][0]
+        RATE_LIMITED.labels(scope).inc()
+        return scope, wait / 1000
+
+    def _take_local(self, buckets):
+        """Same as the script on this process' buckets"""
+        now = time.monotonic()
+        with self._lock:
+            states = []
+            for scope, key, rate, burst in buckets:
+                tokens, last = self._buckets.get(key) or (burst, now)
+                tokens = min(burst, tokens + (now - last) * rate)
+                if tokens < 1:
+                    RATE_LIMITED.labels(scope).inc()
+                    return scope, (1 - tokens) / rate
+                states.append((key, tokens))
+            for key, tokens in states:
+                self._buckets[key] = [tokens - 1, now]
+            if len(self._buckets) > LOCAL_BUCKETS:  # Forget buckets idle long enough to be full again
+                idle = max(burst / rate for rate, burst in self.limits.values())
+                self._buckets = {key: state for key, state in self._buckets.items() if now - state[1] < idle}
+        return None
+
+    def check(self, client_id, account_id=""):
+        """Takes a token for the RPC, returns None if allowed or (scope, retry after seconds) if limited"""
+        buckets = self._buckets_for(client_id, account_id)
+        if not buckets:
+            return None
+        if self._script is None:
+            return self._take_local(buckets)
+        keys, args = self._script_args(buckets)
+        try:
+            return self._verdict(buckets, self._script(keys, args))
+        except redis.RedisError:  # Fail open
+            return None
+
+class AsyncRateLimiter(RateLimiter):
+    """RateLimiter for a redis.asyncio client"""
+
+    async def check(self, client_id, account_id=""):
+        """Takes a token for the RPC, returns None if allowed or (scope, retry after seconds) if limited"""
+        buckets = self._buckets_for(client_id, account_id)
+        if not buckets:
+            return None
+        if self._script is None:
+            return self._take_local(buckets)
+        keys, args = self._script_args(buckets)
+        try:
+            return self._verdict(buckets, await self._script(keys, args))
+        except redis.RedisError:
+            return None
+
+def _rejection(verdict):
+    """Trailing metadata and details of a rate limited RPC"""
+    scope, retry_after = verdict
+    retry_ms = max(1, int(retry_after * 1000))
+    return ((RETRY_AFTER_HEADER, str(retry_ms)),), f"Rate limit exceeded for this {scope}, retry in {retry_ms}ms"
+
+class RateLimitInterceptor(grpc.ServerInterceptor):
+    """Rejects RPCs over their client's or account's rate with RESOURCE_EXHAUSTED before they reach the service"""
+
+    def __init__(self, limiter):
+        """Initialize with a RateLimiter"""
+        self.limiter = limiter
+
+    def intercept_service(self, continuation, handler_call_details):
+        handler = continuation(handler_call_details)
+        if handler is None or not self.limiter.limits:
+            return handler
+
+        def admit(request, context):
+            """Aborts the RPC if it is over a limit"""
+            verdict = self.limiter.check(client_identity(context), request_account(request))
+            if verdict:
+                metadata, details = _rejection(verdict)
+                context.set_trailing_metadata(metadata)
+                context.abort(grpc.StatusCode.RESOURCE_EXHAUSTED, details)
+
+        def unary_response(behavior):
+            def wrapper(request, context):
+                admit(request, context)
+                return behavior(request, context)
+            return wrapper
+
+        def stream_response(behavior):
+            def wrapper(request, context):
+                admit(request, context)
+                yield from behavior(request, context)
+            return wrapper
+
+        if handler.unary_unary:
+            return handler._replace(unary_unary=unary_response(handler.unary_unary))
+        if handler.stream_unary:
+            return handler._replace(stream_unary=unary_response(handler.stream_unary))
+        if handler.unary_stream:
+            return handler._replace(unary_stream=stream_response(handler.unary_stream))
+        return handler._replace(stream_stream=stream_response(handler.stream_stream))
+
+class AdmissionInterceptor(grpc.ServerInterceptor):
+    """Admission control of the threaded server that leaves long-lived streams out
+
+    At most workers RPCs run at once and queue_depth more wait for their
+    turn, the rest fail with RESOURCE_EXHAUSTED right away instead of
+    queueing. RPCs of the exempt methods (WatchBalance) are bounded by the
+    service instead, so open streams take neither a turn nor a queue slot.
+    """
+
+    def __init__(self, workers, queue_depth, exempt=()):
+        """Initialize with the running and waiting RPC limits and the full names of exempt methods"""
+        self.exempt = frozenset(exempt)
+        self._admitted = threading.BoundedSemaphore(workers + queue_depth)
+        self._running = threading.BoundedSemaphore(workers)
+
+    def intercept_service(self, continuation, handler_call_details):
+        handler = continuation(handler_call_details)
+        if handler is None or handler_call_details.method in self.exempt:
+            return handler
+
+        def admit(context):
+            """Aborts the RPC if every slot is taken, or waits for its turn"""
+            if not self._admitted.acquire(blocking=False):
+                context.abort(grpc.StatusCode.RESOURCE_EXHAUSTED, "Server is at capacity, try again later")
+            self._running.acquire()
+
+        def release():
+            self._running.release()
+            self._admitted.release()
+
+        def unary_response(behavior):
+            def wrapper(request, context):
+                admit(context)
+                try:
+                    return behavior(request, context)
+                finally:
+                    release()
+            return wrapper
+
+        def stream_response(behavior):
+            def wrapper(request, context):
+                admit(context)
+                try:
+                    yield from behavior(request, context)
+                finally:
+                    release()
+            return wrapper
+
+        if handler.unary_unary:
+            return handler._replace(unary_unary=unary_response(handler.unary_unary))
+        if handler.stream_unary:
+            return handler._replace(stream_unary=unary_response(handler.stream_unary))
+        if handler.unary_stream:
+            return handler._replace(unary_stream=stream_response(handler.unary_stream))
+        return handler._replace(stream_stream=stream_response(handler.stream_stream))
+
+class AsyncRateLimitInterceptor(grpc.aio.ServerInterceptor):
+    """RateLimitInterceptor for grpc.aio servers, with an AsyncRateLimiter"""
+
+    def __init__(self, limiter):
+        """Initialize with an AsyncRateLimiter"""
+        self.limiter = limiter
+
+    async def intercept_service(self, continuation, handler_call_details):
+        handler = await continuation(handler_call_details)
+        if handler is None or not self.limiter.limits:
+            return handler
+
+        async def admit(request, context):
+            """Aborts the RPC if it is over a limit"""
+            verdict = await self.limiter.check(client_identity(context), request_account(request))
+            if verdict:
+                metadata, details = _rejection(verdict)
+                context.set_trailing_metadata(metadata)
+                await context.abort(grpc.StatusCode.RESOURCE_EXHAUSTED, details)
+
+        def unary_response(behavior):
+            async def wrapper(request, context):
+                await admit(request, context)
+                return await behavior(request, context)
+            return wrapper
+
+        def stream_response(behavior):
+            async def wrapper(request, context):
+                await admit(request, context)
+                async for response in behavior(request, context):
+                    yield response
+            return wrapper
+
+        if handler.unary_unary:
+            return handler._replace(unary_unary=unary_response(handler.unary_unary))
+        if handler.stream_unary:
+            return handler._replace(stream_unary=unary_response(handler.stream_unary))
+        if handler.unary_stream:
+            return handler._replace(unary_stream=stream_response(handler.unary_stream))
+        return handler._replace(stream_stream=stream_response(handler.stream_stream))
+
+def add_rate_limit_arguments(parser):
+    """Adds the --client-rate/--account-rate options, see rate_limit_options()"""
+    parser.add_argument("--client-rate", type=float, default=float(getenv("CLIENT_RATE_LIMIT", 0)),
+                        help="Requests per second per client (x-client-id metadata or IP), 0 disables the limit")
+    parser.add_argument("--client-burst", type=int, default=int(getenv("CLIENT_BURST", 0)), help="Client bucket size (default: one second's worth)")
+    parser.add_argument("--account-rate", type=float, default=float(getenv("ACCOUNT_RATE_LIMIT", 0)),
+                        help="Requests per second per account, 0 disables the limit")
+    parser.add_argument("--account-burst", type=int, default=int(getenv("ACCOUNT_BURST", 0)), help="Account bucket size (default: one second's worth)")
+
+def rate_limit_options(args):
+    """RateLimiter arguments from parsed add_rate_limit_arguments() options"""
+    return {"client_rate": args.client_rate, "client_burst": args.client_burst,
+            "account_rate": args.account_rate, "account_burst": args.account_burst}
@@ -0,0 +1,132 @@
+"""
+bankRPC - Distributed Banking
+By: Imesh Nimsitha
+2025/02/05
+Rebalance.py Online Shard Rebalancing
+"""
+
+from redis_pool import add_redis_arguments, create_client, parse_addresses, redis_options
+from sharding import HashRing, move_key
+from storage import INTERNAL_PREFIX, LEDGER_KEY, TRANSFER_DECISION_KEY, TRANSFER_KEY
+import scripts
+import argparse
+
+REQUEST_PREFIX = scripts.IDEMPOTENCY_PREFIX.encode()  # Request ID keys: <prefix><account>:<request ID>
+TRANSFER_PREFIX = TRANSFER_KEY.format("").encode()  # Transfer records, on their source account's node
+
+def request_owner(ring, key):
+    """Node owning a request ID key, None if its account cannot be told apart
+
+    Account and request IDs may both contain colons, so every split is
+    tried and the key is only routed when they all lead to one node. Servers
+    still pull the others on use while they run with the previous node list.
+    """
+    rest = key[len(REQUEST_PREFIX):].decode()
+    nodes = {ring.node_for(rest[:i]) for i, char in enumerate(rest) if char == ":"}
+    return nodes.pop() if len(nodes) == 1 else None
+
+def bookkeeping_owners(source, ring, keys):
+    """Yields (key, owner node, destination account or None) for the request ID keys and transfer records among keys
+
+    Request IDs belong to their account, transfer records to their source
+    account; the destination account of a transfer owns its decision.
+    """
+    transfers = [key for key in keys if key.startswith(TRANSFER_PREFIX)]
+    pipe = source.pipeline(transaction=False)
+    for key in transfers:
+        pipe.hmget(key, "from", "to")
+    for key, (from_account_id, to_account_id) in zip(transfers, pipe.execute()):
+        if from_account_id is not None:  # Expired in between
+            yield key, ring.node_for(from_account_id), to_account_id
+    for key in keys:
+        if key.startswith(REQUEST_PREFIX):
+            owner = request_owner(ring, key)
+            if owner is not None:
+                yield key, owner, None
+
+def move_batch(source, target, keys, bookkeeping=()):
+    """Moves accounts and their ledgers from one node to another with pipelined DUMP/RESTORE, then deletes them from the source
+
+    Keys are only deleted once restored (or found already restored by a
+    server that pulled them first), so accounts are never lost or duplicated.
+    bookkeeping holds request ID keys and transfer records of accounts owned
+    by the target, moved first with their remaining TTLs. The accounts'
+    secondary index entries are rebuilt from the restored records on the
+    target and dropped with them on the source.
+    Returns the number of accounts moved.
+    """
+    keys = list(bookkeeping) + [moved for key in keys for moved in (LEDGER_KEY.format(key.decode()).encode(), key)]  # Ledger before its account, as servers do
+    pipe = source.pipeline(transaction=False)
+    for key in keys:
+        pipe.dump(key)
+        pipe.pttl(key)
+    replies = pipe.execute()
+    present = [(key, data, ttl) for key, data, ttl in zip(keys, replies[::2], replies[1::2]) if data is not None and ttl != -2]
+    if not present:
+        return 0
+
+    pipe = target.pipeline(transaction=False)
+    for key, data, ttl in present:
+        pipe.restore(key, max(ttl, 0), data)
+    for reply in pipe.execute(raise_on_error=False):
+        if isinstance(reply, Exception) and "BUSYKEY" not in str(reply):  # BUSYKEY: already moved
+            raise reply
+    target.register_script(scripts.INDEX_SCRIPTS["index_accounts"])(keys=[key for key, _, _ in present if not key.startswith(INTERNAL_PREFIX)])
+    source.register_script(scripts.INDEX_SCRIPTS["drop_accounts"])(keys=[key for key, _, _ in present])
+    return sum(1 for key, _, _ in present if not key.startswith(INTERNAL_PREFIX))
+
+def rebalance(previous_clients, clients, batch_size=1000, dry_run=False):
+    """Moves every account whose owner changed from the previous node list to the new one
+
+    Both arguments map node addresses to clients. Servers should already run
+    with the new list as --redis-shards and the old one as --redis-shards-previous.
+    Request IDs and transfer records move to their account's new owner, and
+    a transfer's decision to its destination account's new owner.
+    """
+    ring = HashRing(clients)
+    previous_ring = HashRing(previous_clients)
+    moved = 0
+    for node, source in previous_clients.items():
+        cursor = scanned = node_moved = 0
+        while True:
+            cursor, keys = source.scan(cursor=cursor, count=batch_size)
+            accounts = [key for key in keys if not key.startswith(INTERNAL_PREFIX)]  # Ledgers move with their accounts
+            scanned += len(accounts)
+
+            targets = {}  # Node -> (accounts, bookkeeping keys)
+            for key in accounts:
+                target = ring.node_for(key)
+                if target != node:
+                    targets.setdefault(target, ([], []))[0].append(key)
+            for key, target, to_account_id in bookkeeping_owners(source, ring, keys):
+                if target != node:
+                    targets.setdefault(target, ([], []))[1].append(key)
+                if to_account_id is not None and not dry_run:
+                    decision_owner, previous_owner = ring.node_for(to_account_id), previous_ring.node_for(to_account_id)
+                    if decision_owner != previous_owner:
+                        decision = TRANSFER_DECISION_KEY.format(key[len(TRANSFER_PREFIX):].decode())
+                        move_key(previous_clients[previous_owner], clients[decision_owner], decision)
+            for target, (target_keys, bookkeeping) in targets.items():
+                node_moved += len(target_keys) if dry_run else move_batch(source, clients[target], target_keys, bookkeeping)
+
+            if cursor == 0:  # Full pass over the node
+                break
+        print(f"{node}: scanned {scanned} keys, {'would move' if dry_run else 'moved'} {node_moved} accounts...")
+        moved += node_moved
+    return moved
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Move accounts to their owners after Redis nodes were added or removed")
+    parser.add_argument("--from", dest="previous", required=True, help="Node list before the change (host:port,host:port...)")
+    parser.add_argument("--to", dest="nodes", required=True, help="Node list after the change")
+    parser.add_argument("--batch-size", type=int, default=1000, help="Keys per SCAN batch")
+    parser.add_argument("--dry-run", action="store_true", help="Only count the accounts that would move")
+    add_redis_arguments(parser)
+    args = parser.parse_args()
+
+    options = redis_options(args)
+    clients = {address: create_client(options, address=address) for address in parse_addresses(args.nodes)}
+    previous_clients = {address: clients.get(address) or create_client(options, address=address) for address in parse_addresses(args.previous)}
+
+    moved = rebalance(previous_clients, clients, args.batch_size, args.dry_run)
+    print(f"Done: {'would move' if args.dry_run else 'moved'} {moved} accounts.")
@@ -0,0 +1,295 @@
+"""
+bankRPC - Distributed Banking
+By: Imesh Nimsitha
+2025/02/05
+Redis_pool.py Redis Connection Pool Configuration
+"""
+
+from contextvars import ContextVar
+from os import getenv
+from metrics import observe_redis
+import redis.asyncio.client
+import redis.asyncio
+import redis.client
+import redis
+import time
+import grpc
+
+ROUND_TRIPS_HEADER = "x-redis-round-trips"  # Trailing metadata with the Redis round trips of an RPC
+
+_round_trips = ContextVar("round_trips", default=None)  # [count] for the RPC running in this thread/task
+
+def count_round_trip():
+    """Counts one request/response exchange with Redis for the current RPC"""
+    counter = _round_trips.get()
+    if counter is not None:
+        counter[0] += 1
+
+class CountingConnection(redis.Connection):
+    """TCP connection that counts round trips (a pipeline is sent as one packed command)"""
+
+    def send_packed_command(self, command, check_health=True):
+        count_round_trip()
+        super().send_packed_command(command, check_health)
+
+class CountingUnixConnection(redis.UnixDomainSocketConnection):
+    """Unix socket connection that counts round trips"""
+
+    def send_packed_command(self, command, check_health=True):
+        count_round_trip()
+        super().send_packed_command(command, check_health)
+
+class AsyncCountingConnection(redis.asyncio.Connection):
+    """redis.asyncio TCP connection that counts round trips"""
+
+    async def send_packed_command(self, command, check_health=True):
+        count_round_trip()
+        await super().send_packed_command(command, check_health)
+
+class AsyncCountingUnixConnection(redis.asyncio.UnixDomainSocketConnection):
+    """redis.asyncio unix socket connection that counts round trips"""
+
+    async def send_packed_command(self, command, check_health=True):
+        count_round_trip()
+        await super().send_packed_command(command, check_health)
+
+def _command_name(args):
+    """Metric label of a command: GET, EVALSHA, HMGET..."""
+    name = args[0]
+    return name.decode() if isinstance(name, bytes) else str(name).upper()
+
+class InstrumentedPipeline(redis.client.Pipeline):
+    """Pipeline that times WATCHed reads and the pipeline round trip (EXEC or PIPELINE)"""
+
+    def immediate_execute_command(self, *args, **options):
+        start = time.perf_counter()
+        try:
+            return super().immediate_execute_command(*args, **options)
+        finally:
+            observe_redis(_command_name(args), time.perf_counter() - start)
+
+    def execute(self, raise_on_error=True):
+        start = time.perf_counter()
+        try:
+            return super().execute(raise_on_error)
+        finally:
+            observe_redis("EXEC" if self.transaction else "PIPELINE", time.perf_counter() - start)
+
+class InstrumentedRedis(redis.Redis):
+    """Client that times every command for the metrics"""
+
+    def execute_command(self, *args, **options):
+        start = time.perf_counter()
+        try:
+            return super().execute_command(*args, **options)
+        finally:
+            observe_redis(_command_name(args), time.perf_counter() - start)
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        return InstrumentedPipeline(self.connection_pool, self.response_callbacks, transaction, shard_hint)
+
+class AsyncInstrumentedPipeline(redis.asyncio.client.Pipeline):
+    """redis.asyncio pipeline that times its round trip"""
+
+    async def immediate_execute_command(self, *args, **options):
+        start = time.perf_counter()
+        try:
+            return await super().immediate_execute_command(*args, **options)
+        finally:
+            observe_redis(_command_name(args), time.perf_counter() - start)
+
+    async def execute(self, raise_on_error=True):
+        start = time.perf_counter()
+        try:
+            return await super().execute(raise_on_error)
+        finally:
+            observe_redis("EXEC" if self.is_transaction else "PIPELINE", time.perf_counter() - start)
+
+class AsyncInstrumentedRedis(redis.asyncio.Redis):
+    """redis.asyncio client that times every command for the metrics"""
+
+    async def execute_command(self, *args, **options):
+        start = time.perf_counter()
+        try:
+            return await super().execute_command(*args, **options)
+        finally:
+            observe_redis(_command_name(args), time.perf_counter() - start)
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        return AsyncInstrumentedPipeline(self.connection_pool, self.response_callbacks, transaction, shard_hint)
+
+def add_redis_arguments(parser):
+    """Adds Redis connection pool flags to an argparse parser (defaults come from the environment)"""
+    parser.add_argument("--redis-connections", type=int, default=int(getenv("REDIS_CONNECTIONS", 64)), help="Redis connection pool size")
+    parser.add_argument("--redis-unix-socket", default=getenv("REDIS_UNIX_SOCKET"), help="Connect to Redis over this unix socket instead of TCP")
+    parser.add_argument("--redis-socket-timeout", type=float, default=float(getenv("REDIS_SOCKET_TIMEOUT", 5)), help="Seconds to wait for a Redis reply")
+    parser.add_argument("--redis-connect-timeout", type=float, default=float(getenv("REDIS_CONNECT_TIMEOUT", 2)), help="Seconds to wait for a new Redis connection")
+    parser.add_argument("--redis-pool-timeout", type=float, default=float(getenv("REDIS_POOL_TIMEOUT", 5)), help="Seconds to wait for a free pooled connection")
+    parser.add_argument("--redis-keepalive", type=int, choices=(0, 1), default=int(getenv("REDIS_KEEPALIVE", 1)), help="Enable TCP keepalive on Redis connections")
+    parser.add_argument("--redis-shards", default=getenv("REDIS_SHARDS"), help="host:port,host:port... to shard accounts across several Redis nodes")
+    parser.add_argument("--redis-shards-previous", default=getenv("REDIS_SHARDS_PREVIOUS"), help="Node list before a running rebalance")
+    parser.add_argument("--redis-replicas", default=getenv("REDIS_REPLICAS"), help="host:port,host:port... replicas of the primary serving balance reads")
+
+def redis_options(args=None):
+    """Returns pool options from parsed add_redis_arguments flags, or from the environment"""
+    if args is None:
+        import argparse
+        parser = argparse.ArgumentParser()
+        add_redis_arguments(parser)
+        args = parser.parse_args([])
+    return {
+        "max_connections": args.redis_connections,
+        "unix_socket": args.redis_unix_socket,
+        "socket_timeout": args.redis_socket_timeout,
+        "connect_timeout": args.redis_connect_timeout,
+        "pool_timeout": args.redis_pool_timeout,
+        "keepalive": bool(args.redis_keepalive),
+        "shards": args.redis_shards,
+        "previous_shards": args.redis_shards_previous,
+        "replicas": args.redis_replicas,
+    }
+
+def _pool_kwargs(options, unix_class, tcp_class, address=None):
+    """Builds connection pool arguments for the configured transport, or for one shard's host:port"""
+    kwargs = {
+        "db": 0,
+        "max_connections": options["max_connections"],
+        "timeout": options["pool_timeout"],  # BlockingConnectionPool waits this long for a free connection
+        "socket_timeout": options["socket_timeout"],
+        "socket_connect_timeout": options["connect_timeout"],
+    }
+    if address:
+        host, _, port = address.rpartition(":")
+        kwargs.update(connection_class=tcp_class, host=host, port=int(port), socket_keepalive=options["keepalive"])
+    elif options["unix_socket"]:
+        kwargs.update(connection_class=unix_class, path=options["unix_socket"])
+    else:
+        kwargs.update(connection_class=tcp_class, host=getenv("REDIS_HOST", "localhost"), port=int(getenv("REDIS_PORT", 6379)),
+                      socket_keepalive=options["keepalive"])
+    return kwargs
+
+def create_client(options=None, instrumented=True, address=None):
+    """Creates a Redis client on a blocking, bounded connection pool, timing commands for the metrics"""
+    options = options or redis_options()
+    pool = redis.BlockingConnectionPool(**_pool_kwargs(options, CountingUnixConnection, CountingConnection, address))
+    return (InstrumentedRedis if instrumented else redis.Redis)(connection_pool=pool)
+
+def create_async_client(options=None, instrumented=True, address=None):
+    """Creates a redis.asyncio client on a blocking, bounded connection pool, timing commands for the metrics"""
+    options = options or redis_options()
+    pool = redis.asyncio.BlockingConnectionPool(**_pool_kwargs(options, AsyncCountingUnixConnection, AsyncCountingConnection, address))
+    return (AsyncInstrumentedRedis if instrumented else redis.asyncio.Redis)(connection_pool=pool)
+
+def parse_addresses(value):
+    """Parses "host:port,host:port" into a list of node addresses"""
+    return [address.strip() for address in (value or "").split(",") if address.strip()]
+
+def _shard_clients(options, create):
+    """{address: client} for the shards and for the node list before a rebalance, (None, None) if not sharded"""
+    shards = parse_addresses(options.get("shards"))
+    if not shards:
+        return None, None
+    clients = {address: create(options, address=address) for address in shards}  # One pool per shard
+    previous = parse_addresses(options.get("previous_shards"))
+    previous_clients = {address: clients.get(address) or create(options, address=address) for address in previous}
+    return clients, previous_clients or None
+
+def create_shard_clients(options=None):
+    """Redis clients per shard (and per previous shard while rebalancing), (None, None) if not sharded"""
+    return _shard_clients(options or redis_options(), create_client)
+
+def create_replica_clients(options=None):
+    """Redis clients per replica address, None if no replicas are configured"""
+    options = options or redis_options()
+    replicas = parse_addresses(options.get("replicas"))
+    return {address: create_client(options, address=address) for address in replicas} or None
+
+def create_async_shard_clients(options=None):
+    """redis.asyncio clients per shard, see create_shard_clients()"""
+    return _shard_clients(options or redis_options(), create_async_client)
+
+def _trailing_metadata(counter):
+    """Round trip count as trailing metadata"""
+    return ((ROUND_TRIPS_HEADER, str(counter[0])),)
+
+class RoundTripInterceptor(grpc.ServerInterceptor):
+    """Counts the Redis round trips of every RPC and returns them as trailing metadata"""
+
+    def intercept_service(self, continuation, handler_call_details):
+        handler = continuation(handler_call_details)
+        if handler is None:
+            return None
+
+        def unary_response(behavior):
+            def wrapper(request, context):
+                counter = [0]
+                token = _round_trips.set(counter)
+                try:
+                    return behavior(request, context)
+                finally:
+                    _round_trips.reset(token)
+                    context.set_trailing_metadata(_trailing_metadata(counter))
+            return wrapper
+
+        def stream_response(behavior):
+            def wrapper(request, context):
+                counter = [0]
+                try:
+                    responses = behavior(request, context)
+                    while True:  # The generator body runs lazily, so count around every step
+                        token = _round_trips.set(counter)
+                        try:
+                            response = next(responses)
+                        except StopIteration:
+                            return
+                        finally:
+                            _round_trips.reset(token)
+                        yield response
+                finally:
+                    context.set_trailing_metadata(_trailing_metadata(counter))
+            return wrapper
+
+        if handler.unary_unary:
+            return handler._replace(unary_unary=unary_response(handler.unary_unary))
+        if handler.stream_unary:
+            return handler._replace(stream_unary=unary_response(handler.stream_unary))
+        if handler.unary_stream:
+            return handler._replace(unary_stream=stream_response(handler.unary_stream))
+        return handler._replace(stream_stream=stream_response(handler.stream_stream))
+
+class AsyncRoundTripInterceptor(grpc.aio.ServerInterceptor):
+    """RoundTripInterceptor for grpc.aio servers"""
+
+    async def intercept_service(self, continuation, handler_call_details):
+        handler = await continuation(handler_call_details)
+        if handler is None:
+            return None
+
+        def unary_response(behavior):
+            async def wrapper(request, context):
+                counter = [0]
+                _round_trips.set(counter)  # Each RPC runs in its own task and context
+                try:
+                    return await behavior(request, context)
+                finally:
+                    context.set_trailing_metadata(_trailing_metadata(counter))
+            return wrapper
+
+        def stream_response(behavior):
+            async def wrapper(request, context):
+                counter = [0]
+                _round_trips.set(counter)
+                try:
+                    async for response in behavior(request, context):
+                        yield response
+                finally:
+                    context.set_trailing_metadata(_trailing_metadata(counter))
+            return wrapper
+
+        if handler.unary_unary:
+            return handler._replace(unary_unary=unary_response(handler.unary_unary))
+        if handler.stream_unary:
+            return handler._replace(stream_unary=unary_response(handler.stream_unary))
+        if handler.unary_stream:
+            return handler._replace(unary_stream=stream_response(handler.unary_stream))
+        return handler._replace(stream_stream=stream_response(handler.stream_stream))
@@ -0,0 +1,62 @@
+"""
+bankRPC - Distributed Banking
+By: Imesh Nimsitha
+2025/02/05
+Reindex.py Secondary Index Rebuild
+"""
+
+from redis_pool import add_redis_arguments, create_client, create_shard_clients, redis_options
+from storage import BALANCE_INDEX_KEY, INTERNAL_PREFIX, TYPE_INDEX_KEY
+import scripts
+import argparse
+
+def rebuild(client, batch_size=1000):
+    """Rebuilds the secondary indexes of every account on one node, returns the accounts indexed and stale entries removed
+
+    Accounts are found with SCAN and indexed from their records one batch
+    per script call, so servers can keep running: a write racing the tool
+    updates the same entries from the newer record. Then every index is
+    walked once more and entries of keys that are no longer accounts of
+    that type are removed.
+    """
+    index_batch = client.register_script(scripts.INDEX_SCRIPTS["index_accounts"])
+    prune_batch = client.register_script(scripts.INDEX_SCRIPTS["prune_index"])
+    cursor = indexed = 0
+    while True:
+        cursor, keys = client.scan(cursor=cursor, count=batch_size)
+        keys = [key for key in keys if not key.startswith(INTERNAL_PREFIX)]
+        if keys:
+            indexed += index_batch(keys=keys)  # Each batch is indexed atomically
+        if cursor == 0:  # Full pass over the node
+            break
+
+    pruned = 0
+    type_indexes = [(key, key[len(TYPE_INDEX_KEY.format("")):]) for key in client.scan_iter(match=TYPE_INDEX_KEY.format("*"), count=batch_size)]
+    for key, account_type in [(BALANCE_INDEX_KEY.encode(), b""), *type_indexes]:
+        cursor = 0
+        while True:
+            if account_type:
+                cursor, members = client.sscan(key, cursor, count=batch_size)
+            else:
+                cursor, entries = client.zscan(key, cursor, count=batch_size)
+                members = [member for member, _ in entries]
+            if members:
+                pruned += prune_batch(keys=[key], args=[account_type, *members])
+            if cursor == 0:
+                break
+    return indexed, pruned
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Build the account type and balance indexes of existing accounts, and drop stale entries")
+    parser.add_argument("--batch-size", type=int, default=1000, help="Keys per SCAN batch")
+    add_redis_arguments(parser)  # Every shard is rebuilt with --redis-shards
+    args = parser.parse_args()
+
+    options = redis_options(args)
+    shard_clients, _ = create_shard_clients(options)
+    clients = shard_clients or {"redis": create_client(options)}
+
+    for node, client in clients.items():
+        indexed, pruned = rebuild(client, args.batch_size)
+        print(f"{node}: indexed {indexed} accounts, removed {pruned} stale entries...")
+    print("Done.")
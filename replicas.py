@@ -0,0 +1,95 @@
+"""
+bankRPC - Distributed Banking
+By: Imesh Nimsitha
+2025/02/05
+Replicas.py Replica Read Routing
+"""
+
+from metrics import REPLICA_READS, REPLICA_STALENESS
+import itertools
+import threading
+import time
+import uuid
+import redis
+
+HEARTBEAT_KEY = "bankrpc:heartbeat:{}"  # Each server process' heartbeat, written to the primary and read back from replicas
+CHECK_INTERVAL = 0.1  # Seconds between heartbeats, staleness is known to about this precision
+MAX_STALENESS = 1.0  # Seconds a replica may lag behind when the request does not say
+
+class ReplicaRouter:
+    """Routes balance reads to Redis replicas that are fresh enough, or to the primary
+
+    A background thread writes this process' clock to a heartbeat key on the
+    primary every check_interval seconds and reads it back from each replica.
+    A replica holding heartbeat t has applied every write the primary made
+    before t, so now - t bounds how stale its data is. Reads go round-robin
+    to the replicas within the request's bound (max_staleness seconds, 0 for
+    the primary). A replica that is down, lagging or whose replication link
+    is broken stops advancing and falls out of rotation on its own, and a
+    replica failing a read is skipped until the next check sees it again.
+    """
+
+    def __init__(self, primary, replicas, max_staleness=MAX_STALENESS, check_interval=CHECK_INTERVAL):
+        """Initialize on the primary's client and {address: client} replicas, starts the health checks"""
+        self.primary = primary
+        self.addresses = list(replicas)
+        self.replicas = list(replicas.values())
+        self.max_staleness = max_staleness
+        self.check_interval = check_interval
+        self._fresh_as_of = [0.0] * len(self.replicas)  # Heartbeat last seen on each replica, 0 while unknown or down
+        self._key = HEARTBEAT_KEY.format(uuid.uuid4().hex)
+        self._next = itertools.count()
+        self._stopped = threading.Event()
+        threading.Thread(target=self._check_loop, name="replica-health", daemon=True).start()
+
+    def _check(self):
+        """Writes a heartbeat to the primary, then reads the latest one each replica has"""
+        beat = time.time()
+        try:
+            self.primary.set(self._key, repr(beat), px=int(self.check_interval * 1000 * 50))  # Gone soon after this process
+        except redis.RedisError:
+            pass  # Replicas keep the last heartbeat, their staleness grows until the primary is back
+        for index, replica in enumerate(self.replicas):
+            try:
+                seen = replica.get(self._key)
+                self._fresh_as_of[index] = float(seen) if seen else 0.0
+            except redis.RedisError:
+                self._fresh_as_of[index] = 0.0
+            REPLICA_STALENESS.labels(self.addresses[index]).set(self.staleness(index))
+
+    def _check_loop(self):
+        """Background loop of health checks until close()"""
+        while not self._stopped.wait(self.check_interval):
+            self._check()
+
+    def staleness(self, index):
+        """Upper bound in seconds of how far a replica lags behind the primary, inf if unknown"""
+        fresh_as_of = self._fresh_as_of[index]
+        return time.time() - fresh_as_of if fresh_as_of else float("inf")
+
+    def pick(self, max_staleness=None):
+        """Index and client of the next replica within max_staleness seconds (default: the router's), or (None, primary)"""
+        bound = self.max_staleness if max_staleness is None else max_staleness
+        if bound > 0:
+            fresh = [index for index in range(len(self.replicas)) if self.staleness(index) <= bound]
+            if fresh:
+                index = fresh[next(self._next) % len(fresh)]
+                return index, self.replicas[index]
+        return None, self.primary
+
+    def read(self, read, max_staleness=None):
+        """Runs read(client) on a replica fresh enough for max_staleness, or on the primary if none is or it fails"""
+        index, client = self.pick(max_staleness)
+        if index is not None:
+            try:
+                result = read(client)
+                REPLICA_READS.labels("replica").inc()
+                return result
+            except redis.RedisError:
+                self._fresh_as_of[index] = 0.0  # Out of rotation until the next check
+        REPLICA_READS.labels("primary").inc()
+        return read(self.primary)
+
+    def close(self):
+        """Stops the health checks"""
+        self._stopped.set()
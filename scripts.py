@@ -0,0 +1,509 @@
+"""
+bankRPC - Distributed Banking
+By: Imesh Nimsitha
+2025/02/05
+Scripts.py Redis Lua Scripts
+"""
+
+# Every script validates and applies one operation inside Redis, so the whole
+# operation is a single atomic round trip (no WATCH/MULTI retry loop).
+# Scripts reply with a status string, followed by the new balance on success.
+# Balances are returned as strings since Redis truncates Lua numbers to integers.
+
+INDEX_PREFIX = "bankrpc:index:"  # Secondary indexes of the accounts on a node
+TYPE_INDEX_PREFIX = INDEX_PREFIX + "type:"  # One set of account IDs per account type
+BALANCE_INDEX_KEY = INDEX_PREFIX + "balance"  # Sorted set of account IDs scored by balance, in layout units
+
+# index_account() and index_balance() keep the secondary indexes in step with the
+# account records: the layouts' create() and credit() call them, so every script
+# that creates an account or changes a balance updates its indexes atomically.
+# Index keys live on the account's node, like its ledger.
+INDEX_PRELUDE = """
+local function index_account(key, account_type, balance)
+  redis.call('SADD', '%s' .. account_type, key)
+  redis.call('ZADD', '%s', balance, key)
+end
+local function index_balance(key, balance)
+  redis.call('ZADD', '%s', balance, key)
+end
+""" % (TYPE_INDEX_PREFIX, BALANCE_INDEX_KEY, BALANCE_INDEX_KEY)
+
+# Each storage layout provides the same helpers (KIND, load, create, mark, credit, interest, fmt)
+# so the operation bodies below are shared between layouts.
+JSON_PRELUDE = """
+local KIND = 'string'
+local function load(key)
+  local raw = redis.call('GET', key)
+  if not raw then return nil end
+  return cjson.decode(raw)
+end
+local function fmt(balance)  -- Shortest form that reads back as the same double, as Python's repr
+  for _, format in ipairs({'%.15g', '%.16g'}) do
+    local text = string.format(format, balance)
+    if tonumber(text) == balance then return text end
+  end
+  return string.format('%.17g', balance)
+end
+local function encode(account)  -- By hand: cjson.encode keeps 14 significant digits, large balances would lose cents
+  local fields = {'"account_type":' .. cjson.encode(account.account_type), '"balance":' .. fmt(account.balance)}
+  if type(account.last_accrual) == 'string' then table.insert(fields, '"last_accrual":' .. cjson.encode(account.last_accrual)) end
+  return '{' .. table.concat(fields, ',') .. '}'
+end
+local function create(key, account_type)
+  redis.call('SET', key, encode({account_type = account_type, balance = 0}))
+  index_account(key, account_type, 0)
+end
+local function mark(key, account, run_id)
+  account.last_accrual = run_id  -- Saved by the credit that follows
+end
+local function credit(key, account, delta)
+  account.balance = account.balance + delta
+  redis.call('SET', key, encode(account))
+  index_balance(key, account.balance)
+  return account.balance
+end
+local function interest(balance, rate)
+  return balance * (rate / 100)
+end
+"""
+
+# Hash layout: balance is an integer number of cents, updated in place with HINCRBY
+HASH_PRELUDE = """
+local KIND = 'hash'
+local function load(key)
+  local fields = redis.call('HMGET', key, 'account_type', 'balance', 'last_accrual')
+  if not fields[2] then return nil end
+  return {account_type = fields[1], balance = tonumber(fields[2]), last_accrual = fields[3]}
+end
+local function create(key, account_type)
+  redis.call('HSET', key, 'account_type', account_type, 'balance', 0)
+  index_account(key, account_type, 0)
+end
+local function mark(key, account, run_id)
+  account.last_accrual = run_id
+  redis.call('HSET', key, 'last_accrual', run_id)
+end
+local function credit(key, account, delta)
+  account.balance = redis.call('HINCRBY', key, 'balance', delta)
+  index_balance(key, account.balance)
+  return account.balance
+end
+local function interest(balance, rate)
+  return math.floor(balance * rate / 100 + 0.5)
+end
+local function fmt(balance)
+  return string.format('%d', balance)
+end
+"""
+
+PRELUDES = {
+    "json": JSON_PRELUDE,
+    "hash": HASH_PRELUDE,
+}
+
+LEDGER_PREFIX = "bankrpc:ledger:"  # Each account's transaction history is a stream under this prefix
+
+# record() appends a balance change to the account's ledger stream, in the same script
+# as the change itself. The stream lives on the same node as the account (its key is
+# derived here rather than passed in KEYS, which only a Redis Cluster would need).
+# Amounts and balances are in balance units; ref is the other account or the accrual run.
+LEDGER_PRELUDE = """
+local function record(key, op, amount, balance, ref)
+  redis.call('XADD', '%s' .. key, %s'*', 'op', op, 'amount', fmt(amount), 'balance', fmt(balance), 'ref', ref or '')
+end
+"""
+
+NO_LEDGER_PRELUDE = """
+local function record(key, op, amount, balance, ref) end
+"""
+
+IDEMPOTENCY_PREFIX = "bankrpc:idempotency:"  # Outcome of a mutation by account and request ID
+
+# replay() returns the saved reply of a request ID already applied to the account, or
+# REQUEST_ID_REUSED if it was used for a different operation; remember() saves the reply
+# in the same script as the change. Entries are strings with a TTL on the account's node,
+# holding the operation's fingerprint and the balance it replied with.
+IDEMPOTENCY_PRELUDE = """
+local IDEMPOTENCY_TTL = %d
+local function replay(key, request_id, fingerprint)
+  if not request_id or request_id == '' then return nil end
+  local saved = redis.call('GET', '%s' .. key .. ':' .. request_id)
+  if not saved then return nil end
+  local saved_fingerprint, balance = string.match(saved, '^(.*) (%%S+)$')
+  if saved_fingerprint ~= fingerprint then return {'REQUEST_ID_REUSED'} end
+  return {'OK', balance}
+end
+local function remember(key, request_id, fingerprint, balance)
+  if not request_id or request_id == '' then return end
+  redis.call('SET', '%s' .. key .. ':' .. request_id, fingerprint .. ' ' .. fmt(balance), 'EX', IDEMPOTENCY_TTL)
+end
+"""
+
+def idempotency_prelude(ttl):
+    """replay() and remember() keeping applied request IDs for ttl seconds"""
+    return IDEMPOTENCY_PRELUDE % (int(ttl), IDEMPOTENCY_PREFIX, IDEMPOTENCY_PREFIX)
+
+def ledger_prelude(maxlen):
+    """record() for a ledger trimmed to about maxlen entries per account (0 keeps everything, None disables it)"""
+    if maxlen is None:
+        return NO_LEDGER_PRELUDE
+    trim = f"'MAXLEN', '~', {int(maxlen)}, " if maxlen > 0 else ""  # ~: trims whole stream nodes only, which is cheap
+    return LEDGER_PRELUDE % (LEDGER_PREFIX, trim)
+
+CREATE_ACCOUNT = """
+if redis.call('EXISTS', KEYS[1]) == 1 then return {'EXISTS'} end
+create(KEYS[1], ARGV[1])
+return {'OK', fmt(0)}
+"""
+
+# Mutations on one account take the amount (or rate) in ARGV[1] and an optional
+# request ID in ARGV[2]: a request ID already applied replies as the first time did.
+DEPOSIT = """
+local fingerprint = 'deposit:' .. KEYS[1] .. ':' .. ARGV[1]
+local saved = replay(KEYS[1], ARGV[2], fingerprint)
+if saved then return saved end
+local account = load(KEYS[1])
+if not account then return {'NOT_FOUND'} end
+local amount = tonumber(ARGV[1])
+if not amount or amount <= 0 then return {'INVALID_AMOUNT'} end
+local balance = credit(KEYS[1], account, amount)
+record(KEYS[1], 'deposit', amount, balance)
+remember(KEYS[1], ARGV[2], fingerprint, balance)
+return {'OK', fmt(balance)}
+"""
+
+WITHDRAW = """
+local fingerprint = 'withdraw:' .. KEYS[1] .. ':' .. ARGV[1]
+local saved = replay(KEYS[1], ARGV[2], fingerprint)
+if saved then return saved end
+local account = load(KEYS[1])
+if not account then return {'NOT_FOUND'} end
+local amount = tonumber(ARGV[1])
+if not amount or amount <= 0 then return {'INVALID_AMOUNT'} end
+if account.balance < amount then return {'INSUFFICIENT_FUNDS'} end
+local balance = credit(KEYS[1], account, -amount)
+record(KEYS[1], 'withdraw', amount, balance)
+remember(KEYS[1], ARGV[2], fingerprint, balance)
+return {'OK', fmt(balance)}
+"""
+
+CALCULATE_INTEREST = """
+local fingerprint = 'interest:' .. KEYS[1] .. ':' .. ARGV[1]
+local saved = replay(KEYS[1], ARGV[2], fingerprint)
+if saved then return saved end
+local account = load(KEYS[1])
+if not account then return {'NOT_FOUND'} end
+local rate = tonumber(ARGV[1])
+if not rate or rate <= 0 then return {'INVALID_AMOUNT'} end
+local earned = interest(account.balance, rate)
+local balance = credit(KEYS[1], account, earned)
+record(KEYS[1], 'interest', earned, balance)
+remember(KEYS[1], ARGV[2], fingerprint, balance)
+return {'OK', fmt(balance)}
+"""
+
+# Moves an amount between two accounts on the same node. KEYS are the source and
+# destination accounts, ARGV[1] the amount and ARGV[2] an optional request ID.
+# Replies with the source's new balance.
+TRANSFER = """
+local fingerprint = 'transfer:' .. KEYS[1] .. ':' .. KEYS[2] .. ':' .. ARGV[1]
+local saved = replay(KEYS[1], ARGV[2], fingerprint)
+if saved then return saved end
+local source = load(KEYS[1])
+if not source then return {'NOT_FOUND'} end
+local target = load(KEYS[2])
+if not target then return {'NOT_FOUND'} end
+local amount = tonumber(ARGV[1])
+if not amount or amount <= 0 then return {'INVALID_AMOUNT'} end
+if source.balance < amount then return {'INSUFFICIENT_FUNDS'} end
+record(KEYS[2], 'transfer_in', amount, credit(KEYS[2], target, amount), KEYS[1])
+local balance = credit(KEYS[1], source, -amount)
+record(KEYS[1], 'transfer_out', amount, balance, KEYS[2])
+remember(KEYS[1], ARGV[2], fingerprint, balance)
+return {'OK', fmt(balance)}
+"""
+
+# Transfers between shards use three single-node steps (see sharding.py). KEYS are an
+# account and the transfer's record on its node: the transfer on the source, the decision on the destination.
+# Prepare debits the source and records the pending transfer (ARGV: amount, destination, creation time).
+# If the record already exists (a retried request reuses its transfer ID), it replies as the first time.
+TRANSFER_PREPARE = """
+local saved = redis.call('HMGET', KEYS[2], 'to', 'amount', 'balance')
+if saved[1] then
+  if saved[1] ~= ARGV[2] or saved[2] ~= ARGV[1] then return {'REQUEST_ID_REUSED'} end
+  return {'OK', saved[3]}
+end
+local source = load(KEYS[1])
+if not source then return {'NOT_FOUND'} end
+local amount = tonumber(ARGV[1])
+if not amount or amount <= 0 then return {'INVALID_AMOUNT'} end
+if source.balance < amount then return {'INSUFFICIENT_FUNDS'} end
+local balance = credit(KEYS[1], source, -amount)
+record(KEYS[1], 'transfer_out', amount, balance, ARGV[2])
+redis.call('HSET', KEYS[2], 'state', 'prepared', 'from', KEYS[1], 'to', ARGV[2], 'amount', ARGV[1], 'created', ARGV[3], 'balance', fmt(balance))
+return {'OK', fmt(balance)}
+"""
+
+# Decides the transfer on the destination node: credits it once, or rejects it if the
+# account does not exist. The decision is recorded, so repeating the step returns it again
+# (ARGV: amount, seconds the decision is kept, source account).
+TRANSFER_CREDIT = """
+local state = redis.call('GET', KEYS[2])
+if state then return {state} end
+local target = load(KEYS[1])
+if target then
+  local amount = tonumber(ARGV[1])
+  record(KEYS[1], 'transfer_in', amount, credit(KEYS[1], target, amount), ARGV[3])
+  state = 'credited'
+else
+  state = 'rejected'
+end
+redis.call('SET', KEYS[2], state, 'EX', ARGV[2])
+return {state}
+"""
+
+# Finishes a prepared transfer on the source node with the destination's decision:
+# committed if credited, refunded if rejected. Only the first call has an effect
+# (ARGV: decision, seconds the record is kept).
+TRANSFER_FINISH = """
+local state = redis.call('HGET', KEYS[2], 'state')
+if state ~= 'prepared' then return {state or 'MISSING'} end
+if ARGV[1] == 'rejected' then
+  local source = load(KEYS[1])
+  local amount = tonumber(redis.call('HGET', KEYS[2], 'amount'))
+  record(KEYS[1], 'transfer_refund', amount, credit(KEYS[1], source, amount), redis.call('HGET', KEYS[2], 'to'))
+  state = 'aborted'
+else
+  state = 'committed'
+end
+redis.call('HSET', KEYS[2], 'state', state)
+redis.call('EXPIRE', KEYS[2], ARGV[2])
+return {state}
+"""
+
+# Credits one chunk of an interest accrual run. KEYS[1] is the run's progress hash and
+# KEYS[2..] the scanned keys; ARGV is the run ID, the SCAN cursor after this chunk and the
+# annual rates by lower-case account type as JSON. Each account records the last run that
+# credited it, and the cursor is saved in the same script, so a resumed run never credits twice.
+ACCRUE_INTEREST = """
+local run_id = ARGV[1]
+local rates = cjson.decode(ARGV[3])
+local credited, skipped = 0, 0
+for i = 2, #KEYS do
+  local key = KEYS[i]
+  local account = nil
+  if redis.call('TYPE', key).ok == KIND then
+    local ok, loaded = pcall(load, key)
+    if ok and type(loaded) == 'table' and type(loaded.balance) == 'number' then account = loaded end
+  end
+  local rate = account and rates[string.lower(tostring(account.account_type))]
+  if rate and account.last_accrual ~= run_id then
+    mark(key, account, run_id)
+    local earned = interest(account.balance, rate)
+    record(key, 'interest', earned, credit(key, account, earned), run_id)
+    credited = credited + 1
+  else
+    skipped = skipped + 1
+  end
+end
+redis.call('HSET', KEYS[1], 'cursor', ARGV[2])
+redis.call('HINCRBY', KEYS[1], 'scanned', #KEYS - 1)
+redis.call('HINCRBY', KEYS[1], 'credited', credited)
+redis.call('HINCRBY', KEYS[1], 'skipped', skipped)
+if ARGV[2] == '0' then redis.call('HSET', KEYS[1], 'done', 1) end
+return credited
+"""
+
+MIGRATE_REQUESTS_PREFIX = "bankrpc:migrate:requests:"  # Per account: its request ID keys and transfer records, grouped by migrate.py
+
+# Converts a batch of JSON accounts to hashes with integer cents (used by migrate.py).
+# Everything else kept in the account's units moves to cents in the same step: its
+# ledger entries (rewritten under the same entry IDs), and the remembered request IDs
+# and transfer records listed in its MIGRATE_REQUESTS_PREFIX set (interest rates stay
+# in percent). Keys that are already hashes or are not account records are left
+# untouched, so re-running a batch after a crash is harmless.
+MIGRATE_JSON_TO_HASH = """
+local function cents(value)
+  return string.format('%%d', math.floor(tonumber(value) * 100 + 0.5))
+end
+local migrated = 0
+for _, key in ipairs(KEYS) do
+  local requests = '%s' .. key
+  if redis.call('TYPE', key).ok == 'string' then
+    local ok, data = pcall(cjson.decode, redis.call('GET', key))
+    if ok and type(data) == 'table' and type(data.balance) == 'number' then
+      local balance = cents(data.balance)
+      redis.call('DEL', key)
+      redis.call('HSET', key, 'account_type', tostring(data.account_type or ''), 'balance', balance)
+      if type(data.last_accrual) == 'string' then redis.call('HSET', key, 'last_accrual', data.last_accrual) end
+      redis.call('ZADD', '%s', balance, key)  -- The balance index is in layout units too
+
+      local ledger = '%s' .. key
+      local entries = redis.call('XRANGE', ledger, '-', '+')
+      redis.call('DEL', ledger)
+      for _, entry in ipairs(entries) do
+        local fields = entry[2]
+        for i = 1, #fields, 2 do
+          if fields[i] == 'amount' or fields[i] == 'balance' then fields[i + 1] = cents(fields[i + 1]) end
+        end
+        redis.call('XADD', ledger, entry[1], unpack(fields))  -- Same IDs, so ledger cursors stay valid
+      end
+
+      for _, request in ipairs(redis.call('SMEMBERS', requests)) do
+        local kind = redis.call('TYPE', request).ok
+        if kind == 'string' then  -- '<op>:<accounts>:<value> <balance>'
+          local fingerprint, saved = string.match(redis.call('GET', request), '^(.*) (%%S+)$')
+          if string.sub(fingerprint, 1, 9) ~= 'interest:' then
+            fingerprint = (string.gsub(fingerprint, '[^:]+$', cents))
+          end
+          local ttl = redis.call('PTTL', request)
+          if ttl > 0 then
+            redis.call('SET', request, fingerprint .. ' ' .. cents(saved), 'PX', ttl)
+          else
+            redis.call('SET', request, fingerprint .. ' ' .. cents(saved))
+          end
+        elseif kind == 'hash' then  -- Transfer record
+          for _, field in ipairs({'amount', 'balance'}) do
+            local value = redis.call('HGET', request, field)
+            if value then redis.call('HSET', request, field, cents(value)) end
+          end
+        end
+      end
+      migrated = migrated + 1
+    end
+  end
+  redis.call('DEL', requests)  -- Also for accounts converted before
+end
+return migrated
+""" % (MIGRATE_REQUESTS_PREFIX, BALANCE_INDEX_KEY, LEDGER_PREFIX)
+
+# The scripts below work on accounts of either layout (tools and shard moves do not
+# know it): read_any() returns an account's type and balance in stored units, or nil
+# for keys that are not account records.
+ANY_LAYOUT_PRELUDE = """
+local function read_any(key)
+  local kind = redis.call('TYPE', key).ok
+  if kind == 'string' then
+    local ok, data = pcall(cjson.decode, redis.call('GET', key))
+    if ok and type(data) == 'table' and type(data.balance) == 'number' then return tostring(data.account_type), data.balance end
+  elseif kind == 'hash' then
+    local fields = redis.call('HMGET', key, 'account_type', 'balance')
+    if fields[1] and tonumber(fields[2]) then return fields[1], tonumber(fields[2]) end
+  end
+  return nil
+end
+"""
+
+# (Re)indexes KEYS from their records, keys that are not accounts leave the balance index.
+# Used to build the indexes of existing data and after restoring moved accounts.
+INDEX_ACCOUNTS = """
+local indexed = 0
+for _, key in ipairs(KEYS) do
+  local account_type, balance = read_any(key)
+  if account_type then
+    index_account(key, account_type, balance)
+    indexed = indexed + 1
+  else
+    redis.call('ZREM', '%s', key)
+  end
+end
+return indexed
+""" % BALANCE_INDEX_KEY
+
+# Deletes KEYS (accounts and other keys alike) and removes the accounts from the indexes.
+DROP_ACCOUNTS = """
+local deleted = 0
+for _, key in ipairs(KEYS) do
+  local account_type = read_any(key)
+  if account_type then redis.call('SREM', '%s' .. account_type, key) end
+  redis.call('ZREM', '%s', key)
+  deleted = deleted + redis.call('DEL', key)
+end
+return deleted
+""" % (TYPE_INDEX_PREFIX, BALANCE_INDEX_KEY)
+
+# Removes stale members from one index: KEYS[1] is the index, ARGV[1] its account type
+# ('' for the balance index) and ARGV[2..] the members to check. A member is stale if it
+# is not an account (any more), or no longer of the set's type. Returns the number removed.
+PRUNE_INDEX = """
+local removed = 0
+for i = 2, #ARGV do
+  local account_type = read_any(ARGV[i])
+  if not account_type or (ARGV[1] ~= '' and account_type ~= ARGV[1]) then
+    redis.call(ARGV[1] == '' and 'ZREM' or 'SREM', KEYS[1], ARGV[i])
+    removed = removed + 1
+  end
+end
+return removed
+"""
+
+INDEX_SCRIPTS = {name: INDEX_PRELUDE + ANY_LAYOUT_PRELUDE + body for name, body in {
+    "index_accounts": INDEX_ACCOUNTS,
+    "drop_accounts": DROP_ACCOUNTS,
+    "prune_index": PRUNE_INDEX,
+}.items()}  # Complete sources, the same for both layouts
+
+RATE_LIMIT_PREFIX = "bankrpc:ratelimit:"  # Token buckets of the rate limiter, shared by every server process
+
+# KEYS: token buckets; ARGV: now in ms, then rate (tokens/s) and burst of each bucket.
+# A call takes one token from every bucket or, when one of them is empty, none at all
+# and replies with the milliseconds until it refills and the 1-based index of that bucket.
+TOKEN_BUCKET = """
+local now = tonumber(ARGV[1])
+local tokens = {}
+for i, key in ipairs(KEYS) do
+  local rate, burst = tonumber(ARGV[2 * i]), tonumber(ARGV[2 * i + 1])
+  local state = redis.call('HMGET', key, 'tokens', 'ts')
+  local available = tonumber(state[1]) or burst
+  local elapsed = math.max(0, now - (tonumber(state[2]) or now))
+  available = math.min(burst, available + elapsed * rate / 1000)
+  if available < 1 then
+    return {math.ceil((1 - available) * 1000 / rate), i}
+  end
+  tokens[i] = available
+end
+for i, key in ipairs(KEYS) do
+  local rate, burst = tonumber(ARGV[2 * i]), tonumber(ARGV[2 * i + 1])
+  redis.call('HSET', key, 'tokens', tostring(tokens[i] - 1), 'ts', now)
+  redis.call('PEXPIRE', key, math.ceil(burst * 1000 / rate) + 1000)  -- Gone once it would be full again
+end
+return {0, 0}
+"""
+
+SCRIPTS = {
+    "create_account": CREATE_ACCOUNT,
+    "deposit": DEPOSIT,
+    "withdraw": WITHDRAW,
+    "calculate_interest": CALCULATE_INTEREST,
+    "transfer": TRANSFER,
+    "transfer_prepare": TRANSFER_PREPARE,
+    "transfer_credit": TRANSFER_CREDIT,
+    "transfer_finish": TRANSFER_FINISH,
+    "accrue_interest": ACCRUE_INTEREST,
+}
+
+
+def script_sources(layout="json", ledger_maxlen=None, idempotency_ttl=600):
+    """Returns the full source of every script for the storage layout by name, see ledger_prelude() for ledger_maxlen"""
+    prelude = INDEX_PRELUDE + PRELUDES[layout] + ledger_prelude(ledger_maxlen) + idempotency_prelude(idempotency_ttl)
+    return {**{name: prelude + body for name, body in SCRIPTS.items()}, **INDEX_SCRIPTS}
+
+
+def register_scripts(client, layout="json", ledger_maxlen=None, idempotency_ttl=600):
+    """Loads every script for the storage layout into Redis up front and returns the EVALSHA wrappers by name"""
+    registered = {}
+    for name, source in script_sources(layout, ledger_maxlen, idempotency_ttl).items():
+        script = client.register_script(source)
+        client.script_load(source)  # Pre-register so the first call is already an EVALSHA
+        registered[name] = script
+    return registered
+
+
+async def register_scripts_async(client, layout="json", ledger_maxlen=None, idempotency_ttl=600):
+    """Same as register_scripts for a redis.asyncio client"""
+    registered = {}
+    for name, source in script_sources(layout, ledger_maxlen, idempotency_ttl).items():
+        script = client.register_script(source)
+        await client.script_load(source)
+        registered[name] = script
+    return registered
@@ -8,66 +8,343 @@ Server.py Implementation
 from os import getenv
 import bank_pb2_grpc
 import bank_pb2
-import redis
-import json
+from storage import LAYOUTS, AccountFilter, RedisStore
+from accrual import CHUNK_SIZE, AccrualError, AccrualJob
+from redis_pool import RoundTripInterceptor, add_redis_arguments, create_client, create_replica_clients, create_shard_clients, redis_options
+from sharding import ShardedStore
+from metrics import MetricsInterceptor, start_metrics_server
+from ratelimit import AdmissionInterceptor, RateLimiter, RateLimitInterceptor, add_rate_limit_arguments, rate_limit_options
+from cache import BalanceCache, InvalidationListener
+from combiner import WriteCombiner
+from replicas import MAX_STALENESS, ReplicaRouter
+from watch import MAX_WATCHERS, BalanceWatchers
+from snapshot import account_snapshots, accounts_chunk
+from memory_store import MemoryStore
+from sqlite_store import SqliteStore
+import argparse
+import asyncio
+import re
+import signal
+import threading
 import grpc
 from concurrent import futures
 
+EXEC_MODES = ("watch", "script")  # Optimistic WATCH/MULTI loops or atomic Lua scripts
+SERVE_MODES = ("threaded", "async")  # Thread pool server or grpc.aio coroutines
+ENGINES = ("redis", "memory", "sqlite")  # Storage engines: Redis (optionally sharded), in-process MemoryStore or durable SqliteStore
+MAX_WORKERS = 10  # Handler threads of the threaded server
+QUEUE_DEPTH = int(getenv("QUEUE_DEPTH", 50))  # RPCs admitted beyond MAX_WORKERS to wait for a thread
+WATCH_METHOD = "/BankService/WatchBalance"  # Long-lived streams, bounded by max_watchers instead of admission control
+SHUTDOWN_GRACE = 5  # Seconds in-flight RPCs get to finish on SIGTERM
+RECOVERY_INTERVAL = 10  # Seconds between checks for interrupted transfers between shards
+LEDGER_CURSOR = re.compile(r"\d+(-\d+)?")  # Ledger entry (stream) ID
+
+STATUS_ERRORS = {  # Store status -> (gRPC code, details)
+    "NOT_FOUND": (grpc.StatusCode.NOT_FOUND, 'Account not found. Please check the account ID.'),
+    "INSUFFICIENT_FUNDS": (grpc.StatusCode.FAILED_PRECONDITION, 'Insufficient funds for the requested withdrawal.'),
+    "INVALID_AMOUNT": (grpc.StatusCode.INVALID_ARGUMENT, 'Transaction amount must be at least one cent.'),
+    "REQUEST_ID_REUSED": (grpc.StatusCode.INVALID_ARGUMENT, 'Request ID was already used for a different operation.'),
+    "ABORTED": (grpc.StatusCode.ABORTED, 'Failed to update account after multiple retries.'),
+}
+
 class BankService(bank_pb2_grpc.BankServiceServicer):
     """Implements the gRPC bank service"""
 
-    def __init__(self):
-        """Initialize Redis connection"""
-        self.redis = redis.Redis(getenv("REDIS_HOST", "localhost"), port=6379, db=0)
-        self.MAX_RETRIES = 3  # No infinite retries (deadlock prevention)
+    BATCH_SIZE = 500  # Streamed operations (or balances) per pipelined Redis round trip
+    MAX_BALANCES = 10000  # IDs per GetBalances call, longer lists go through StreamBalances
 
-    def _get_account(self, account_id):
-        """Helper function for getting JSON account data from Redis"""
-        data = self.redis.get(account_id)
-        return json.loads(data) if data else None
+    def __init__(self, exec_mode=None, storage=None, redis_client=None, cache_size=None, cache_ttl=None,
+                 shard_clients=None, previous_shard_clients=None, write_combine=None, write_combine_delay=None, engine=None,
+                 sqlite_path=None, commit_window=None, replica_clients=None, max_staleness=None, max_watchers=None):
+        """Initialize Redis connection, or one connection pool per shard given {address: client}, or an embedded engine
 
-    def _set_account(self, account_id, data):
-        """Helper function for setting JSON account data in Redis"""
-        self.redis.set(account_id, json.dumps(data))
+        With {address: client} replica_clients, balance reads go to replicas lagging
+        at most max_staleness seconds behind (default $REPLICA_MAX_STALENESS or 1).
+        At most max_watchers WatchBalance streams run at once (default $MAX_WATCHERS or 256).
+        """
+        self.exec_mode = exec_mode or getenv("EXEC_MODE", "watch")
+        if self.exec_mode not in EXEC_MODES:
+            raise ValueError(f"Unknown execution mode: {self.exec_mode}")
+        storage = storage or getenv("ACCOUNT_STORAGE", "json")
+        engine = engine or getenv("STORAGE_ENGINE", "redis")
+        if engine not in ENGINES:
+            raise ValueError(f"Unknown storage engine: {engine}")
 
-    def CreateAccount(self, request, context):
-        """Creates a new account"""
-        retries = 0
-        while retries < self.MAX_RETRIES:  # Prevents optimistic locking
+        if engine != "redis":
+            if shard_clients:
+                raise ValueError(f"The {engine} engine cannot be sharded")
+            self.redis = None
+            self.store = MemoryStore(storage) if engine == "memory" else SqliteStore(sqlite_path, storage, commit_window)
+        elif shard_clients:
+            self.store = ShardedStore(shard_clients, storage, self.exec_mode, previous_shard_clients)
+            self.redis = self.store.clients[0]
+            threading.Thread(target=self._recover_transfers, name="transfer-recovery", daemon=True).start()
+        else:
+            self.redis = redis_client or create_client()  # Pool configured from the environment by default
+            self.store = RedisStore(self.redis, storage, self.exec_mode)
+
+        cache_size = int(getenv("BALANCE_CACHE_SIZE", 0)) if cache_size is None else cache_size
+        self.cache = None  # Optional GetBalance cache, kept coherent with keyspace notifications
+        if cache_size > 0 and engine == "sqlite":  # Other processes may write the file, and nothing would tell this one
+            print("The balance cache is not available with the sqlite engine, GetBalance reads the database.")
+        elif cache_size > 0:
+            cache_ttl = float(getenv("BALANCE_CACHE_TTL", 30)) if cache_ttl is None else cache_ttl
+            self.cache = BalanceCache(cache_size, cache_ttl)
+            if self.redis is None:  # Memory engine: this process makes every write and invalidates what it changed
+                self.cache_listener = None
+            else:
+                self.cache.enabled = False  # Until the listener is subscribed
+                self.cache_listener = InvalidationListener(self.store.clients if shard_clients else [self.redis], self.cache)
+
+        write_combine = getenv("WRITE_COMBINE", "0") == "1" if write_combine is None else write_combine
+        self.combiner = None  # Optional per-account combining of concurrent Deposit/Withdraw/CalculateInterest calls
+        if write_combine:
+            write_combine_delay = float(getenv("WRITE_COMBINE_DELAY", 0)) if write_combine_delay is None else write_combine_delay
+            self.combiner = WriteCombiner(self.store, write_combine_delay, self.BATCH_SIZE)
+
+        self.replicas = None  # Optional routing of balance reads to Redis replicas
+        if replica_clients:
+            if engine != "redis" or shard_clients:
+                raise ValueError("Replica reads need the redis engine without sharding")
+            max_staleness = float(getenv("REPLICA_MAX_STALENESS", MAX_STALENESS)) if max_staleness is None else max_staleness
+            self.replicas = ReplicaRouter(self.redis, replica_clients, max_staleness)
+
+        max_watchers = MAX_WATCHERS if max_watchers is None else max_watchers  # WatchBalance streams, woken by keyspace notifications
+        self.watchers = BalanceWatchers(None if self.redis is None else self.store.clients if shard_clients else [self.redis], max_watchers)
+        self.watchers.notifying = engine != "sqlite"  # Other processes may write the sqlite file unseen, streams re-read it every check_interval
+
+    def _recover_transfers(self):
+        """Background loop finishing transfers between shards interrupted by a crash"""
+        stopped = threading.Event()  # Never set, the thread dies with the process
+        while not stopped.wait(RECOVERY_INTERVAL):
             try:
-                with self.redis.pipeline() as pipe:
-                    pipe.watch(request.account_id)
-                    if self.redis.exists(request.account_id):  # Check if account already exists
-                        context.set_code(grpc.StatusCode.ALREADY_EXISTS)
-                        context.set_details('Account already exists.')
-                        return bank_pb2.AccountResponse()
-
-                    data = {  # New account data
-                        "account_type": request.account_type,
-                        "balance": 0.0
-                    }
-                    self._set_account(request.account_id, data)
-
-                    return bank_pb2.AccountResponse(account_id=request.account_id,message="Account created.")
-            
-            except redis.WatchError:
-                retries += 1
+                recovered = self.store.recover_transfers()
+            except Exception as e:  # Keep trying while Redis is unreachable
+                print(f"Transfer recovery failed: {e}")
                 continue
-        
-        context.set_code(grpc.StatusCode.ABORTED)
-        context.set_details('Failed to create account after multiple retries.')
-        return bank_pb2.AccountResponse()
+            if recovered:
+                print(f"Recovered {recovered} interrupted transfers...")
+
+    def _invalidate(self, *account_ids):
+        """Helper function for dropping changed accounts from the local cache right away, and waking their watchers on embedded engines"""
+        if self.cache:
+            for account_id in account_ids:
+                self.cache.invalidate(account_id)
+        if self.redis is None:  # With Redis, watchers hear about every write from keyspace notifications
+            for account_id in account_ids:
+                self.watchers.invalidate(account_id)
+
+    def _invalidate_all(self):
+        """Helper function for dropping every cached account and waking every watcher after a bulk write on an embedded engine"""
+        if self.cache:
+            self.cache.clear()
+        self.watchers.clear()
+
+    def _replica_read(self, request, read):
+        """Helper function for running read(client) on a replica fresh enough for the request, or on the primary"""
+        max_staleness = request.max_staleness if request.HasField("max_staleness") else None
+        return self.replicas.read(read, max_staleness)
+
+    def _get_many(self, request, account_ids):
+        """Helper function for reading several balances, from a replica if enabled"""
+        if self.replicas is None:
+            return self.store.get_many(account_ids)
+        return self._replica_read(request, lambda client: self.store.get_many(account_ids, client))
+
+    def _apply(self, op, account_id, value, request_id):
+        """Helper function for applying a mutation, through the write combiner if enabled"""
+        if self.combiner:
+            return self.combiner.apply(op, account_id, value, request_id)
+        return self.store.apply(op, account_id, value, request_id)
+
+    def _transaction_response(self, status, account_id, balance, context, message):
+        """Helper function for turning a store result into a TransactionResponse"""
+        if status != "OK":  # Nothing was written
+            code, details = STATUS_ERRORS[status]
+            context.set_code(code)
+            context.set_details(details)
+            return bank_pb2.TransactionResponse()
+
+        return bank_pb2.TransactionResponse(account_id=account_id, balance=balance, message=message)
+
+    def _batch_operations(self, batch):
+        """Helper function for turning (index, BatchOperation) pairs into store operations, without the empty ones"""
+        operations = []
+        for _, operation in batch:
+            kind = operation.WhichOneof("operation")
+            if kind is None:
+                continue
+            request = getattr(operation, kind)
+            operations.append((kind, request.account_id, request.amount, request.request_id))
+        return operations
+
+    def _batch_results(self, batch, operations, results):
+        """Helper function for turning store results into BatchResults in batch order, empty operations are rejected in place"""
+        applied = iter(zip(operations, results))
+        for index, operation in batch:
+            if operation.WhichOneof("operation") is None:
+                yield self._invalid_operation(index)
+                continue
+            (kind, account_id, _, _), (status, balance) = next(applied)
+            if status != "OK":
+                code, details = STATUS_ERRORS[status]
+                yield bank_pb2.BatchResult(index=index, account_id=account_id, code=code.value[0], message=details)
+            else:
+                message = "Deposit successful." if kind == "deposit" else "Withdraw successful."
+                yield bank_pb2.BatchResult(index=index, account_id=account_id, message=message, balance=balance)
+
+    def _apply_batch(self, batch):
+        """Helper function for applying (index, BatchOperation) pairs in one pipeline"""
+        operations = self._batch_operations(batch)
+        results = self.store.apply_many(operations) if operations else []
+        self._invalidate(*{operation[1] for operation in operations})
+        return self._batch_results(batch, operations, results)
+
+    def _accrual_job(self, request, context):
+        """Helper function for validating an AccrualRequest, returns None if it is invalid"""
+        if not request.run_id or not request.rates or any(rate <= 0 for rate in request.rates.values()):
+            context.set_code(grpc.StatusCode.INVALID_ARGUMENT)
+            context.set_details('A run ID and a positive annual interest rate per account type are required.')
+            return None
+
+        return AccrualJob(self.store, request.run_id, dict(request.rates), request.batch_size or CHUNK_SIZE)
+
+    def _accrual_progress(self, progress):
+        """Helper function for turning job progress into an AccrualProgress"""
+        return bank_pb2.AccrualProgress(run_id=progress["run_id"], scanned=progress["scanned"], credited=progress["credited"],
+                                        skipped=progress["skipped"], done=progress["done"])
+
+    def _balances_response(self, account_ids, accounts):
+        """Helper function for turning accounts (None if missing) into a BalancesResponse"""
+        return bank_pb2.BalancesResponse(balances=[
+            bank_pb2.BalanceEntry(account_id=account_id, found=True, balance=account.balance) if account
+            else bank_pb2.BalanceEntry(account_id=account_id, found=False)
+            for account_id, account in zip(account_ids, accounts)
+        ])
+
+    def _too_many_balances(self, request, context):
+        """Helper function for rejecting GetBalances calls over MAX_BALANCES IDs"""
+        if len(request.account_ids) <= self.MAX_BALANCES:
+            return False
+        context.set_code(grpc.StatusCode.INVALID_ARGUMENT)
+        context.set_details(f'At most {self.MAX_BALANCES} account IDs per call, use StreamBalances for more.')
+        return True
+
+    def _ledger_entry(self, transaction):
+        """Helper function for turning a store Transaction into a LedgerEntry"""
+        return bank_pb2.LedgerEntry(id=transaction.id, type=transaction.op, amount=transaction.amount, balance=transaction.balance,
+                                    timestamp_ms=int(transaction.id.split("-", 1)[0]), reference=transaction.ref)
+
+    def _invalid_cursor(self, request, context):
+        """Helper function for rejecting a TransactionsRequest cursor that is not an entry ID"""
+        if not request.since or LEDGER_CURSOR.fullmatch(request.since):
+            return False
+        context.set_code(grpc.StatusCode.INVALID_ARGUMENT)
+        context.set_details('Cursor must be the ID of a previous transaction.')
+        return True
+
+    def _account_filter(self, request):
+        """Helper function for turning a ListAccountsRequest's filter into an AccountFilter"""
+        query = request.filter
+        return AccountFilter(query.account_type or None,
+                             query.min_balance if query.HasField("min_balance") else None,
+                             query.max_balance if query.HasField("max_balance") else None)
+
+    def _list_count(self, remaining):
+        """Helper function for the number of accounts the next ListAccounts index read covers"""
+        return self.BATCH_SIZE if remaining is None else min(self.BATCH_SIZE, remaining)
+
+    def _invalid_page_token(self, context):
+        """Helper function for rejecting a page token this listing did not hand out"""
+        context.set_code(grpc.StatusCode.INVALID_ARGUMENT)
+        context.set_details('Page token must be the next_page_token of a previous ListAccounts call with the same filter.')
+
+    def _account_not_found(self, context):
+        """Helper function for rejecting calls on an account that does not exist"""
+        context.set_code(grpc.StatusCode.NOT_FOUND)
+        context.set_details('Account not found. Please check the account ID.')
+
+    def _too_many_watchers(self, context):
+        """Helper function for rejecting a WatchBalance call past max_watchers"""
+        context.set_code(grpc.StatusCode.RESOURCE_EXHAUSTED)
+        context.set_details('Too many balance watchers on this server, try again later.')
+
+    def _invalid_operation(self, index):
+        """Helper function for rejecting an empty BatchOperation"""
+        return bank_pb2.BatchResult(index=index, code=grpc.StatusCode.INVALID_ARGUMENT.value[0], message='Operation must be a deposit or a withdrawal.')
+
+    def CreateAccount(self, request, context):
+        """Creates a new account"""
+        status, _ = self.store.create(request.account_id, request.account_type)
+        if status == "EXISTS":  # Check if account already exists
+            context.set_code(grpc.StatusCode.ALREADY_EXISTS)
+            context.set_details('Account already exists.')
+            return bank_pb2.AccountResponse()
+
+        if status == "ABORTED":
+            context.set_code(grpc.StatusCode.ABORTED)
+            context.set_details('Failed to create account after multiple retries.')
+            return bank_pb2.AccountResponse()
+
+        return bank_pb2.AccountResponse(account_id=request.account_id,message="Account created.")
 
     def GetBalance(self, request, context):
         """Retrieves the balance for the account"""
-        data = self._get_account(request.account_id)
-        if not data:  # Check if account exists
+        if self.cache:  # Misses read the primary, so a replica's stale balance is never cached
+            account = self.cache.get(request.account_id, self.store.get)
+        elif self.replicas:
+            account = self._replica_read(request, lambda client: self.store.get(request.account_id, client))
+        else:
+            account = self.store.get(request.account_id)
+        if not account:  # Check if account exists
             context.set_code(grpc.StatusCode.NOT_FOUND)
             context.set_details('Account not found. Please check the account ID.')
             return bank_pb2.BalanceResponse()
 
-        return bank_pb2.BalanceResponse(account_id=request.account_id, balance=data['balance'], message="Balance retrieved.")
+        return bank_pb2.BalanceResponse(account_id=request.account_id, balance=account.balance, message="Balance retrieved.")
     
+    def GetBalances(self, request, context):
+        """Retrieves the balances of several accounts with one Redis read, missing accounts are reported per ID"""
+        if self._too_many_balances(request, context):
+            return bank_pb2.BalancesResponse()
+
+        account_ids = list(request.account_ids)
+        return self._balances_response(account_ids, self._get_many(request, account_ids))
+
+    def StreamBalances(self, request, context):
+        """Streams the balances of a long list of accounts, one response per BATCH_SIZE IDs and Redis read"""
+        for start in range(0, len(request.account_ids), self.BATCH_SIZE):
+            account_ids = request.account_ids[start:start + self.BATCH_SIZE]
+            yield self._balances_response(account_ids, self._get_many(request, account_ids))
+
+    def WatchBalance(self, request, context):
+        """Streams the account's balance, then the new balance after each change, until the client cancels
+
+        The stream sleeps until a write to the account wakes it and then reads
+        the balance once, so writes landing in between are sent as one update.
+        Each stream holds a handler thread, max_watchers of them at most.
+        """
+        event = self.watchers.add(request.account_id)
+        if event is None:
+            self._too_many_watchers(context)
+            return
+        context.add_callback(event.set)  # Cancelled: stop waiting right away
+        try:
+            balance, changed = None, True
+            while context.is_active():
+                if changed:
+                    account = self.store.get(request.account_id)  # Always the primary, a replica could go back in time
+                    if not account:
+                        self._account_not_found(context)
+                        return
+                    if account.balance != balance:
+                        message = "Balance retrieved." if balance is None else "Balance changed."
+                        balance = account.balance
+                        yield bank_pb2.BalanceResponse(account_id=request.account_id, balance=balance, message=message)
+                changed = self.watchers.wait(event)
+        finally:
+            self.watchers.remove(request.account_id, event)
+
     def Deposit(self, request, context):
         """Deposits the amount into the account"""
         if request.amount <= 0:  # Check if amount is positive
@@ -75,30 +352,9 @@ class BankService(bank_pb2_grpc.BankServiceServicer):
             context.set_details('Transaction amount must be positive.')
             return bank_pb2.TransactionResponse()
 
-        retries = 0
-        while retries < self.MAX_RETRIES:
-            try:
-                with self.redis.pipeline() as pipe:
-                    pipe.watch(request.account_id)  # Watch for account data changes
-                    data = self._get_account(request.account_id)
-                    if not data:  # Check if account exists
-                        context.set_code(grpc.StatusCode.NOT_FOUND)
-                        context.set_details('Account not found. Please check the account ID.')
-                        return bank_pb2.TransactionResponse()
-                    
-                    data['balance'] += request.amount  # Update balance
-                    pipe.multi()  # Start transaction
-                    pipe.set(request.account_id, json.dumps(data))
-                    pipe.execute()  # Execute the transaction
-                    return bank_pb2.TransactionResponse(account_id=request.account_id, balance=data['balance'], message="Deposit successful.")
-            
-            except redis.WatchError:  # Handle concurrent updates
-                retries += 1
-                continue
-        
-        context.set_code(grpc.StatusCode.ABORTED)
-        context.set_details('Failed to update account after multiple retries.')
-        return bank_pb2.TransactionResponse()
+        status, balance = self._apply("deposit", request.account_id, request.amount, request.request_id)
+        self._invalidate(request.account_id)
+        return self._transaction_response(status, request.account_id, balance, context, "Deposit successful.")
     
     def Withdraw(self, request, context):
         """Withdraws the amount from the account"""
@@ -106,36 +362,10 @@ class BankService(bank_pb2_grpc.BankServiceServicer):
             context.set_code(grpc.StatusCode.INVALID_ARGUMENT)
             context.set_details('Transaction amount must be positive.')
             return bank_pb2.TransactionResponse()
-        
-        retries = 0
-        while retries < self.MAX_RETRIES:
-            try:
-                with self.redis.pipeline() as pipe:
-                    pipe.watch(request.account_id)
-                    data = self._get_account(request.account_id)
-                    if not data:
-                        context.set_code(grpc.StatusCode.NOT_FOUND)
-                        context.set_details('Account not found. Please check the account ID.')
-                        return bank_pb2.TransactionResponse()
-                    
-                    if data['balance'] < request.amount:
-                        context.set_code(grpc.StatusCode.FAILED_PRECONDITION)
-                        context.set_details('Insufficient funds for the requested withdrawal.')
-                        return bank_pb2.TransactionResponse()
-                    
-                    data['balance'] -= request.amount  # Update balance
-                    pipe.multi()  # Transaction occurs
-                    pipe.set(request.account_id, json.dumps(data))
-                    pipe.execute()
-                    return bank_pb2.TransactionResponse(account_id=request.account_id, balance=data['balance'], message="Withdraw successful.")
-            
-            except redis.WatchError:
-                retries += 1
-                continue
-        
-        context.set_code(grpc.StatusCode.ABORTED)
-        context.set_details('Failed to update account after multiple retries.')
-        return bank_pb2.TransactionResponse()
+
+        status, balance = self._apply("withdraw", request.account_id, request.amount, request.request_id)
+        self._invalidate(request.account_id)
+        return self._transaction_response(status, request.account_id, balance, context, "Withdraw successful.")
     
     def CalculateInterest(self, request, context):
         """Calculates the interest on the account"""
@@ -143,41 +373,189 @@ class BankService(bank_pb2_grpc.BankServiceServicer):
             context.set_code(grpc.StatusCode.INVALID_ARGUMENT)
             context.set_details('Annual interest rate must be a positive value.')
             return bank_pb2.TransactionResponse()
-        
-        retries = 0
-        while retries < self.MAX_RETRIES:
+
+        status, balance = self._apply("calculate_interest", request.account_id, request.annual_interest_rate, request.request_id)
+        self._invalidate(request.account_id)
+        return self._transaction_response(status, request.account_id, balance, context, "Interest calculated and deposited.")
+
+    def Transfer(self, request, context):
+        """Moves the amount from one account to another atomically"""
+        if request.amount <= 0:  # Check if amount is positive
+            context.set_code(grpc.StatusCode.INVALID_ARGUMENT)
+            context.set_details('Transaction amount must be positive.')
+            return bank_pb2.TransactionResponse()
+
+        if request.from_account_id == request.to_account_id:
+            context.set_code(grpc.StatusCode.INVALID_ARGUMENT)
+            context.set_details('Cannot transfer to the same account.')
+            return bank_pb2.TransactionResponse()
+
+        status, balance = self.store.transfer(request.from_account_id, request.to_account_id, request.amount, request.request_id)
+        self._invalidate(request.from_account_id, request.to_account_id)
+        return self._transaction_response(status, request.from_account_id, balance, context, "Transfer successful.")
+
+    def BatchTransactions(self, request_iterator, context):
+        """Applies a stream of deposits and withdrawals, streaming back one result per operation
+
+        Operations are grouped into chunks of BATCH_SIZE and each chunk is applied with one
+        pipelined Redis round trip. Results for a chunk are sent once it is full or the
+        request stream ends, always in request order.
+        """
+        batch = []
+        for index, operation in enumerate(request_iterator):
+            batch.append((index, operation))  # Empty operations too, rejected in their place among the results
+            if len(batch) >= self.BATCH_SIZE:
+                yield from self._apply_batch(batch)
+                batch = []
+
+        if batch:
+            yield from self._apply_batch(batch)
+
+    def AccrueInterest(self, request, context):
+        """Credits interest to every account whose type has a rate, streaming progress after each chunk"""
+        job = self._accrual_job(request, context)
+        if job is None:
+            return
+
+        try:
+            for progress in job.run():
+                if self.redis is None:  # Credited accounts are not reported one by one, Redis engines hear of them from notifications
+                    self._invalidate_all()
+                yield self._accrual_progress(progress)
+        except AccrualError as e:  # Run ID reused with different rates
+            context.set_code(grpc.StatusCode.FAILED_PRECONDITION)
+            context.set_details(str(e))
+
+    def ExportAccounts(self, request, context):
+        """Streams every account (optionally matching a glob pattern), one AccountsChunk per scan batch"""
+        for batch in self.store.iter_accounts(min(request.batch_size or self.BATCH_SIZE, self.MAX_BALANCES), request.match or None):
+            yield accounts_chunk(batch)
+
+    def ListAccounts(self, request, context):
+        """Streams the accounts matching the filter from the secondary indexes, one AccountsPage per BATCH_SIZE index entries
+
+        Pages the filter left empty are skipped, except the last one, which
+        carries the token to resume from (empty once the listing is complete).
+        """
+        query = self._account_filter(request)
+        token, remaining = request.page_token, request.page_size or None  # None: every account
+        while True:
+            count = self._list_count(remaining)
             try:
-                with self.redis.pipeline() as pipe:
-                    pipe.watch(request.account_id)
-                    data = self._get_account(request.account_id)
-                    if not data:
-                        context.set_code(grpc.StatusCode.NOT_FOUND)
-                        context.set_details('Account not found. Please check the account ID.')
-                        return bank_pb2.TransactionResponse()
-                    
-                    data['balance'] += data['balance'] * (request.annual_interest_rate / 100)  # Calculate interest and deposit
-                    pipe.multi()  # Transaction occurs
-                    pipe.set(request.account_id, json.dumps(data))
-                    pipe.execute()
-                    return bank_pb2.TransactionResponse(account_id=request.account_id, balance=data['balance'], message="Interest calculated and deposited.")
-            
-            except redis.WatchError:
-                retries += 1
-                continue
-        
-        context.set_code(grpc.StatusCode.ABORTED)
-        context.set_details('Failed to update account after multiple retries.')
-        return bank_pb2.TransactionResponse()
+                accounts, token = self.store.list_accounts(query, token, count)
+            except ValueError:
+                self._invalid_page_token(context)
+                return
+            remaining = None if remaining is None else remaining - count
+            last = not token or (remaining is not None and remaining <= 0)
+            if accounts or last:
+                yield bank_pb2.AccountsPage(accounts=account_snapshots(accounts), next_page_token=token)
+            if last:
+                return
+
+    def GetTransactions(self, request, context):
+        """Streams the account's ledger after the since cursor, reading BATCH_SIZE entries per Redis round trip"""
+        if self._invalid_cursor(request, context):
+            return
+
+        remaining = request.limit or None  # None: the whole history
+        cursor = request.since
+        while remaining is None or remaining > 0:
+            count = self.BATCH_SIZE if remaining is None else min(self.BATCH_SIZE, remaining)
+            transactions = self.store.transactions(request.account_id, cursor, count, request.newest_first)
+            if not transactions:
+                if not cursor and self.store.get(request.account_id) is None:  # No history at all: is there an account?
+                    self._account_not_found(context)
+                return
+
+            for transaction in transactions:
+                yield self._ledger_entry(transaction)
+            if len(transactions) < count:  # End of the history
+                return
+            cursor = transactions[-1].id
+            if remaining is not None:
+                remaining -= count
         
 
-def serve():
-    """Starts the gRPC server"""
-    server = grpc.server(futures.ThreadPoolExecutor(max_workers=10))  # Locking mechanism with 10 threads
-    bank_pb2_grpc.add_BankServiceServicer_to_server(BankService(), server)
-    server.add_insecure_port('[::]:50051')
+def serve(exec_mode=None, storage=None, port=50051, reuse_port=False, pool_options=None, metrics_port=0,
+          queue_depth=QUEUE_DEPTH, rate_limits=None, **service_options):
+    """Starts the gRPC server, SIGTERM stops it gracefully
+
+    At most MAX_WORKERS RPCs run at once and queue_depth more wait for a turn
+    (0 admits any number), the rest are rejected with RESOURCE_EXHAUSTED without
+    queueing them. rate_limits holds the RateLimiter arguments (client_rate,
+    client_burst, account_rate, account_burst). WatchBalance streams hold a
+    thread for as long as they run, so they are left out of admission control:
+    the pool has max_watchers more threads, and the service rejects streams
+    beyond max_watchers.
+    """
+    if metrics_port:
+        start_metrics_server(metrics_port)
+    shard_clients, previous_shard_clients = create_shard_clients(pool_options)
+    replica_clients = create_replica_clients(pool_options)
+    if shard_clients:
+        service = BankService(exec_mode, storage, shard_clients=shard_clients, previous_shard_clients=previous_shard_clients,
+                              replica_clients=replica_clients, **service_options)
+    else:
+        service = BankService(exec_mode, storage, create_client(pool_options), replica_clients=replica_clients, **service_options)
+    limiter = RateLimiter(service.redis, **(rate_limits or {}))  # Shared through Redis, in-process with embedded engines
+    options = [("grpc.so_reuseport", 1 if reuse_port else 0)]  # Several processes may share the port
+    workers = MAX_WORKERS + service.watchers.max_watchers  # Locking mechanism with MAX_WORKERS threads, plus one per stream
+    interceptors = [RateLimitInterceptor(limiter), RoundTripInterceptor(), MetricsInterceptor()]
+    if queue_depth:  # Shed load instead of queueing it, outermost so rejected RPCs skip the rest
+        interceptors.insert(0, AdmissionInterceptor(MAX_WORKERS, queue_depth, exempt=(WATCH_METHOD,)))
+        workers += queue_depth  # Admitted RPCs wait for their turn on a thread, never in grpc's queue
+    server = grpc.server(futures.ThreadPoolExecutor(max_workers=workers), options=options, interceptors=interceptors,
+                         maximum_concurrent_rpcs=workers if queue_depth else None)
+    bank_pb2_grpc.add_BankServiceServicer_to_server(service, server)
+    server.add_insecure_port(f'[::]:{port}')
     server.start()
+    signal.signal(signal.SIGTERM, lambda *_: server.stop(SHUTDOWN_GRACE))  # Finish in-flight RPCs first
     print("Server started...")
     server.wait_for_termination()
 
 if __name__ == '__main__':
-    serve()
+    parser = argparse.ArgumentParser(description="bankRPC gRPC server")
+    parser.add_argument("--mode", choices=SERVE_MODES, default="threaded", help="Serving mode")
+    parser.add_argument("--port", type=int, default=50051, help="Port to listen on")
+    parser.add_argument("--exec-mode", choices=EXEC_MODES, help="How mutations are applied in Redis (default: $EXEC_MODE or watch)")
+    parser.add_argument("--storage", choices=LAYOUTS, help="Account storage layout (default: $ACCOUNT_STORAGE or json)")
+    parser.add_argument("--engine", choices=ENGINES, default=getenv("STORAGE_ENGINE", "redis"),
+                        help="Threaded mode: storage engine, memory keeps accounts in this process only, sqlite in a durable local file (default: $STORAGE_ENGINE or redis)")
+    parser.add_argument("--sqlite-path", default=getenv("SQLITE_PATH", "bankrpc.db"), help="Database file of the sqlite engine")
+    parser.add_argument("--commit-window", type=float, default=float(getenv("COMMIT_WINDOW", 0)),
+                        help="Seconds a sqlite group commit waits for more mutations, 0 only groups those already queued")
+    parser.add_argument("--max-concurrent-rpcs", type=int, default=int(getenv("MAX_CONCURRENT_RPCS", 4096)), help="Async mode: in-flight RPC limit")
+    parser.add_argument("--queue-depth", type=int, default=QUEUE_DEPTH,
+                        help="Threaded mode: RPCs admitted beyond the handler threads, the rest fail with RESOURCE_EXHAUSTED (0: no limit)")
+    parser.add_argument("--balance-cache-size", type=int, default=int(getenv("BALANCE_CACHE_SIZE", 0)), help="Threaded mode: cached GetBalance accounts, 0 disables the cache, ignored by the sqlite engine")
+    parser.add_argument("--balance-cache-ttl", type=float, default=float(getenv("BALANCE_CACHE_TTL", 30)), help="Seconds a cached balance may be served")
+    parser.add_argument("--write-combine", action="store_true", default=getenv("WRITE_COMBINE", "0") == "1",
+                        help="Threaded mode: apply concurrent mutations of the same account as one Redis update")
+    parser.add_argument("--write-combine-delay", type=float, default=float(getenv("WRITE_COMBINE_DELAY", 0)),
+                        help="Seconds a combined batch waits for more mutations, 0 only combines those already queued")
+    parser.add_argument("--max-staleness", type=float, default=float(getenv("REPLICA_MAX_STALENESS", MAX_STALENESS)),
+                        help="Threaded mode with --redis-replicas: seconds a replica may lag behind for balance reads that do not say")
+    parser.add_argument("--max-watchers", type=int, default=MAX_WATCHERS,
+                        help="Threaded mode: WatchBalance streams served at once, each holds a handler thread (default: $MAX_WATCHERS or 256)")
+    parser.add_argument("--metrics-port", type=int, default=int(getenv("METRICS_PORT", 0)), help="Serve Prometheus metrics on this port, 0 disables it")
+    add_rate_limit_arguments(parser)
+    add_redis_arguments(parser)
+    args = parser.parse_args()
+
+    if args.mode == "async":
+        if args.exec_mode == "watch":
+            parser.error("async mode always uses --exec-mode script")
+        if args.engine != "redis":
+            parser.error("async mode always uses the redis engine")
+        if args.redis_replicas:
+            parser.error("replica reads need threaded mode")
+        from async_server import serve_async
+        asyncio.run(serve_async(args.storage, args.port, args.max_concurrent_rpcs, redis_options(args), metrics_port=args.metrics_port,
+                                rate_limits=rate_limit_options(args)))
+    else:
+        serve(args.exec_mode, args.storage, args.port, pool_options=redis_options(args), metrics_port=args.metrics_port,
+              queue_depth=args.queue_depth, rate_limits=rate_limit_options(args), max_staleness=args.max_staleness, max_watchers=args.max_watchers,
+              cache_size=args.balance_cache_size, cache_ttl=args.balance_cache_ttl,
+              write_combine=args.write_combine, write_combine_delay=args.write_combine_delay, engine=args.engine,
+              sqlite_path=args.sqlite_path, commit_window=args.commit_window)
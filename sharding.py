@@ -0,0 +1,471 @@
+"""
+bankRPC - Distributed Banking
+By: Imesh Nimsitha
+2025/02/05
+Sharding.py Sharded Account Keyspace
+"""
+
+from collections import defaultdict
+from storage import IDEMPOTENCY_KEY, LEDGER_KEY, TRANSFER_DECISION_KEY, TRANSFER_KEY, AsyncRedisStore, RedisStore, Store, decode_page_token, encode_page_token, has_balance_bounds, matching_accounts
+import scripts
+import bisect
+import hashlib
+import heapq
+import itertools
+import uuid
+import redis
+
+VNODES = 160  # Points per node on the ring, smooths out the share of keys each node gets
+RECOVERY_AGE = 30  # Seconds a transfer between shards may stay prepared before recovery finishes it
+TRANSFER_NAMESPACE = uuid.UUID("8f3c2a4e-5b1d-4c7e-9a60-2d8e4f1b7c35")  # Transfer IDs derived from request IDs
+
+def routing_key(account_id):
+    """Part of an account ID that is hashed: the {hash tag} if it has one, as in Redis Cluster"""
+    if isinstance(account_id, bytes):
+        account_id = account_id.decode()
+    start = account_id.find("{")
+    if start != -1:
+        end = account_id.find("}", start + 1)
+        if end > start + 1:
+            return account_id[start + 1:end]
+    return account_id
+
+def _hash(value):
+    """64-bit position on the ring"""
+    return int.from_bytes(hashlib.md5(value.encode()).digest()[:8], "big")
+
+class HashRing:
+    """Consistent hash ring: adding a node only moves the accounts it takes over"""
+
+    def __init__(self, nodes, vnodes=VNODES):
+        """Initialize ring, nodes are identified by their address"""
+        if not nodes:
+            raise ValueError("A hash ring needs at least one node")
+        self.nodes = list(nodes)
+        points = sorted((_hash(f"{node}#{i}"), index) for index, node in enumerate(self.nodes) for i in range(vnodes))
+        self._points = [point for point, _ in points]
+        self._owners = [index for _, index in points]
+
+    def shard_for(self, account_id):
+        """Index of the node that owns an account"""
+        i = bisect.bisect(self._points, _hash(routing_key(account_id)))
+        return self._owners[i % len(self._points)]
+
+    def node_for(self, account_id):
+        """Address of the node that owns an account"""
+        return self.nodes[self.shard_for(account_id)]
+
+def transfer_id(from_account_id, request_id):
+    """ID of a transfer between shards: derived from the request ID so a retry resumes the same transfer"""
+    if not request_id:
+        return uuid.uuid4().hex
+    return uuid.uuid5(TRANSFER_NAMESPACE, f"{from_account_id}\0{request_id}").hex
+
+def request_keys(account_id, request_ids):
+    """Request ID keys of an account, for the request IDs that are set"""
+    return [IDEMPOTENCY_KEY.format(account_id, request_id) for request_id in request_ids if request_id]
+
+def move_key(source, target, key):
+    """Moves one key between nodes with DUMP/RESTORE, returns False if the source no longer has it
+
+    The copy is restored with the key's remaining TTL before the source is
+    deleted, and RESTORE never replaces, so concurrent movers of the same key
+    are harmless. An account's secondary index entries are rebuilt from the
+    record on the target and removed with it from the source.
+    """
+    with source.pipeline(transaction=False) as pipe:
+        data, ttl = pipe.dump(key).pttl(key).execute()
+    if data is None or ttl == -2:  # -2: expired in between
+        return False
+    try:
+        target.restore(key, max(ttl, 0), data)
+    except redis.ResponseError as e:
+        if "BUSYKEY" not in str(e):  # Already moved by someone else
+            raise
+    target.register_script(scripts.INDEX_SCRIPTS["index_accounts"])(keys=[key])
+    source.register_script(scripts.INDEX_SCRIPTS["drop_accounts"])(keys=[key])
+    return True
+
+async def move_key_async(source, target, key):
+    """move_key() on redis.asyncio clients"""
+    async with source.pipeline(transaction=False) as pipe:
+        data, ttl = await pipe.dump(key).pttl(key).execute()
+    if data is None or ttl == -2:
+        return False
+    try:
+        await target.restore(key, max(ttl, 0), data)
+    except redis.ResponseError as e:
+        if "BUSYKEY" not in str(e):
+            raise
+    await target.register_script(scripts.INDEX_SCRIPTS["index_accounts"])(keys=[key])
+    await source.register_script(scripts.INDEX_SCRIPTS["drop_accounts"])(keys=[key])
+    return True
+
+def merge_balance_entries(pages, positions, count):
+    """Merges balance index entries read from every shard into the first count in (balance, ID) order
+
+    pages holds the (member, score) entries read after each shard's position.
+    Returns the merged entries, each shard's position after them, and whether
+    more may follow (a shard filled its page or entries were left over).
+    """
+    merged = heapq.merge(*[[(score, member, shard) for member, score in page] for shard, page in enumerate(pages)])
+    taken = list(itertools.islice(merged, count))
+    positions = list(positions)
+    for score, member, shard in taken:
+        positions[shard] = [score, member.decode()]
+    more = any(len(page) == count for page in pages) or len(taken) < sum(len(page) for page in pages)
+    return [(member, score) for score, member, _ in taken], positions, more
+
+class ShardedStore(Store):
+    """RedisStore interface over several Redis nodes, routing each account on a consistent hash ring
+
+    clients maps node addresses to clients, each with its own connection pool.
+    While a rebalance is running, previous_clients holds the node list before
+    it; an account whose owner changed is moved from its previous owner the
+    first time it is used, and rebalance.py moves the others. Request IDs and
+    transfer records of a moved account are pulled when a call needs them,
+    so a retried request is still recognized on the new owner.
+    """
+
+    def __init__(self, clients, layout="json", exec_mode="watch", previous_clients=None):
+        """Initialize one RedisStore per node"""
+        self.ring = HashRing(clients)
+        self.clients = list(clients.values())
+        self.stores = [RedisStore(client, layout, exec_mode) for client in self.clients]
+        self.layout = self.stores[0].layout
+        self.exec_mode = exec_mode
+        self.previous_ring = HashRing(previous_clients) if previous_clients else None
+        self.previous_clients = previous_clients
+        self.previous_stores = [RedisStore(client, layout, exec_mode) for node, client in (previous_clients or {}).items()
+                                if node not in clients]  # Removed nodes, scanned for stranded transfers
+
+    def _moved(self, account_id, shard):
+        """Previous owner's client if the account changed owner in a running rebalance"""
+        if self.previous_ring is None:
+            return None
+        previous = self.previous_ring.node_for(account_id)
+        if previous == self.ring.nodes[shard]:
+            return None
+        return self.previous_clients[previous]
+
+    def _route(self, account_id, *keys):
+        """Store that owns an account, pulling it from its previous owner first if needed
+
+        keys are bookkeeping keys of the account the caller is about to use
+        (request IDs, transfer records), pulled as well: they may still be
+        left behind after the account itself moved.
+        """
+        shard = self.ring.shard_for(account_id)
+        source = self._moved(account_id, shard)
+        if source is not None:  # History first: once the account moved, new entries are written on its new node
+            for key in (*keys, LEDGER_KEY.format(account_id), account_id):
+                move_key(source, self.clients[shard], key)
+        return self.stores[shard]
+
+    def _group(self, account_ids):
+        """Positions of the account IDs per shard"""
+        groups = defaultdict(list)
+        for i, account_id in enumerate(account_ids):
+            groups[self.ring.shard_for(account_id)].append(i)
+        return groups
+
+    def get(self, account_id):
+        """Returns the account with its balance in dollars, or None if it does not exist"""
+        return self._route(account_id).get(account_id)
+
+    def get_many(self, account_ids):
+        """Returns the accounts (None for missing ones) in order, one round trip per shard involved"""
+        accounts = [None] * len(account_ids)
+        for shard, positions in self._group(account_ids).items():
+            for i in positions:
+                if self._moved(account_ids[i], shard) is not None:
+                    self._route(account_ids[i])
+            for i, account in zip(positions, self.stores[shard].get_many([account_ids[i] for i in positions])):
+                accounts[i] = account
+        return accounts
+
+    def create(self, account_id, account_type):
+        """Creates a new account with a zero balance on its shard"""
+        return self._route(account_id).create(account_id, account_type)
+
+    def transactions(self, account_id, since="", count=100, newest_first=False):
+        """Returns ledger entries of the account, kept on the account's shard"""
+        return self._route(account_id).transactions(account_id, since, count, newest_first)
+
+    def apply(self, op, account_id, value, request_id=""):
+        """Applies a deposit, withdraw or calculate_interest operation on the account's shard"""
+        return self._route(account_id, *request_keys(account_id, [request_id])).apply(op, account_id, value, request_id)
+
+    def apply_combined(self, account_id, operations):
+        """Applies (op, value, request_id) operations to one account as one atomic update on its shard"""
+        keys = request_keys(account_id, [request_id for _, _, request_id in operations])
+        return self._route(account_id, *keys).apply_combined(account_id, operations)
+
+    def apply_many(self, operations):
+        """Applies (op, account_id, value, request_id) operations with one pipelined round trip per shard involved"""
+        results = [None] * len(operations)
+        for shard, positions in self._group([operation[1] for operation in operations]).items():
+            for i in positions:
+                if self._moved(operations[i][1], shard) is not None:
+                    self._route(operations[i][1], *request_keys(operations[i][1], [operations[i][3]]))
+            for i, result in zip(positions, self.stores[shard].apply_many([operations[i] for i in positions])):
+                results[i] = result
+        return results
+
+    def transfer(self, from_account_id, to_account_id, amount, request_id=""):
+        """Moves an amount in dollars between two accounts
+
+        Accounts on the same node (e.g. sharing a {hash tag}) move in one script.
+        Otherwise the source is debited and the transfer recorded (prepare), the
+        destination credits it once (credit), and the source commits or refunds
+        it (finish). Every step is idempotent, so recover_transfers() can finish
+        transfers interrupted by a crash, and a retried request ID replays them.
+        """
+        transfer = transfer_id(from_account_id, request_id)
+        source = self._route(from_account_id, TRANSFER_KEY.format(transfer), *request_keys(from_account_id, [request_id]))
+        target = self._route(to_account_id, TRANSFER_DECISION_KEY.format(transfer))
+        if source is target:
+            return source.transfer(from_account_id, to_account_id, amount, request_id)
+
+        units = source._units("transfer", amount)
+        if units <= 0:
+            return "INVALID_AMOUNT", None
+        status, balance = source.prepare_transfer(transfer, from_account_id, to_account_id, repr(units))
+        if status != "OK":
+            return status, None
+        decision = target.credit_transfer(transfer, from_account_id, to_account_id, repr(units))
+        source.finish_transfer(transfer, from_account_id, decision)
+        if decision == "rejected":  # Destination does not exist, the source was refunded
+            return "NOT_FOUND", None
+        return status, balance
+
+    def recover_transfers(self, min_age=RECOVERY_AGE):
+        """Finishes transfers between shards left prepared for over min_age seconds, returns how many
+
+        Nodes removed by a running rebalance are scanned too. A record left
+        on the previous owner of its source account is pulled to the current
+        one, with the account, before the transfer is finished there.
+        """
+        recovered = 0
+        for node in self.stores + self.previous_stores:
+            for transfer_id, record in node.pending_transfers(min_age):
+                source = self._route(record["from"], TRANSFER_KEY.format(transfer_id))
+                target = self._route(record["to"], TRANSFER_DECISION_KEY.format(transfer_id))
+                decision = target.credit_transfer(transfer_id, record["from"], record["to"], record["amount"])
+                source.finish_transfer(transfer_id, record["from"], decision)
+                recovered += 1
+        return recovered
+
+    def scan_accounts(self, cursor=0, count=1000, match=None):
+        """SCANs the shards one after another, cursors are (shard, shard cursor) pairs"""
+        shard, shard_cursor = cursor or (0, 0)
+        shard_cursor, keys = self.stores[shard].scan_accounts(shard_cursor, count, match)
+        return (shard, shard_cursor), keys
+
+    def iter_accounts(self, batch_size=1000, match=None):
+        """Yields the accounts of every shard, one shard after another"""
+        for store in self.stores:
+            yield from store.iter_accounts(batch_size, match)
+
+    def put_many(self, accounts):
+        """Writes (account_id, Account) records with one pipelined round trip per shard involved"""
+        accounts = list(accounts)
+        for shard, positions in self._group([account_id for account_id, _ in accounts]).items():
+            self.stores[shard].put_many([accounts[i] for i in positions])
+
+    def _shard_positions(self, position):
+        """Each shard's balance index position from a decoded page token, None for the start"""
+        if position is None:
+            return [None] * len(self.stores)
+        if len(position[1]) != len(self.stores):
+            raise ValueError("Page token of another shard list")
+        return position[1]
+
+    def _next_shard(self, shard, token):
+        """Position after a page of one shard's listing: the rest of that shard, then the next shard, or None at the end"""
+        if token:
+            return ["shards", shard, token]
+        return ["shards", shard + 1, ""] if shard + 1 < len(self.stores) else None
+
+    def list_accounts(self, query, page_token="", count=1000):
+        """Returns the accounts passing an AccountFilter among the next count of every shard, and the next page's token
+
+        Balance bounds merge the shards' balance indexes into one balance order,
+        the token holding each shard's position. Other listings go through the
+        shards one after another. Accounts still waiting to be moved by a
+        running rebalance are listed once they are.
+        """
+        if has_balance_bounds(query):
+            position = decode_page_token(page_token, "merged")
+            low, high = self.stores[0]._unit_bounds(query)
+            positions = self._shard_positions(position)
+            pages = [store._balance_entries(low, high, after, count) for store, after in zip(self.stores, positions)]
+            entries, positions, more = merge_balance_entries(pages, positions, count)
+            keys = [member for member, _ in entries]
+            return matching_accounts(query, keys, self.get_many(keys)), encode_page_token(["merged", positions] if more else None)
+
+        position = decode_page_token(page_token, "shards")
+        shard, token = position[1:] if position else (0, "")
+        if not isinstance(shard, int) or not 0 <= shard < len(self.stores):
+            raise ValueError("Page token of another shard list")
+        accounts, token = self.stores[shard].list_accounts(query, token, count)
+        return accounts, encode_page_token(self._next_shard(shard, token))
+
+    def _accrual_progress(self, run_id, rates, progress):
+        """Combines the accrual progress of every shard, the cursor points into the first unfinished one"""
+        pending = next((shard for shard, p in enumerate(progress) if not p["done"]), None)
+        return {
+            "run_id": run_id,
+            "cursor": (pending, progress[pending]["cursor"]) if pending is not None else (0, 0),
+            "scanned": sum(p["scanned"] for p in progress),
+            "credited": sum(p["credited"] for p in progress),
+            "skipped": sum(p["skipped"] for p in progress),
+            "done": pending is None,
+            "rates": next((p["rates"] for p in progress if p["rates"] != rates), rates),  # Any mismatch is reported
+        }
+
+    def start_accrual(self, run_id, rates):
+        """Records the rates of an accrual run on every shard and returns the combined progress"""
+        return self._accrual_progress(run_id, rates, [store.start_accrual(run_id, rates) for store in self.stores])
+
+    def accrue_chunk(self, run_id, keys, next_cursor, rates):
+        """Credits a chunk scanned from one shard, recording that shard's progress"""
+        shard, shard_cursor = next_cursor
+        return self.stores[shard].accrue_chunk(run_id, keys, shard_cursor, rates)
+
+class AsyncShardedStore(ShardedStore):
+    """ShardedStore on redis.asyncio clients, call connect() before use"""
+
+    def __init__(self, clients, layout="json", previous_clients=None):
+        """Initialize one AsyncRedisStore per node"""
+        self.ring = HashRing(clients)
+        self.clients = list(clients.values())
+        self.stores = [AsyncRedisStore(client, layout) for client in self.clients]
+        self.layout = self.stores[0].layout
+        self.exec_mode = "script"
+        self.previous_ring = HashRing(previous_clients) if previous_clients else None
+        self.previous_clients = previous_clients
+        self.previous_stores = [AsyncRedisStore(client, layout) for node, client in (previous_clients or {}).items() if node not in clients]
+
+    async def connect(self):
+        """Pre-registers the Lua scripts on every node"""
+        for store in self.stores + self.previous_stores:
+            await store.connect()
+
+    async def _route(self, account_id, *keys):
+        """Store that owns an account, pulling it (and its bookkeeping keys) from its previous owner first if needed"""
+        shard = self.ring.shard_for(account_id)
+        source = self._moved(account_id, shard)
+        if source is not None:
+            for key in (*keys, LEDGER_KEY.format(account_id), account_id):
+                await move_key_async(source, self.clients[shard], key)
+        return self.stores[shard]
+
+    async def get(self, account_id):
+        """Returns the account with its balance in dollars, or None if it does not exist"""
+        return await (await self._route(account_id)).get(account_id)
+
+    async def get_many(self, account_ids):
+        """Returns the accounts (None for missing ones) in order, one round trip per shard involved"""
+        accounts = [None] * len(account_ids)
+        for shard, positions in self._group(account_ids).items():
+            for i in positions:
+                if self._moved(account_ids[i], shard) is not None:
+                    await self._route(account_ids[i])
+            for i, account in zip(positions, await self.stores[shard].get_many([account_ids[i] for i in positions])):
+                accounts[i] = account
+        return accounts
+
+    async def create(self, account_id, account_type):
+        """Creates a new account with a zero balance on its shard"""
+        return await (await self._route(account_id)).create(account_id, account_type)
+
+    async def transactions(self, account_id, since="", count=100, newest_first=False):
+        """Returns ledger entries of the account, kept on the account's shard"""
+        return await (await self._route(account_id)).transactions(account_id, since, count, newest_first)
+
+    async def apply(self, op, account_id, value, request_id=""):
+        """Applies a deposit, withdraw or calculate_interest operation on the account's shard"""
+        return await (await self._route(account_id, *request_keys(account_id, [request_id]))).apply(op, account_id, value, request_id)
+
+    async def apply_many(self, operations):
+        """Applies (op, account_id, value, request_id) operations with one pipelined round trip per shard involved"""
+        results = [None] * len(operations)
+        for shard, positions in self._group([operation[1] for operation in operations]).items():
+            for i in positions:
+                if self._moved(operations[i][1], shard) is not None:
+                    await self._route(operations[i][1], *request_keys(operations[i][1], [operations[i][3]]))
+            for i, result in zip(positions, await self.stores[shard].apply_many([operations[i] for i in positions])):
+                results[i] = result
+        return results
+
+    async def transfer(self, from_account_id, to_account_id, amount, request_id=""):
+        """Moves an amount in dollars between two accounts, see ShardedStore.transfer()"""
+        transfer = transfer_id(from_account_id, request_id)
+        source = await self._route(from_account_id, TRANSFER_KEY.format(transfer), *request_keys(from_account_id, [request_id]))
+        target = await self._route(to_account_id, TRANSFER_DECISION_KEY.format(transfer))
+        if source is target:
+            return await source.transfer(from_account_id, to_account_id, amount, request_id)
+
+        units = source._units("transfer", amount)
+        if units <= 0:
+            return "INVALID_AMOUNT", None
+        status, balance = await source.prepare_transfer(transfer, from_account_id, to_account_id, repr(units))
+        if status != "OK":
+            return status, None
+        decision = await target.credit_transfer(transfer, from_account_id, to_account_id, repr(units))
+        await source.finish_transfer(transfer, from_account_id, decision)
+        if decision == "rejected":
+            return "NOT_FOUND", None
+        return status, balance
+
+    async def recover_transfers(self, min_age=RECOVERY_AGE):
+        """Finishes transfers between shards left prepared for over min_age seconds, returns how many"""
+        recovered = 0
+        for node in self.stores + self.previous_stores:
+            for transfer_id, record in await node.pending_transfers(min_age):
+                source = await self._route(record["from"], TRANSFER_KEY.format(transfer_id))
+                target = await self._route(record["to"], TRANSFER_DECISION_KEY.format(transfer_id))
+                decision = await target.credit_transfer(transfer_id, record["from"], record["to"], record["amount"])
+                await source.finish_transfer(transfer_id, record["from"], decision)
+                recovered += 1
+        return recovered
+
+    async def scan_accounts(self, cursor=0, count=1000, match=None):
+        """SCANs the shards one after another, cursors are (shard, shard cursor) pairs"""
+        shard, shard_cursor = cursor or (0, 0)
+        shard_cursor, keys = await self.stores[shard].scan_accounts(shard_cursor, count, match)
+        return (shard, shard_cursor), keys
+
+    async def iter_accounts(self, batch_size=1000, match=None):
+        """Yields the accounts of every shard, one shard after another"""
+        for store in self.stores:
+            async for batch in store.iter_accounts(batch_size, match):
+                yield batch
+
+    async def list_accounts(self, query, page_token="", count=1000):
+        """Returns the accounts passing an AccountFilter among the next count of every shard, see ShardedStore.list_accounts()"""
+        if has_balance_bounds(query):
+            position = decode_page_token(page_token, "merged")
+            low, high = self.stores[0]._unit_bounds(query)
+            positions = self._shard_positions(position)
+            pages = [await store._balance_entries(low, high, after, count) for store, after in zip(self.stores, positions)]
+            entries, positions, more = merge_balance_entries(pages, positions, count)
+            keys = [member for member, _ in entries]
+            return matching_accounts(query, keys, await self.get_many(keys)), encode_page_token(["merged", positions] if more else None)
+
+        position = decode_page_token(page_token, "shards")
+        shard, token = position[1:] if position else (0, "")
+        if not isinstance(shard, int) or not 0 <= shard < len(self.stores):
+            raise ValueError("Page token of another shard list")
+        accounts, token = await self.stores[shard].list_accounts(query, token, count)
+        return accounts, encode_page_token(self._next_shard(shard, token))
+
+    async def start_accrual(self, run_id, rates):
+        """Records the rates of an accrual run on every shard and returns the combined progress"""
+        return self._accrual_progress(run_id, rates, [await store.start_accrual(run_id, rates) for store in self.stores])
+
+    async def accrue_chunk(self, run_id, keys, next_cursor, rates):
+        """Credits a chunk scanned from one shard, recording that shard's progress"""
+        shard, shard_cursor = next_cursor
+        return await self.stores[shard].accrue_chunk(run_id, keys, shard_cursor, rates)
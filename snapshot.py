@@ -0,0 +1,151 @@
+"""
+bankRPC - Distributed Banking
+By: Imesh Nimsitha
+2025/02/05
+Snapshot.py Account Snapshot Export and Import
+"""
+
+from os import getenv
+import bank_pb2_grpc
+import bank_pb2
+from redis_pool import add_redis_arguments, create_client, create_shard_clients, redis_options
+from storage import LAYOUTS, Account, RedisStore
+import argparse
+import struct
+import gzip
+import time
+import grpc
+
+MAGIC = b"BANKRPC-SNAPSHOT 1\n"  # First bytes of the uncompressed stream
+FRAME = struct.Struct("<I")  # Length prefix of each serialized AccountsChunk
+BATCH_SIZE = 1000  # Accounts per SCAN batch, chunk and pipelined write
+COMPRESS_LEVEL = 1  # gzip level, higher levels cost far more CPU than they save on balances
+
+# A snapshot file is a gzip stream of MAGIC followed by frames: a little-endian
+# uint32 length, then an AccountsChunk (bank.proto) of that many bytes. Chunks are
+# written as they are scanned and read back one at a time, so memory use does not
+# depend on the number of accounts, and ExportAccounts' messages are stored as is.
+
+def account_snapshots(batch):
+    """AccountSnapshot messages for a list of (account_id, Account) with balances in dollars"""
+    return [
+        bank_pb2.AccountSnapshot(account_id=account_id, account_type=account.account_type, balance=account.balance,
+                                 last_accrual=account.last_accrual or "")
+        for account_id, account in batch
+    ]
+
+def accounts_chunk(batch):
+    """AccountsChunk message for a list of (account_id, Account) with balances in dollars"""
+    return bank_pb2.AccountsChunk(accounts=account_snapshots(batch))
+
+def chunk_accounts(chunk):
+    """(account_id, Account) records of an AccountsChunk"""
+    return [(record.account_id, Account(record.account_type, record.balance, record.last_accrual or None)) for record in chunk.accounts]
+
+class SnapshotWriter:
+    """Writes AccountsChunk frames to a compressed snapshot file"""
+
+    def __init__(self, path, compresslevel=COMPRESS_LEVEL):
+        """Initialize writer, the file is replaced"""
+        self.file = gzip.open(path, "wb", compresslevel=compresslevel)
+        self.file.write(MAGIC)
+        self.accounts = 0
+
+    def write(self, chunk):
+        """Appends one AccountsChunk"""
+        data = chunk.SerializeToString()
+        self.file.write(FRAME.pack(len(data)))
+        self.file.write(data)
+        self.accounts += len(chunk.accounts)
+
+    def close(self):
+        """Flushes and closes the file"""
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+def read_snapshot(path):
+    """Yields the AccountsChunks of a snapshot file one at a time, raises ValueError on a damaged file"""
+    with gzip.open(path, "rb") as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{path} is not a bankRPC snapshot")
+        try:
+            while True:
+                header = f.read(FRAME.size)
+                if not header:
+                    return
+                if len(header) < FRAME.size:
+                    raise EOFError
+                (size,) = FRAME.unpack(header)
+                data = f.read(size)
+                if len(data) < size:
+                    raise EOFError
+                yield bank_pb2.AccountsChunk.FromString(data)
+        except EOFError as e:  # Also raised by gzip on a cut-off stream
+            raise ValueError(f"{path} is truncated") from e
+
+def export_store(store, path, batch_size=BATCH_SIZE, match=None):
+    """Writes every account of a store to a snapshot file, returns the number exported"""
+    with SnapshotWriter(path) as writer:
+        for batch in store.iter_accounts(batch_size, match):
+            writer.write(accounts_chunk(batch))
+    return writer.accounts
+
+def export_server(address, path, batch_size=BATCH_SIZE, match=None):
+    """Writes every account served by the ExportAccounts RPC to a snapshot file, returns the number exported"""
+    with grpc.insecure_channel(address) as channel, SnapshotWriter(path) as writer:
+        stub = bank_pb2_grpc.BankServiceStub(channel)
+        for chunk in stub.ExportAccounts(bank_pb2.ExportRequest(batch_size=batch_size, match=match or "")):
+            writer.write(chunk)
+    return writer.accounts
+
+def import_store(store, path):
+    """Writes every account of a snapshot file to a store, one pipelined write per chunk, returns the number imported
+
+    Accounts already in the store are replaced, others are left alone.
+    """
+    imported = 0
+    for chunk in read_snapshot(path):
+        store.put_many(chunk_accounts(chunk))
+        imported += len(chunk.accounts)
+    return imported
+
+def open_store(args):
+    """Store the command works on directly: Redis (sharded with --redis-shards) or a sqlite engine file"""
+    if args.engine == "sqlite":
+        from sqlite_store import SqliteStore
+        return SqliteStore(args.sqlite_path, args.storage)
+    options = redis_options(args)
+    shard_clients, _ = create_shard_clients(options)
+    if shard_clients:
+        from sharding import ShardedStore
+        return ShardedStore(shard_clients, args.storage, "script")
+    return RedisStore(create_client(options), args.storage, "script")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Export all accounts to a snapshot file, or import one")
+    parser.add_argument("command", choices=("export", "import"), help="Direction")
+    parser.add_argument("path", help="Snapshot file")
+    parser.add_argument("--server", help="Export through the ExportAccounts RPC on this server instead of reading storage directly")
+    parser.add_argument("--engine", choices=("redis", "sqlite"), default=getenv("STORAGE_ENGINE", "redis"), help="Storage read or written directly")
+    parser.add_argument("--sqlite-path", default=getenv("SQLITE_PATH", "bankrpc.db"), help="Database file of the sqlite engine")
+    parser.add_argument("--storage", choices=LAYOUTS, default=getenv("ACCOUNT_STORAGE", "json"), help="Account storage layout")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE, help="Accounts per SCAN batch and chunk")
+    parser.add_argument("--match", help="Export: only account IDs matching this glob pattern")
+    add_redis_arguments(parser)
+    args = parser.parse_args()
+    if args.server and args.command == "import":
+        parser.error("import writes to storage directly, --server only applies to export")
+
+    start = time.perf_counter()
+    if args.command == "export":
+        count = export_server(args.server, args.path, args.batch_size, args.match) if args.server else \
+            export_store(open_store(args), args.path, args.batch_size, args.match)
+    else:
+        count = import_store(open_store(args), args.path)
+    elapsed = time.perf_counter() - start
+    print(f"{args.command.capitalize()}ed {count} accounts in {elapsed:.1f}s ({count / elapsed if elapsed else 0:.0f}/s).")
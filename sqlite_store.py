@@ -0,0 +1,440 @@
+"""
+bankRPC - Distributed Banking
+By: Imesh Nimsitha
+2025/02/05
+Sqlite_store.py Durable SQLite Storage Engine
+"""
+
+from storage import IDEMPOTENCY_TTL, LAYOUTS, LEDGER_OPS, Account, Store, Transaction, decode_page_token, encode_page_token, ledger_maxlen
+from metrics import COMMIT_DURATION, GROUP_COMMIT_SIZE
+from os import getenv
+import json
+import queue
+import sqlite3
+import threading
+import time
+
+SQLITE_PATH = "bankrpc.db"  # Default database file, $SQLITE_PATH overrides it
+COMMIT_WINDOW = 0.0  # Default seconds a group commit waits for more mutations, $COMMIT_WINDOW overrides it
+MAX_GROUP = 1000  # Mutations per commit at most
+PURGE_EVERY = 1000  # Commits between deletions of expired request IDs
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS accounts (
+    account_id TEXT NOT NULL UNIQUE,
+    account_type TEXT NOT NULL,
+    balance NUMERIC NOT NULL,
+    last_accrual TEXT
+);
+CREATE INDEX IF NOT EXISTS accounts_type ON accounts (account_type, balance, account_id);
+CREATE INDEX IF NOT EXISTS accounts_balance ON accounts (balance, account_id);
+CREATE TABLE IF NOT EXISTS ledger (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    account_id TEXT NOT NULL,
+    ms INTEGER NOT NULL,
+    op TEXT NOT NULL,
+    amount NUMERIC NOT NULL,
+    balance NUMERIC NOT NULL,
+    ref TEXT NOT NULL DEFAULT ''
+);
+CREATE INDEX IF NOT EXISTS ledger_account ON ledger (account_id, id);
+CREATE TABLE IF NOT EXISTS requests (
+    account_id TEXT NOT NULL,
+    request_id TEXT NOT NULL,
+    fingerprint TEXT NOT NULL,
+    balance NUMERIC NOT NULL,
+    expires REAL NOT NULL,
+    PRIMARY KEY (account_id, request_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS requests_expires ON requests (expires);
+CREATE TABLE IF NOT EXISTS accruals (
+    run_id TEXT PRIMARY KEY,
+    rates TEXT NOT NULL,
+    cursor INTEGER NOT NULL DEFAULT 0,
+    scanned INTEGER NOT NULL DEFAULT 0,
+    credited INTEGER NOT NULL DEFAULT 0,
+    skipped INTEGER NOT NULL DEFAULT 0,
+    done INTEGER NOT NULL DEFAULT 0
+);
+"""
+
+class _Job:
+    """A mutation waiting for its group commit"""
+
+    __slots__ = ("fn", "args", "result", "error", "done")
+
+    def __init__(self, fn, args):
+        self.fn = fn
+        self.args = args
+        self.result = self.error = None
+        self.done = threading.Event()
+
+class SqliteStore(Store):
+    """Durable embedded storage engine on SQLite, with group commit
+
+    The database runs in WAL mode with synchronous=FULL, so a mutation is on
+    disk (fsync'd) before its caller gets a reply. Mutations are queued to
+    one writer thread, which applies every mutation waiting (for up to
+    commit_window more seconds, at most MAX_GROUP) in one transaction and
+    commits them with a single fsync. Each runs in its own savepoint, so one
+    failing does not undo the others. Reads use a connection per thread and
+    see committed data only. After a crash SQLite rolls back the commit that
+    was in progress when the database is opened again: every acknowledged
+    mutation is kept and no unacknowledged one is half applied.
+    """
+
+    def __init__(self, path=None, layout="json", commit_window=None, ledger=True):
+        """Opens (or creates) the database and starts the writer thread"""
+        if layout not in LAYOUTS:
+            raise ValueError(f"Unknown storage layout: {layout}")
+        self.path = path or getenv("SQLITE_PATH", SQLITE_PATH)
+        self.layout = LAYOUTS[layout]()
+        self.exec_mode = "sqlite"
+        self.commit_window = float(getenv("COMMIT_WINDOW", COMMIT_WINDOW)) if commit_window is None else commit_window
+        self.ledger_maxlen = ledger_maxlen() if ledger else None
+        self.idempotency_ttl = int(getenv("IDEMPOTENCY_TTL", IDEMPOTENCY_TTL))
+        self.commits = self.committed = 0  # Transactions and mutations committed
+
+        self._writer = self._connect()
+        self._writer.executescript(SCHEMA)
+        self._writer.execute("PRAGMA wal_checkpoint(TRUNCATE)")  # Fold the WAL left by a previous run into the database
+        self._readers = threading.local()
+        self._touched = set()  # Accounts with new ledger entries in the running transaction
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._write_loop, name="sqlite-group-commit", daemon=True)
+        self._thread.start()
+
+    def _connect(self):
+        """Opens a connection in autocommit mode (transactions are explicit)"""
+        connection = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=FULL")  # fsync the WAL on every commit
+        connection.execute("PRAGMA busy_timeout=5000")
+        return connection
+
+    def _reader(self):
+        """This thread's read connection"""
+        connection = getattr(self._readers, "connection", None)
+        if connection is None:
+            connection = self._readers.connection = self._connect()
+        return connection
+
+    def close(self):
+        """Commits what is queued, then stops the writer"""
+        self._queue.put(None)
+        self._thread.join()
+        self._writer.close()
+
+    def _submit(self, fn, *args):
+        """Queues a mutation for the writer and returns the job"""
+        job = _Job(fn, args)
+        self._queue.put(job)
+        return job
+
+    def _wait(self, job):
+        """Blocks until the job's group is committed, returns its result"""
+        job.done.wait()
+        if job.error is not None:
+            raise job.error
+        return job.result
+
+    def _write(self, fn, *args):
+        """Runs fn(connection, *args) in the next group commit and returns its result once it is durable"""
+        return self._wait(self._submit(fn, *args))
+
+    def _write_loop(self):
+        """Writer thread: applies queued mutations in groups, one transaction and fsync per group"""
+        stopping = False
+        while not stopping:
+            job = self._queue.get()
+            if job is None:
+                return
+            group = [job]
+            deadline = time.monotonic() + self.commit_window
+            while len(group) < MAX_GROUP:
+                try:
+                    job = self._queue.get(timeout=max(0.0, deadline - time.monotonic())) if self.commit_window else self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if job is None:  # Commit the group, then stop
+                    stopping = True
+                    break
+                group.append(job)
+            self._commit(group)
+
+    def _commit(self, group):
+        """Applies a group of jobs in one transaction, each in a savepoint"""
+        start = time.perf_counter()
+        connection = self._writer
+        try:
+            connection.execute("BEGIN IMMEDIATE")
+            for job in group:
+                connection.execute("SAVEPOINT job")
+                try:
+                    job.result = job.fn(connection, *job.args)
+                    connection.execute("RELEASE job")
+                except Exception as e:
+                    connection.execute("ROLLBACK TO job")
+                    connection.execute("RELEASE job")
+                    job.error = e
+            self._trim_ledgers(connection)
+            self.commits += 1
+            if self.commits % PURGE_EVERY == 0:
+                connection.execute("DELETE FROM requests WHERE expires < ?", (time.time(),))
+            connection.execute("COMMIT")  # The group's single fsync
+            self.committed += len(group)
+        except sqlite3.Error as e:  # Disk full, I/O error...: nothing in the group was committed
+            if connection.in_transaction:
+                connection.execute("ROLLBACK")
+            for job in group:
+                job.error = e
+        finally:
+            self._touched.clear()
+        GROUP_COMMIT_SIZE.observe(len(group))
+        COMMIT_DURATION.observe(time.perf_counter() - start)
+        for job in group:
+            job.done.set()
+
+    def _trim_ledgers(self, connection):
+        """Keeps the last ledger_maxlen entries of the accounts written in this group"""
+        if not self.ledger_maxlen:
+            return
+        for account_id in self._touched:
+            connection.execute("DELETE FROM ledger WHERE account_id = ? AND id <= "
+                               "(SELECT id FROM ledger WHERE account_id = ? ORDER BY id DESC LIMIT 1 OFFSET ?)",
+                               (account_id, account_id, self.ledger_maxlen))
+
+    def _record(self, connection, account_id, op, amount, balance, ref=""):
+        """Inserts a ledger entry in the running transaction"""
+        if self.ledger_maxlen is None:
+            return
+        connection.execute("INSERT INTO ledger (account_id, ms, op, amount, balance, ref) VALUES (?, ?, ?, ?, ?, ?)",
+                           (account_id, int(time.time() * 1000), op, amount, balance, ref))
+        self._touched.add(account_id)
+
+    def _replay(self, connection, account_id, request_id, fingerprint):
+        """Outcome of a request ID already applied to the account, or None"""
+        if not request_id:
+            return None
+        saved = connection.execute("SELECT fingerprint, balance FROM requests WHERE account_id = ? AND request_id = ? AND expires >= ?",
+                                   (account_id, request_id, time.time())).fetchone()
+        if saved is None:
+            return None
+        if saved[0] != fingerprint:
+            return "REQUEST_ID_REUSED", None
+        return "OK", self.layout.from_units(saved[1])
+
+    def _remember(self, connection, account_id, request_id, fingerprint, balance):
+        """Remembers an applied request ID for idempotency_ttl seconds"""
+        if request_id:
+            connection.execute("INSERT OR REPLACE INTO requests VALUES (?, ?, ?, ?, ?)",
+                               (account_id, request_id, fingerprint, balance, time.time() + self.idempotency_ttl))
+
+    def _load(self, connection, account_id):
+        """Reads an account (balance in units), or None"""
+        row = connection.execute("SELECT account_type, balance, last_accrual FROM accounts WHERE account_id = ?", (account_id,)).fetchone()
+        return Account(*row) if row else None
+
+    def get(self, account_id):
+        """Returns the account with its balance in dollars, or None if it does not exist"""
+        account = self._load(self._reader(), account_id)
+        return account._replace(balance=self.layout.from_units(account.balance)) if account else None
+
+    def get_many(self, account_ids):
+        """Returns the accounts (None for missing ones) in order, read in one query"""
+        if not account_ids:
+            return []
+        found = {}
+        for start in range(0, len(account_ids), 500):  # Stay under SQLite's bound parameter limit
+            chunk = account_ids[start:start + 500]
+            rows = self._reader().execute("SELECT account_id, account_type, balance, last_accrual FROM accounts WHERE account_id IN "
+                                          f"({','.join('?' * len(chunk))})", chunk)
+            for account_id, account_type, balance, last_accrual in rows:
+                found[account_id] = Account(account_type, self.layout.from_units(balance), last_accrual)
+        return [found.get(account_id) for account_id in account_ids]
+
+    def _create(self, connection, account_id, account_type):
+        """Writer side of create()"""
+        if connection.execute("SELECT 1 FROM accounts WHERE account_id = ?", (account_id,)).fetchone():
+            return "EXISTS", None
+        connection.execute("INSERT INTO accounts (account_id, account_type, balance) VALUES (?, ?, ?)",
+                           (account_id, account_type, self.layout.to_units(0)))
+        return "OK", 0.0
+
+    def create(self, account_id, account_type):
+        """Creates a new account with a zero balance"""
+        return self._write(self._create, account_id, account_type)
+
+    def _units(self, op, value):
+        """Converts an operation's value to balance units (interest rates are kept as is)"""
+        return value if op == "calculate_interest" else self.layout.to_units(value)
+
+    def _apply(self, connection, op, account_id, value, request_id):
+        """Writer side of apply(), value in units"""
+        fingerprint = f"{LEDGER_OPS[op]}:{account_id}:{value!r}"  # Same format as RedisStore
+        saved = self._replay(connection, account_id, request_id, fingerprint)
+        if saved:
+            return saved
+        account = self._load(connection, account_id)
+        if account is None:
+            return "NOT_FOUND", None
+
+        if op == "deposit":
+            delta = value
+        elif op == "withdraw":
+            if account.balance < value:
+                return "INSUFFICIENT_FUNDS", None
+            delta = -value
+        else:
+            delta = self.layout.interest(account.balance, value)
+        balance = account.balance + delta
+        connection.execute("UPDATE accounts SET balance = ? WHERE account_id = ?", (balance, account_id))
+        self._record(connection, account_id, LEDGER_OPS[op], value if op != "calculate_interest" else delta, balance)
+        self._remember(connection, account_id, request_id, fingerprint, balance)
+        return "OK", self.layout.from_units(balance)
+
+    def apply(self, op, account_id, value, request_id=""):
+        """Applies a deposit, withdraw or calculate_interest operation once it is durable"""
+        value = self._units(op, value)
+        if value <= 0:
+            return "INVALID_AMOUNT", None
+        return self._write(self._apply, op, account_id, value, request_id)
+
+    def apply_many(self, operations):
+        """Applies (op, account_id, value, request_id) operations, queued together so they share group commits"""
+        jobs = []
+        for op, account_id, value, request_id in operations:
+            value = self._units(op, value)
+            jobs.append(self._submit(self._apply, op, account_id, value, request_id) if value > 0 else None)
+        return [self._wait(job) if job else ("INVALID_AMOUNT", None) for job in jobs]
+
+    def apply_combined(self, account_id, operations):
+        """Applies (op, value, request_id) operations to one account, queued together so they share group commits"""
+        return self.apply_many([(op, account_id, value, request_id) for op, value, request_id in operations])
+
+    def _transfer(self, connection, from_account_id, to_account_id, value, request_id):
+        """Writer side of transfer(), value in units"""
+        fingerprint = f"transfer:{from_account_id}:{to_account_id}:{value!r}"
+        saved = self._replay(connection, from_account_id, request_id, fingerprint)
+        if saved:
+            return saved
+        source, target = self._load(connection, from_account_id), self._load(connection, to_account_id)
+        if source is None or target is None:
+            return "NOT_FOUND", None
+        if source.balance < value:
+            return "INSUFFICIENT_FUNDS", None
+
+        connection.execute("UPDATE accounts SET balance = ? WHERE account_id = ?", (target.balance + value, to_account_id))
+        self._record(connection, to_account_id, "transfer_in", value, target.balance + value, from_account_id)
+        balance = source.balance - value
+        connection.execute("UPDATE accounts SET balance = ? WHERE account_id = ?", (balance, from_account_id))
+        self._record(connection, from_account_id, "transfer_out", value, balance, to_account_id)
+        self._remember(connection, from_account_id, request_id, fingerprint, balance)
+        return "OK", self.layout.from_units(balance)
+
+    def transfer(self, from_account_id, to_account_id, amount, request_id=""):
+        """Moves an amount in dollars between two accounts in one transaction"""
+        value = self._units("transfer", amount)
+        if value <= 0:
+            return "INVALID_AMOUNT", None
+        return self._write(self._transfer, from_account_id, to_account_id, value, request_id)
+
+    def transactions(self, account_id, since="", count=100, newest_first=False):
+        """Returns up to count ledger entries of the account after the since cursor (an entry ID), oldest first by default"""
+        query = "SELECT id, ms, op, amount, balance, ref FROM ledger WHERE account_id = ?"
+        params = [account_id]
+        if since:
+            ms, _, seq = since.partition("-")
+            column, bound = ("id", int(seq)) if seq else ("ms", int(ms))  # Entry IDs are ms-id
+            query += f" AND {column} {'<' if newest_first else '>'} ?"
+            params.append(bound)
+        query += f" ORDER BY id {'DESC' if newest_first else 'ASC'} LIMIT ?"
+        params.append(count)
+        return [
+            Transaction(f"{ms}-{entry_id}", op, self.layout.from_units(amount), self.layout.from_units(balance), ref)
+            for entry_id, ms, op, amount, balance, ref in self._reader().execute(query, params)
+        ]
+
+    def scan_accounts(self, cursor=0, count=1000, match=None):
+        """Returns the next cursor (0 when done) and the account IDs in that batch, in creation order"""
+        query = "SELECT rowid, account_id FROM accounts WHERE rowid > ?"
+        params = [cursor]
+        if match:
+            query += " AND account_id GLOB ?"
+            params.append(match)
+        rows = self._reader().execute(query + " ORDER BY rowid LIMIT ?", [*params, count]).fetchall()
+        return (rows[-1][0] if len(rows) == count else 0), [account_id for _, account_id in rows]
+
+    def list_accounts(self, query, page_token="", count=1000):
+        """Returns up to count accounts passing an AccountFilter in balance order (then by ID), and the next page's token
+
+        Served by the accounts_type index with a type, accounts_balance without,
+        resuming after the last (balance, account_id) of the previous page.
+        """
+        position = decode_page_token(page_token, "balance")
+        conditions, params = [], []
+        if query.account_type:
+            conditions.append("account_type = ?")
+            params.append(query.account_type)
+        if query.min_balance is not None:
+            conditions.append("balance >= ?")
+            params.append(self.layout.to_units(query.min_balance))
+        if query.max_balance is not None:
+            conditions.append("balance <= ?")
+            params.append(self.layout.to_units(query.max_balance))
+        if position:
+            conditions.append("(balance, account_id) > (?, ?)")
+            params += position[1:3]
+        where = f" WHERE {' AND '.join(conditions)}" if conditions else ""
+        rows = self._reader().execute(f"SELECT account_id, account_type, balance, last_accrual FROM accounts{where} "
+                                      "ORDER BY balance, account_id LIMIT ?", [*params, count]).fetchall()
+        accounts = [(account_id, Account(account_type, self.layout.from_units(balance), last_accrual))
+                    for account_id, account_type, balance, last_accrual in rows]
+        return accounts, encode_page_token(["balance", rows[-1][2], rows[-1][0]] if len(rows) == count else None)
+
+    def _put_many(self, connection, rows):
+        """Writer side of put_many()"""
+        connection.executemany("INSERT INTO accounts (account_id, account_type, balance, last_accrual) VALUES (?, ?, ?, ?) "
+                               "ON CONFLICT (account_id) DO UPDATE SET account_type = excluded.account_type, "
+                               "balance = excluded.balance, last_accrual = excluded.last_accrual", rows)
+
+    def put_many(self, accounts):
+        """Writes (account_id, Account) records as they are in one commit, replacing existing accounts"""
+        rows = [(account_id, account.account_type, self.layout.to_units(account.balance), account.last_accrual) for account_id, account in accounts]
+        self._write(self._put_many, rows)
+
+    def _start_accrual(self, connection, run_id, rates):
+        """Writer side of start_accrual()"""
+        connection.execute("INSERT OR IGNORE INTO accruals (run_id, rates) VALUES (?, ?)", (run_id, json.dumps(rates, sort_keys=True)))
+        rates, cursor, scanned, credited, skipped, done = connection.execute(
+            "SELECT rates, cursor, scanned, credited, skipped, done FROM accruals WHERE run_id = ?", (run_id,)).fetchone()
+        return {"run_id": run_id, "cursor": cursor, "scanned": scanned, "credited": credited, "skipped": skipped,
+                "done": bool(done), "rates": json.loads(rates)}
+
+    def start_accrual(self, run_id, rates):
+        """Records the rates of an accrual run (kept if the run already exists) and returns its progress"""
+        return self._write(self._start_accrual, run_id, rates)
+
+    def _accrue_chunk(self, connection, run_id, keys, next_cursor, rates):
+        """Writer side of accrue_chunk()"""
+        credited = 0
+        for key in keys:
+            account = self._load(connection, key)
+            rate = account and rates.get(str(account.account_type).lower())
+            if not rate or account.last_accrual == run_id:
+                continue
+            earned = self.layout.interest(account.balance, rate)
+            connection.execute("UPDATE accounts SET balance = ?, last_accrual = ? WHERE account_id = ?", (account.balance + earned, run_id, key))
+            self._record(connection, key, "interest", earned, account.balance + earned, run_id)
+            credited += 1
+        connection.execute("UPDATE accruals SET cursor = ?, scanned = scanned + ?, credited = credited + ?, skipped = skipped + ?, done = ? "
+                           "WHERE run_id = ?", (next_cursor, len(keys), credited, len(keys) - credited, int(next_cursor == 0), run_id))
+        return credited
+
+    def accrue_chunk(self, run_id, keys, next_cursor, rates):
+        """Credits interest to a chunk of accounts and records the run's progress in one transaction
+
+        Accounts already credited by this run are skipped, so replaying a chunk is harmless.
+        Returns the number of accounts credited.
+        """
+        return self._write(self._accrue_chunk, run_id, keys, next_cursor, rates)
@@ -0,0 +1,895 @@
+"""
+bankRPC - Distributed Banking
+By: Imesh Nimsitha
+2025/02/05
+Storage.py Account Storage Implementation
+"""
+
+from collections import namedtuple
+from os import getenv
+from metrics import ABORTED, WATCH_RETRIES
+import scripts
+import redis
+import base64
+import json
+import math
+import time
+
+Account = namedtuple("Account", ["account_type", "balance", "last_accrual"], defaults=[None])  # last_accrual: last interest run that credited it
+Transaction = namedtuple("Transaction", ["id", "op", "amount", "balance", "ref"])  # Ledger entry, id is its stream ID
+AccountFilter = namedtuple("AccountFilter", ["account_type", "min_balance", "max_balance"], defaults=[None, None, None])  # ListAccounts query, bounds in dollars
+
+INTERNAL_PREFIX = b"bankrpc:"  # Bookkeeping keys, never account records
+ACCRUAL_KEY = "bankrpc:accrual:{}"  # Progress of an interest accrual run
+TRANSFER_KEY = "bankrpc:transfer:{}"  # Source node's record of a transfer between shards
+TRANSFER_DECISION_KEY = "bankrpc:transfer-decision:{}"  # Destination node's decision on it
+TRANSFER_TTL = 7 * 24 * 3600  # Seconds finished transfer records are kept
+LEDGER_KEY = scripts.LEDGER_PREFIX + "{}"  # Transaction history of an account (a stream on the account's node)
+LEDGER_MAXLEN = 10000  # Default entries kept per account, $LEDGER_MAXLEN overrides it (0 keeps everything)
+LEDGER_OPS = {"deposit": "deposit", "withdraw": "withdraw", "calculate_interest": "interest"}  # Ledger entry type per operation
+IDEMPOTENCY_KEY = scripts.IDEMPOTENCY_PREFIX + "{}:{}"  # Outcome of a request ID applied to an account
+IDEMPOTENCY_TTL = 600  # Default seconds a request ID is remembered, $IDEMPOTENCY_TTL overrides it
+TYPE_INDEX_KEY = scripts.TYPE_INDEX_PREFIX + "{}"  # Set of the account IDs of one account type on a node
+BALANCE_INDEX_KEY = scripts.BALANCE_INDEX_KEY  # Sorted set of a node's account IDs by balance (in layout units)
+
+class JsonLayout:
+    """Original layout: one JSON blob per account with a float balance"""
+
+    name = "json"
+
+    def to_units(self, amount):
+        """Converts an amount in dollars to stored balance units"""
+        return amount
+
+    def from_units(self, units):
+        """Converts stored balance units back to dollars"""
+        return float(units)
+
+    def format_units(self, units):
+        """Balance units as written to the ledger"""
+        return repr(float(units))
+
+    def interest(self, balance, rate):
+        """Interest earned on a balance, in balance units"""
+        return balance * (rate / 100)
+
+    def fetch(self, client, account_id):
+        """Issues the read command for an account (a coroutine on asyncio clients)"""
+        return client.get(account_id)
+
+    def fetch_many(self, client, account_ids, raise_on_error=True):
+        """Issues one MGET for several accounts (keys of other types read as missing)"""
+        return client.mget(account_ids)
+
+    def parse(self, data):
+        """Parses a fetched account (balance in units), or None if it does not exist"""
+        if not data:
+            return None
+        data = json.loads(data)
+        return Account(data['account_type'], data['balance'], data.get('last_accrual'))
+
+    def read(self, client, account_id):
+        """Reads an account (balance in units), or None if it does not exist"""
+        return self.parse(self.fetch(client, account_id))
+
+    def write(self, pipe, account_id, account_type, balance, last_accrual=None):
+        """Queues a full write of the account"""
+        data = {"account_type": account_type, "balance": balance}
+        if last_accrual is not None:
+            data["last_accrual"] = last_accrual
+        pipe.set(account_id, json.dumps(data))
+
+    def credit(self, pipe, account_id, account, delta):
+        """Queues a balance change, the whole record is re-encoded"""
+        self.write(pipe, account_id, account.account_type, account.balance + delta, account.last_accrual)
+
+class HashLayout:
+    """Compact layout: one Redis hash per account with the balance in integer cents"""
+
+    name = "hash"
+
+    def to_units(self, amount):
+        """Converts an amount in dollars to cents (rounding half up)"""
+        return int(math.floor(amount * 100 + 0.5))
+
+    def from_units(self, units):
+        """Converts cents back to dollars"""
+        return units / 100
+
+    def format_units(self, units):
+        """Cents as written to the ledger"""
+        return str(int(units))
+
+    def interest(self, balance, rate):
+        """Interest earned on a balance, rounded half up to the nearest cent"""
+        return int(math.floor(balance * rate / 100 + 0.5))
+
+    def fetch(self, client, account_id):
+        """Issues the read command for an account (a coroutine on asyncio clients)"""
+        return client.hmget(account_id, "account_type", "balance", "last_accrual")
+
+    def fetch_many(self, client, account_ids, raise_on_error=True):
+        """Issues one pipeline of HMGETs for several accounts, raise_on_error=False returns errors (keys of other types) in place"""
+        pipe = client.pipeline(transaction=False)
+        for account_id in account_ids:
+            self.fetch(pipe, account_id)
+        return pipe.execute(raise_on_error=raise_on_error)
+
+    def parse(self, data):
+        """Parses a fetched account (balance in cents), or None if it does not exist"""
+        account_type, balance, last_accrual = data
+        if balance is None:
+            return None
+        return Account(account_type.decode(), int(balance), last_accrual and last_accrual.decode())
+
+    def read(self, client, account_id):
+        """Reads an account (balance in cents), or None if it does not exist"""
+        return self.parse(self.fetch(client, account_id))
+
+    def write(self, pipe, account_id, account_type, balance, last_accrual=None):
+        """Queues a full write of the account"""
+        fields = {"account_type": account_type, "balance": balance}
+        if last_accrual is not None:
+            fields["last_accrual"] = last_accrual
+        pipe.hset(account_id, mapping=fields)
+
+    def credit(self, pipe, account_id, account, delta):
+        """Queues a balance change as a single field update"""
+        pipe.hincrby(account_id, "balance", delta)
+
+LAYOUTS = {
+    "json": JsonLayout,
+    "hash": HashLayout,
+}
+
+def ledger_maxlen():
+    """Entries kept per account ledger, from $LEDGER_MAXLEN"""
+    return int(getenv("LEDGER_MAXLEN", LEDGER_MAXLEN))
+
+def has_balance_bounds(query):
+    """Whether an AccountFilter bounds the balance"""
+    return query.min_balance is not None or query.max_balance is not None
+
+def filter_matches(query, account):
+    """Whether an account (balance in dollars) passes an AccountFilter"""
+    return ((not query.account_type or account.account_type == query.account_type)
+            and (query.min_balance is None or account.balance >= query.min_balance)
+            and (query.max_balance is None or account.balance <= query.max_balance))
+
+def matching_accounts(query, keys, accounts):
+    """(account_id, Account) pairs of the read accounts that exist and pass an AccountFilter"""
+    return [(key.decode() if isinstance(key, bytes) else key, account)
+            for key, account in zip(keys, accounts) if account and filter_matches(query, account)]
+
+def encode_page_token(position):
+    """Opaque ListAccounts page token for a listing position (a JSON list starting with its kind), "" for None"""
+    if position is None:
+        return ""
+    return base64.urlsafe_b64encode(json.dumps(position, separators=(",", ":")).encode()).decode()
+
+def decode_page_token(token, kind):
+    """Listing position of a page token of the given kind, None for "", raises ValueError if it is not one"""
+    if not token:
+        return None
+    try:
+        position = json.loads(base64.urlsafe_b64decode(token.encode()))
+    except ValueError as e:  # Also binascii.Error and UnicodeDecodeError
+        raise ValueError("Invalid page token") from e
+    if not isinstance(position, list) or not position or position[0] != kind:
+        raise ValueError("Page token of another listing")  # E.g. the filter changed between pages
+    return position
+
+class Store:
+    """Storage engine interface under BankService
+
+    Operations return a status string ("OK", "EXISTS", "NOT_FOUND",
+    "INSUFFICIENT_FUNDS", "INVALID_AMOUNT", "REQUEST_ID_REUSED" or "ABORTED")
+    and the new balance in dollars. Every mutation is atomic, and mutations
+    given a request ID apply it at most once: repeating it within the TTL
+    returns the first reply. Engines set layout (balance units) and implement
+    the methods below; batch updates default to one apply() per operation.
+    """
+
+    def get(self, account_id):
+        """Returns the account with its balance in dollars, or None if it does not exist"""
+        raise NotImplementedError
+
+    def get_many(self, account_ids):
+        """Returns the accounts (None for missing ones) in order"""
+        raise NotImplementedError
+
+    def create(self, account_id, account_type):
+        """Creates a new account with a zero balance"""
+        raise NotImplementedError
+
+    def apply(self, op, account_id, value, request_id=""):
+        """Applies a deposit, withdraw or calculate_interest operation (value in dollars, or percent for interest)"""
+        raise NotImplementedError
+
+    def apply_many(self, operations):
+        """Applies (op, account_id, value, request_id) operations, results in order"""
+        return [self.apply(*operation) for operation in operations]
+
+    def apply_combined(self, account_id, operations):
+        """Applies (op, value, request_id) operations to one account, results in order"""
+        return [self.apply(op, account_id, value, request_id) for op, value, request_id in operations]
+
+    def transfer(self, from_account_id, to_account_id, amount, request_id=""):
+        """Moves an amount in dollars between two accounts, returns the source's new balance"""
+        raise NotImplementedError
+
+    def transactions(self, account_id, since="", count=100, newest_first=False):
+        """Returns up to count Transactions of the account after the since cursor (an entry ID), oldest first by default"""
+        raise NotImplementedError
+
+    def scan_accounts(self, cursor=0, count=1000, match=None):
+        """Returns the next cursor (0 when done) and about count account IDs, optionally matching a glob pattern"""
+        raise NotImplementedError
+
+    def iter_accounts(self, batch_size=1000, match=None):
+        """Yields every account (optionally matching a glob pattern) as lists of (account_id, Account), one scan batch at a time"""
+        cursor = 0
+        while True:
+            cursor, keys = self.scan_accounts(cursor, batch_size, match)
+            if keys:
+                batch = self._scanned(keys)
+                if batch:
+                    yield batch
+            if not cursor:
+                return
+
+    def _scanned(self, keys):
+        """(account_id, Account) pairs of scanned keys, without those deleted since the scan"""
+        return [(key.decode() if isinstance(key, bytes) else key, account) for key, account in zip(keys, self.get_many(keys)) if account]
+
+    def put_many(self, accounts):
+        """Writes (account_id, Account) records with balances in dollars as they are, replacing existing accounts"""
+        raise NotImplementedError
+
+    def list_accounts(self, query, page_token="", count=1000):
+        """Returns the accounts passing an AccountFilter among the next count after a page token, and the next page's token
+
+        Accounts come as (account_id, Account) pairs and the token is "" once
+        the listing is complete. Pages can be short or even empty before that.
+        Engines without secondary indexes scan every account, as here.
+        """
+        position = decode_page_token(page_token, "scan")
+        cursor, keys = self.scan_accounts(position[1] if position else 0, count)
+        return matching_accounts(query, keys, self.get_many(keys)), encode_page_token(["scan", cursor] if cursor else None)
+
+    def start_accrual(self, run_id, rates):
+        """Records the rates of an accrual run (kept if the run already exists) and returns its progress"""
+        raise NotImplementedError
+
+    def accrue_chunk(self, run_id, keys, next_cursor, rates):
+        """Credits interest to a chunk of accounts once per run and records the run's progress atomically, returns the number credited"""
+        raise NotImplementedError
+
+class RedisStore(Store):
+    """Reads and atomically updates accounts in Redis, see Store"""
+
+    MAX_RETRIES = 3  # No infinite retries (deadlock prevention)
+
+    def __init__(self, client, layout="json", exec_mode="watch", ledger=True):
+        """Initialize store on a Redis client, ledger=False stops recording transaction history"""
+        if layout not in LAYOUTS:
+            raise ValueError(f"Unknown storage layout: {layout}")
+        self.redis = client
+        self.layout = LAYOUTS[layout]()
+        self.exec_mode = exec_mode
+        self.ledger_maxlen = ledger_maxlen() if ledger else None
+        self.idempotency_ttl = int(getenv("IDEMPOTENCY_TTL", IDEMPOTENCY_TTL))
+        self.scripts = scripts.register_scripts(client, layout, self.ledger_maxlen, self.idempotency_ttl)  # Also used by batches in watch mode
+
+    def _decode_reply(self, reply):
+        """Decodes a script reply into a status and balance in dollars"""
+        status, *result = reply
+        status = status.decode()
+        if status != "OK":
+            return status, None
+        return status, self.layout.from_units(float(result[0]))
+
+    def _run_script(self, name, account_id, *args):
+        """Runs one operation script and decodes its reply"""
+        return self._decode_reply(self.scripts[name](keys=[account_id], args=args))
+
+    def _replay(self, saved, fingerprint):
+        """Decodes the saved outcome of a request ID, which must be for the same operation"""
+        saved_fingerprint, _, balance = saved.decode().rpartition(" ")
+        if saved_fingerprint != fingerprint:
+            return "REQUEST_ID_REUSED", None
+        return "OK", self.layout.from_units(float(balance))
+
+    def _record(self, pipe, account_id, op, amount, balance):
+        """Queues a ledger entry for a balance change made in the same transaction"""
+        if self.ledger_maxlen is None:
+            return
+        fields = {"op": op, "amount": self.layout.format_units(amount), "balance": self.layout.format_units(balance), "ref": ""}
+        pipe.xadd(LEDGER_KEY.format(account_id), fields, maxlen=self.ledger_maxlen or None, approximate=True)
+
+    def _index(self, pipe, account_id, balance, account_type=None):
+        """Queues the secondary index updates of a write in the same transaction, account_type for new accounts"""
+        if account_type is not None:
+            pipe.sadd(TYPE_INDEX_KEY.format(account_type), account_id)
+        pipe.zadd(BALANCE_INDEX_KEY, {account_id: balance})
+
+    def _transactions(self, entries):
+        """Decodes ledger stream entries into Transactions with amounts in dollars"""
+        return [
+            Transaction(entry_id.decode(), fields[b"op"].decode(), self.layout.from_units(float(fields[b"amount"])),
+                        self.layout.from_units(float(fields[b"balance"])), fields[b"ref"].decode())
+            for entry_id, fields in entries
+        ]
+
+    def _ledger_range(self, account_id, since, count, newest_first):
+        """Issues the XRANGE (or XREVRANGE) reading the entries after a cursor"""
+        key = LEDGER_KEY.format(account_id)
+        if newest_first:
+            return self.redis.xrevrange(key, max=f"({since}" if since else "+", min="-", count=count)
+        return self.redis.xrange(key, min=f"({since}" if since else "-", max="+", count=count)
+
+    def transactions(self, account_id, since="", count=100, newest_first=False):
+        """Returns up to count ledger entries of the account after the since cursor (an entry ID), oldest first by default"""
+        return self._transactions(self._ledger_range(account_id, since, count, newest_first))
+
+    def _dollars(self, account):
+        """Converts a parsed account's balance to dollars"""
+        if account is None:
+            return None
+        return account._replace(balance=self.layout.from_units(account.balance))
+
+    def get(self, account_id, client=None):
+        """Returns the account with its balance in dollars, or None if it does not exist (client: a replica to read from)"""
+        return self._dollars(self.layout.read(client or self.redis, account_id))
+
+    def get_many(self, account_ids, client=None):
+        """Returns the accounts (None for missing ones) in order, read in one round trip (client: a replica to read from)"""
+        if not account_ids:
+            return []
+        return [self._dollars(self.layout.parse(data)) for data in self.layout.fetch_many(client or self.redis, account_ids)]
+
+    def create(self, account_id, account_type):
+        """Creates a new account with a zero balance"""
+        if self.exec_mode == "script":
+            return self._run_script("create_account", account_id, account_type)
+
+        retries = 0
+        while retries < self.MAX_RETRIES:  # Prevents optimistic locking
+            try:
+                with self.redis.pipeline() as pipe:
+                    pipe.watch(account_id)
+                    if pipe.exists(account_id):  # Check on the watched connection
+                        return "EXISTS", None
+
+                    pipe.multi()
+                    self.layout.write(pipe, account_id, account_type, self.layout.to_units(0))
+                    self._index(pipe, account_id, self.layout.to_units(0), account_type)
+                    pipe.execute()
+                    return "OK", 0.0
+
+            except redis.WatchError:
+                WATCH_RETRIES.labels("create").inc()
+                retries += 1
+                continue
+
+        ABORTED.labels("create").inc()
+        return "ABORTED", None
+
+    def _units(self, op, value):
+        """Converts an operation's value to balance units (interest rates are kept as is)"""
+        return value if op == "calculate_interest" else self.layout.to_units(value)
+
+    def apply(self, op, account_id, value, request_id=""):
+        """Applies a deposit, withdraw or calculate_interest operation to the account
+
+        value is the amount in dollars, or the annual interest rate in percent.
+        """
+        value = self._units(op, value)
+        if value <= 0:  # Amounts can round down to zero cents
+            return "INVALID_AMOUNT", None
+
+        if self.exec_mode == "script":
+            return self._run_script(op, account_id, repr(value), request_id)
+
+        fingerprint = f"{LEDGER_OPS[op]}:{account_id}:{value!r}"  # Same format as the scripts
+        request_key = IDEMPOTENCY_KEY.format(account_id, request_id) if request_id else None
+        retries = 0
+        while retries < self.MAX_RETRIES:
+            try:
+                with self.redis.pipeline() as pipe:
+                    pipe.watch(*filter(None, (account_id, request_key)))  # Watch for account data changes (and the request ID)
+                    saved = pipe.get(request_key) if request_key else None
+                    if saved is not None:  # Already applied
+                        return self._replay(saved, fingerprint)
+
+                    account = self.layout.read(pipe, account_id)  # Read on the watched connection
+                    if account is None:  # Check if account exists
+                        return "NOT_FOUND", None
+
+                    if op == "deposit":
+                        delta = value
+                    elif op == "withdraw":
+                        if account.balance < value:
+                            return "INSUFFICIENT_FUNDS", None
+                        delta = -value
+                    else:
+                        delta = self.layout.interest(account.balance, value)
+
+                    pipe.multi()  # Start transaction
+                    self.layout.credit(pipe, account_id, account, delta)
+                    self._index(pipe, account_id, account.balance + delta)
+                    self._record(pipe, account_id, LEDGER_OPS[op], value if op != "calculate_interest" else delta, account.balance + delta)
+                    if request_key:
+                        pipe.set(request_key, f"{fingerprint} {self.layout.format_units(account.balance + delta)}", ex=self.idempotency_ttl)
+                    pipe.execute()  # Execute the transaction
+                    return "OK", self.layout.from_units(account.balance + delta)
+
+            except redis.WatchError:  # Handle concurrent updates
+                WATCH_RETRIES.labels(op).inc()
+                retries += 1
+                continue
+
+        ABORTED.labels(op).inc()
+        return "ABORTED", None
+
+    def apply_combined(self, account_id, operations):
+        """Applies (op, value, request_id) operations to one account as one atomic update, results in order
+
+        Script mode runs their scripts in one MULTI/EXEC. Watch mode reads the
+        account once, applies the operations in order in memory (a withdrawal
+        the running balance cannot cover fails alone) and writes the final
+        balance, every ledger entry and request ID in one WATCHed transaction.
+        """
+        results = [None] * len(operations)
+        pending = []
+        for i, (op, value, request_id) in enumerate(operations):
+            value = self._units(op, value)
+            if value <= 0:
+                results[i] = ("INVALID_AMOUNT", None)
+            else:
+                pending.append((i, op, value, request_id))
+        if not pending:
+            return results
+
+        if self.exec_mode == "script":
+            with self.redis.pipeline(transaction=True) as pipe:
+                for _, op, value, request_id in pending:
+                    pipe.evalsha(self.scripts[op].sha, 1, account_id, repr(value), request_id)
+                replies = pipe.execute(raise_on_error=False)
+            for (i, op, value, request_id), reply in zip(pending, replies):
+                if isinstance(reply, redis.exceptions.NoScriptError):  # Script cache was flushed, that one did not run
+                    reply = self.scripts[op](keys=[account_id], args=[repr(value), request_id])
+                elif isinstance(reply, Exception):
+                    raise reply
+                results[i] = self._decode_reply(reply)
+            return results
+
+        request_keys = {request_id: IDEMPOTENCY_KEY.format(account_id, request_id) for _, _, _, request_id in pending if request_id}
+        retries = 0
+        while retries < self.MAX_RETRIES:
+            try:
+                with self.redis.pipeline() as pipe:
+                    pipe.watch(account_id, *request_keys.values())
+                    saved = dict(zip(request_keys, pipe.mget(list(request_keys.values())))) if request_keys else {}
+                    account = self.layout.read(pipe, account_id)
+                    balance = account.balance if account else None
+                    changes = []
+                    for i, op, value, request_id in pending:
+                        fingerprint = f"{LEDGER_OPS[op]}:{account_id}:{value!r}"
+                        if saved.get(request_id) is not None:  # Applied before, or earlier in this batch
+                            results[i] = self._replay(saved[request_id], fingerprint)
+                            continue
+                        if account is None:
+                            results[i] = ("NOT_FOUND", None)
+                            continue
+
+                        if op == "deposit":
+                            delta = value
+                        elif op == "withdraw":
+                            if balance < value:
+                                results[i] = ("INSUFFICIENT_FUNDS", None)
+                                continue
+                            delta = -value
+                        else:
+                            delta = self.layout.interest(balance, value)
+                        balance += delta
+                        changes.append((op, value if op != "calculate_interest" else delta, balance, request_id, fingerprint))
+                        if request_id:
+                            saved[request_id] = f"{fingerprint} {self.layout.format_units(balance)}".encode()
+                        results[i] = ("OK", self.layout.from_units(balance))
+
+                    if changes:
+                        pipe.multi()
+                        self.layout.write(pipe, account_id, account.account_type, balance, account.last_accrual)
+                        self._index(pipe, account_id, balance)
+                        for op, amount, new_balance, request_id, fingerprint in changes:
+                            self._record(pipe, account_id, LEDGER_OPS[op], amount, new_balance)
+                            if request_id:
+                                pipe.set(request_keys[request_id], saved[request_id], ex=self.idempotency_ttl)
+                        pipe.execute()
+                    return results
+
+            except redis.WatchError:  # Rare now: only other processes write the account concurrently
+                WATCH_RETRIES.labels("combined").inc()
+                retries += 1
+                continue
+
+        ABORTED.labels("combined").inc()
+        for i, _, _, _ in pending:
+            results[i] = ("ABORTED", None)
+        return results
+
+    def transfer(self, from_account_id, to_account_id, amount, request_id=""):
+        """Moves an amount in dollars between two accounts on this node
+
+        Always one atomic script, in both execution modes, so hot accounts never
+        fail with ABORTED.
+        """
+        value = self._units("transfer", amount)
+        if value <= 0:
+            return "INVALID_AMOUNT", None
+        return self._decode_reply(self.scripts["transfer"](keys=[from_account_id, to_account_id], args=[repr(value), request_id]))
+
+    def prepare_transfer(self, transfer_id, from_account_id, to_account_id, units):
+        """First step of a transfer to another node: debits the source and records the transfer as prepared"""
+        keys = [from_account_id, TRANSFER_KEY.format(transfer_id)]
+        return self._decode_reply(self.scripts["transfer_prepare"](keys=keys, args=[units, to_account_id, repr(time.time())]))
+
+    def credit_transfer(self, transfer_id, from_account_id, to_account_id, units):
+        """Destination step of a transfer between nodes, returns the recorded decision ("credited" or "rejected")"""
+        keys = [to_account_id, TRANSFER_DECISION_KEY.format(transfer_id)]
+        return self.scripts["transfer_credit"](keys=keys, args=[units, TRANSFER_TTL, from_account_id])[0].decode()
+
+    def finish_transfer(self, transfer_id, from_account_id, decision):
+        """Last step of a transfer between nodes: commits it, or refunds the source if it was rejected"""
+        keys = [from_account_id, TRANSFER_KEY.format(transfer_id)]
+        return self.scripts["transfer_finish"](keys=keys, args=[decision, TRANSFER_TTL])[0].decode()
+
+    def _transfer_record(self, key, fields, min_age):
+        """(transfer_id, record) of a transfer prepared over min_age seconds ago, else None"""
+        record = {field.decode(): value.decode() for field, value in fields.items()}
+        if record.get("state") != "prepared" or float(record["created"]) > time.time() - min_age:
+            return None
+        return key.decode().rsplit(":", 1)[1], record
+
+    def pending_transfers(self, min_age):
+        """Transfers to other nodes still prepared after min_age seconds, as (transfer_id, record) pairs"""
+        pending = []
+        for key in self.redis.scan_iter(match=TRANSFER_KEY.format("*"), count=1000):
+            transfer = self._transfer_record(key, self.redis.hgetall(key), min_age)
+            if transfer:
+                pending.append(transfer)
+        return pending
+
+    def apply_many(self, operations):
+        """Applies a list of (op, account_id, value, request_id) operations in one pipelined round trip
+
+        Each operation is still applied atomically by its script, and results are
+        returned in the same order as the operations.
+        """
+        results = [None] * len(operations)
+        pending = []
+        with self.redis.pipeline(transaction=False) as pipe:
+            for i, (op, account_id, value, request_id) in enumerate(operations):
+                value = self._units(op, value)
+                if value <= 0:
+                    results[i] = ("INVALID_AMOUNT", None)
+                    continue
+                pipe.evalsha(self.scripts[op].sha, 1, account_id, repr(value), request_id)  # Scripts are pre-loaded, skip SCRIPT EXISTS
+                pending.append(i)
+
+            if pending:
+                for i, reply in zip(pending, pipe.execute(raise_on_error=False)):
+                    if isinstance(reply, redis.exceptions.NoScriptError):  # Script cache was flushed, nothing ran
+                        op, account_id, value, request_id = operations[i]
+                        reply = self.scripts[op](keys=[account_id], args=[repr(self._units(op, value)), request_id])
+                    elif isinstance(reply, Exception):
+                        raise reply
+                    results[i] = self._decode_reply(reply)
+        return results
+
+    def scan_accounts(self, cursor=0, count=1000, match=None):
+        """Returns the next SCAN cursor and the account keys in that batch"""
+        cursor, keys = self.redis.scan(cursor=cursor, match=match, count=count)
+        return cursor, [key for key in keys if not key.startswith(INTERNAL_PREFIX)]
+
+    def _parse_scanned(self, keys, records):
+        """(account_id, Account) pairs of the fetched records that are accounts of this layout
+
+        A broad match can reach keys of other applications (or the other
+        layout), which are skipped instead of failing the whole scan.
+        """
+        batch = []
+        for key, data in zip(keys, records):
+            try:
+                account = self.layout.parse(data)
+            except (ValueError, KeyError, TypeError, AttributeError):  # Not an account record
+                continue
+            if account:  # Not deleted since the scan
+                batch.append((key.decode(), self._dollars(account)))
+        return batch
+
+    def _scanned(self, keys):
+        """(account_id, Account) pairs of scanned keys, skipping keys that are not account records"""
+        return self._parse_scanned(keys, self.layout.fetch_many(self.redis, keys, raise_on_error=False))
+
+    def put_many(self, accounts):
+        """Writes (account_id, Account) records as they are in one pipelined round trip, replacing existing accounts"""
+        accounts = list(accounts)
+        if not accounts:
+            return
+        pipe = self.redis.pipeline(transaction=False)
+        self.scripts["drop_accounts"](keys=[account_id for account_id, _ in accounts], client=pipe)  # No fields or index entries left over
+        for account_id, account in accounts:
+            balance = self.layout.to_units(account.balance)
+            self.layout.write(pipe, account_id, account.account_type, balance, account.last_accrual)
+            self._index(pipe, account_id, balance, account.account_type)
+        pipe.execute()
+
+    def _unit_bounds(self, query):
+        """Balance bounds of an AccountFilter in layout units, None where unbounded"""
+        return tuple(None if bound is None else self.layout.to_units(bound) for bound in (query.min_balance, query.max_balance))
+
+    def _balance_start(self, low, after):
+        """Rank in the balance index where a listing resumes: after an (score, member) position, or at the low bound
+
+        The position's member is normally still at its score, one ZRANK away.
+        If its balance changed since, the members tied at the position's score
+        are ordered by name, and a binary search over them finds the first one after it.
+        """
+        if after is None:
+            return self.redis.zcount(BALANCE_INDEX_KEY, "-inf", f"({low!r}") if low is not None else 0
+        score, member = after
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.zscore(BALANCE_INDEX_KEY, member)
+        pipe.zrank(BALANCE_INDEX_KEY, member)
+        current, rank = pipe.execute()
+        if current == score:
+            return rank + 1
+        lo = self.redis.zcount(BALANCE_INDEX_KEY, "-inf", f"({score!r}")
+        hi = lo + self.redis.zcount(BALANCE_INDEX_KEY, score, score)
+        member = member.encode()
+        while lo < hi:
+            mid = (lo + hi) // 2
+            found = self.redis.zrange(BALANCE_INDEX_KEY, mid, mid)
+            if found and found[0] <= member:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def _balance_entries(self, low, high, after, count):
+        """Up to count (member, score) entries of the balance index from a position, stopping at the high bound"""
+        start = self._balance_start(low, after)
+        entries = self.redis.zrange(BALANCE_INDEX_KEY, start, start + count - 1, withscores=True)
+        return [(member, score) for member, score in entries if high is None or score <= high]
+
+    def list_accounts(self, query, page_token="", count=1000):
+        """Returns the accounts passing an AccountFilter among the next count in its index, and the next page's token
+
+        Balance bounds walk the balance index in balance order (then by ID),
+        an account type alone SSCANs its set, and no filter at all SCANs the
+        keyspace. The records are then read with one get_many() and checked
+        against the whole filter, so a page may be short, see Store.
+        """
+        if has_balance_bounds(query):
+            position = decode_page_token(page_token, "balance")
+            low, high = self._unit_bounds(query)
+            entries = self._balance_entries(low, high, position[1:] if position else None, count)
+            keys = [member for member, _ in entries]
+            following = ["balance", entries[-1][1], entries[-1][0].decode()] if len(entries) == count else None
+        elif query.account_type:
+            position = decode_page_token(page_token, "type")
+            cursor, keys = self.redis.sscan(TYPE_INDEX_KEY.format(query.account_type), position[1] if position else 0, count=count)
+            following = ["type", cursor] if cursor else None
+        else:
+            return super().list_accounts(query, page_token, count)
+        return matching_accounts(query, keys, self.get_many(keys)), encode_page_token(following)
+
+    def _accrual_progress(self, run_id, fields):
+        """Decodes an accrual progress hash"""
+        fields = {key.decode(): value.decode() for key, value in fields.items()}
+        return {
+            "run_id": run_id,
+            "cursor": int(fields.get("cursor", 0)),
+            "scanned": int(fields.get("scanned", 0)),
+            "credited": int(fields.get("credited", 0)),
+            "skipped": int(fields.get("skipped", 0)),
+            "done": fields.get("done") == "1",
+            "rates": json.loads(fields["rates"]) if "rates" in fields else None,
+        }
+
+    def start_accrual(self, run_id, rates):
+        """Records the rates of an accrual run (kept if the run already exists) and returns its progress"""
+        key = ACCRUAL_KEY.format(run_id)
+        self.redis.hsetnx(key, "rates", json.dumps(rates, sort_keys=True))
+        return self._accrual_progress(run_id, self.redis.hgetall(key))
+
+    def accrue_chunk(self, run_id, keys, next_cursor, rates):
+        """Credits interest to a chunk of accounts and records the run's progress in one atomic script
+
+        Accounts already credited by this run are skipped, so replaying a chunk is harmless.
+        Returns the number of accounts credited.
+        """
+        return self.scripts["accrue_interest"](keys=[ACCRUAL_KEY.format(run_id), *keys], args=[run_id, next_cursor, json.dumps(rates)])
+
+
+class AsyncRedisStore(RedisStore):
+    """RedisStore for redis.asyncio clients
+
+    Every operation is a single Lua script call, so there is no WATCH loop holding
+    a connection across awaits. Call connect() before use to load the scripts.
+    """
+
+    def __init__(self, client, layout="json", ledger=True):
+        """Initialize store on a redis.asyncio client"""
+        if layout not in LAYOUTS:
+            raise ValueError(f"Unknown storage layout: {layout}")
+        self.redis = client
+        self.layout = LAYOUTS[layout]()
+        self.layout_name = layout
+        self.exec_mode = "script"
+        self.ledger_maxlen = ledger_maxlen() if ledger else None
+        self.idempotency_ttl = int(getenv("IDEMPOTENCY_TTL", IDEMPOTENCY_TTL))
+        self.scripts = None
+
+    async def connect(self):
+        """Pre-registers the Lua scripts"""
+        self.scripts = await scripts.register_scripts_async(self.redis, self.layout_name, self.ledger_maxlen, self.idempotency_ttl)
+
+    async def _run_script(self, name, account_id, *args):
+        """Runs one operation script and decodes its reply"""
+        return self._decode_reply(await self.scripts[name](keys=[account_id], args=args))
+
+    async def get(self, account_id):
+        """Returns the account with its balance in dollars, or None if it does not exist"""
+        return self._dollars(self.layout.parse(await self.layout.fetch(self.redis, account_id)))
+
+    async def get_many(self, account_ids):
+        """Returns the accounts (None for missing ones) in order, read in one round trip"""
+        if not account_ids:
+            return []
+        return [self._dollars(self.layout.parse(data)) for data in await self.layout.fetch_many(self.redis, account_ids)]
+
+    async def create(self, account_id, account_type):
+        """Creates a new account with a zero balance"""
+        return await self._run_script("create_account", account_id, account_type)
+
+    async def transactions(self, account_id, since="", count=100, newest_first=False):
+        """Returns up to count ledger entries of the account after the since cursor, oldest first by default"""
+        return self._transactions(await self._ledger_range(account_id, since, count, newest_first))
+
+    async def apply(self, op, account_id, value, request_id=""):
+        """Applies a deposit, withdraw or calculate_interest operation to the account"""
+        value = self._units(op, value)
+        if value <= 0:
+            return "INVALID_AMOUNT", None
+        return await self._run_script(op, account_id, repr(value), request_id)
+
+    async def transfer(self, from_account_id, to_account_id, amount, request_id=""):
+        """Moves an amount in dollars between two accounts on this node in one atomic script"""
+        value = self._units("transfer", amount)
+        if value <= 0:
+            return "INVALID_AMOUNT", None
+        return self._decode_reply(await self.scripts["transfer"](keys=[from_account_id, to_account_id], args=[repr(value), request_id]))
+
+    async def prepare_transfer(self, transfer_id, from_account_id, to_account_id, units):
+        """First step of a transfer to another node: debits the source and records the transfer as prepared"""
+        keys = [from_account_id, TRANSFER_KEY.format(transfer_id)]
+        return self._decode_reply(await self.scripts["transfer_prepare"](keys=keys, args=[units, to_account_id, repr(time.time())]))
+
+    async def credit_transfer(self, transfer_id, from_account_id, to_account_id, units):
+        """Destination step of a transfer between nodes, returns the recorded decision ("credited" or "rejected")"""
+        keys = [to_account_id, TRANSFER_DECISION_KEY.format(transfer_id)]
+        return (await self.scripts["transfer_credit"](keys=keys, args=[units, TRANSFER_TTL, from_account_id]))[0].decode()
+
+    async def finish_transfer(self, transfer_id, from_account_id, decision):
+        """Last step of a transfer between nodes: commits it, or refunds the source if it was rejected"""
+        keys = [from_account_id, TRANSFER_KEY.format(transfer_id)]
+        return (await self.scripts["transfer_finish"](keys=keys, args=[decision, TRANSFER_TTL]))[0].decode()
+
+    async def pending_transfers(self, min_age):
+        """Transfers to other nodes still prepared after min_age seconds, as (transfer_id, record) pairs"""
+        pending = []
+        async for key in self.redis.scan_iter(match=TRANSFER_KEY.format("*"), count=1000):
+            transfer = self._transfer_record(key, await self.redis.hgetall(key), min_age)
+            if transfer:
+                pending.append(transfer)
+        return pending
+
+    async def apply_many(self, operations):
+        """Applies a list of (op, account_id, value, request_id) operations in one pipelined round trip"""
+        results = [None] * len(operations)
+        pending = []
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for i, (op, account_id, value, request_id) in enumerate(operations):
+                value = self._units(op, value)
+                if value <= 0:
+                    results[i] = ("INVALID_AMOUNT", None)
+                    continue
+                pipe.evalsha(self.scripts[op].sha, 1, account_id, repr(value), request_id)
+                pending.append(i)
+
+            if pending:
+                for i, reply in zip(pending, await pipe.execute(raise_on_error=False)):
+                    if isinstance(reply, redis.exceptions.NoScriptError):
+                        op, account_id, value, request_id = operations[i]
+                        reply = await self.scripts[op](keys=[account_id], args=[repr(self._units(op, value)), request_id])
+                    elif isinstance(reply, Exception):
+                        raise reply
+                    results[i] = self._decode_reply(reply)
+        return results
+
+    async def scan_accounts(self, cursor=0, count=1000, match=None):
+        """Returns the next SCAN cursor and the account keys in that batch"""
+        cursor, keys = await self.redis.scan(cursor=cursor, match=match, count=count)
+        return cursor, [key for key in keys if not key.startswith(INTERNAL_PREFIX)]
+
+    async def iter_accounts(self, batch_size=1000, match=None):
+        """Yields every account as lists of (account_id, Account), one SCAN batch at a time"""
+        cursor = 0
+        while True:
+            cursor, keys = await self.scan_accounts(cursor, batch_size, match)
+            if keys:
+                batch = self._parse_scanned(keys, await self.layout.fetch_many(self.redis, keys, raise_on_error=False))
+                if batch:
+                    yield batch
+            if not cursor:
+                return
+
+    async def _balance_start(self, low, after):
+        """Rank in the balance index where a listing resumes, see RedisStore._balance_start()"""
+        if after is None:
+            return await self.redis.zcount(BALANCE_INDEX_KEY, "-inf", f"({low!r}") if low is not None else 0
+        score, member = after
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.zscore(BALANCE_INDEX_KEY, member)
+        pipe.zrank(BALANCE_INDEX_KEY, member)
+        current, rank = await pipe.execute()
+        if current == score:
+            return rank + 1
+        lo = await self.redis.zcount(BALANCE_INDEX_KEY, "-inf", f"({score!r}")
+        hi = lo + await self.redis.zcount(BALANCE_INDEX_KEY, score, score)
+        member = member.encode()
+        while lo < hi:
+            mid = (lo + hi) // 2
+            found = await self.redis.zrange(BALANCE_INDEX_KEY, mid, mid)
+            if found and found[0] <= member:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    async def _balance_entries(self, low, high, after, count):
+        """Up to count (member, score) entries of the balance index from a position, stopping at the high bound"""
+        start = await self._balance_start(low, after)
+        entries = await self.redis.zrange(BALANCE_INDEX_KEY, start, start + count - 1, withscores=True)
+        return [(member, score) for member, score in entries if high is None or score <= high]
+
+    async def list_accounts(self, query, page_token="", count=1000):
+        """Returns the accounts passing an AccountFilter among the next count in its index, and the next page's token"""
+        if has_balance_bounds(query):
+            position = decode_page_token(page_token, "balance")
+            low, high = self._unit_bounds(query)
+            entries = await self._balance_entries(low, high, position[1:] if position else None, count)
+            keys = [member for member, _ in entries]
+            following = ["balance", entries[-1][1], entries[-1][0].decode()] if len(entries) == count else None
+        elif query.account_type:
+            position = decode_page_token(page_token, "type")
+            cursor, keys = await self.redis.sscan(TYPE_INDEX_KEY.format(query.account_type), position[1] if position else 0, count=count)
+            following = ["type", cursor] if cursor else None
+        else:
+            position = decode_page_token(page_token, "scan")
+            cursor, keys = await self.scan_accounts(position[1] if position else 0, count)
+            following = ["scan", cursor] if cursor else None
+        return matching_accounts(query, keys, await self.get_many(keys)), encode_page_token(following)
+
+    async def start_accrual(self, run_id, rates):
+        """Records the rates of an accrual run (kept if the run already exists) and returns its progress"""
+        key = ACCRUAL_KEY.format(run_id)
+        await self.redis.hsetnx(key, "rates", json.dumps(rates, sort_keys=True))
+        return self._accrual_progress(run_id, await self.redis.hgetall(key))
+
+    async def accrue_chunk(self, run_id, keys, next_cursor, rates):
+        """Credits interest to a chunk of accounts and records the run's progress in one atomic script"""
+        return await self.scripts["accrue_interest"](keys=[ACCRUAL_KEY.format(run_id), *keys], args=[run_id, next_cursor, json.dumps(rates)])
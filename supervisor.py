@@ -0,0 +1,113 @@
+"""
+bankRPC - Distributed Banking
+By: Imesh Nimsitha
+2025/02/05
+Supervisor.py Multi-Process Server Implementation
+"""
+
+from os import cpu_count, getenv
+from redis_pool import add_redis_arguments, redis_options
+from ratelimit import add_rate_limit_arguments, rate_limit_options
+import multiprocessing
+import argparse
+import asyncio
+import signal
+import time
+
+RESTART_DELAY = 1  # Seconds to wait before restarting a worker that keeps crashing
+STOP_TIMEOUT = 10  # Seconds workers get to stop gracefully before they are killed
+
+def run_worker(mode, exec_mode, storage, port, max_concurrent_rpcs, pool_options, cache_size=0, cache_ttl=30.0,
+               queue_depth=None, rate_limits=None, max_staleness=None, metrics_port=0):
+    """Worker process entry point: one gRPC server sharing the port with SO_REUSEPORT
+
+    Rate limits are enforced through Redis, so they apply to all workers together.
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # Ctrl+C is handled by the supervisor
+    if mode == "async":
+        from async_server import serve_async
+        asyncio.run(serve_async(storage, port, max_concurrent_rpcs, pool_options, reuse_port=True, metrics_port=metrics_port,
+                                rate_limits=rate_limits))
+    else:
+        from server import QUEUE_DEPTH, serve
+        serve(exec_mode, storage, port, reuse_port=True, pool_options=pool_options, metrics_port=metrics_port,
+              queue_depth=QUEUE_DEPTH if queue_depth is None else queue_depth, rate_limits=rate_limits,
+              cache_size=cache_size, cache_ttl=cache_ttl, max_staleness=max_staleness)
+
+class Supervisor:
+    """Runs N worker processes on the same port and restarts them if they crash"""
+
+    def __init__(self, workers, worker_args, metrics_port=0):
+        """Initialize supervisor, worker_args are passed to run_worker
+
+        Each worker has its own metrics, served on metrics_port + its slot.
+        """
+        self.context = multiprocessing.get_context("spawn")  # Fresh interpreter per worker, grpc is not fork-safe
+        self.workers = [None] * workers
+        self.started = [0.0] * workers
+        self.worker_args = worker_args
+        self.metrics_port = metrics_port
+        self.stopping = False
+
+    def _start(self, slot):
+        """Starts (or restarts) the worker in a slot"""
+        kwargs = {"metrics_port": self.metrics_port + slot} if self.metrics_port else {}
+        process = self.context.Process(target=run_worker, args=self.worker_args, kwargs=kwargs, name=f"bankrpc-worker-{slot}", daemon=True)
+        process.start()
+        self.workers[slot] = process
+        self.started[slot] = time.monotonic()
+        print(f"Worker {slot} started (pid {process.pid})...")
+
+    def _stop(self, *_):
+        """Signal handler: stop restarting workers and shut them down"""
+        self.stopping = True
+
+    def run(self):
+        """Starts all workers and supervises them until SIGTERM or SIGINT"""
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGINT, self._stop)
+        for slot in range(len(self.workers)):
+            self._start(slot)
+
+        while not self.stopping:
+            for slot, process in enumerate(self.workers):
+                if process.is_alive() or self.stopping:
+                    continue
+                print(f"Worker {slot} (pid {process.pid}) exited with code {process.exitcode}, restarting...")
+                if time.monotonic() - self.started[slot] < RESTART_DELAY:  # Crash loop, back off
+                    time.sleep(RESTART_DELAY)
+                self._start(slot)
+            time.sleep(0.5)
+
+        print("Stopping workers...")
+        for process in self.workers:
+            process.terminate()  # SIGTERM, workers finish in-flight RPCs
+        deadline = time.monotonic() + STOP_TIMEOUT
+        for process in self.workers:
+            process.join(max(0, deadline - time.monotonic()))
+            if process.is_alive():
+                process.kill()
+        print("Supervisor stopped.")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Run several bankRPC server processes on one port")
+    parser.add_argument("--workers", type=int, default=int(getenv("WORKERS", cpu_count() or 1)), help="Worker processes (default: $WORKERS or CPU count)")
+    parser.add_argument("--mode", choices=("threaded", "async"), default="threaded", help="Serving mode of each worker")
+    parser.add_argument("--port", type=int, default=50051, help="Port shared by all workers")
+    parser.add_argument("--exec-mode", choices=("watch", "script"), help="How mutations are applied in Redis (default: $EXEC_MODE or watch)")
+    parser.add_argument("--storage", choices=("json", "hash"), help="Account storage layout (default: $ACCOUNT_STORAGE or json)")
+    parser.add_argument("--max-concurrent-rpcs", type=int, default=int(getenv("MAX_CONCURRENT_RPCS", 4096)), help="Async mode: in-flight RPC limit per worker")
+    parser.add_argument("--balance-cache-size", type=int, default=int(getenv("BALANCE_CACHE_SIZE", 0)), help="Threaded mode: cached GetBalance accounts per worker, 0 disables the cache")
+    parser.add_argument("--balance-cache-ttl", type=float, default=float(getenv("BALANCE_CACHE_TTL", 30)), help="Seconds a cached balance may be served")
+    parser.add_argument("--metrics-port", type=int, default=int(getenv("METRICS_PORT", 0)), help="Serve worker N's Prometheus metrics on this port + N, 0 disables them")
+    parser.add_argument("--queue-depth", type=int, default=int(getenv("QUEUE_DEPTH", 50)),
+                        help="Threaded mode: RPCs admitted per worker beyond its handler threads (0: no limit)")
+    parser.add_argument("--max-staleness", type=float, default=float(getenv("REPLICA_MAX_STALENESS", 1.0)),
+                        help="Threaded mode with --redis-replicas: seconds a replica may lag behind for balance reads that do not say")
+    add_rate_limit_arguments(parser)  # Shared by all workers through Redis
+    add_redis_arguments(parser)  # Pool settings apply to each worker's own pool
+    args = parser.parse_args()
+
+    worker_args = (args.mode, args.exec_mode, args.storage, args.port, args.max_concurrent_rpcs, redis_options(args),
+                   args.balance_cache_size, args.balance_cache_ttl, args.queue_depth, rate_limit_options(args), args.max_staleness)
+    Supervisor(args.workers, worker_args, args.metrics_port).run()
@@ -0,0 +1,178 @@
+"""
+bankRPC - Distributed Banking
+By: Imesh Nimsitha
+2025/02/05
+Watch.py Balance Change Notifications
+"""
+
+from cache import KEYSPACE_EVENTS, KEYSPACE_PATTERN, InvalidationListener
+from os import getenv
+import asyncio
+import threading
+import redis
+
+MAX_WATCHERS = int(getenv("MAX_WATCHERS", 256))  # WatchBalance streams per threaded server, each one holds a handler thread
+CHECK_INTERVAL = 1.0  # Seconds a watcher sleeps before checking its client is still there
+
+class BalanceWatchers:
+    """Wakes WatchBalance streams when their account changes
+
+    Each stream registers an event under its account. A write to the account
+    sets the events, and each stream reads the balance once after waking,
+    however many writes came in between. Writes made by any process are seen
+    through Redis keyspace notifications: an InvalidationListener, started
+    with the first watcher, drives this as it drives the balance cache, so a
+    server keeps one subscription per node whatever the number of streams.
+    Without clients (embedded engines) the service reports its own writes. While
+    a subscription is down, or if keyspace events could not be turned on,
+    watchers re-read their account every check_interval.
+    """
+
+    def __init__(self, clients=None, max_watchers=MAX_WATCHERS, check_interval=CHECK_INTERVAL):
+        """Initialize on the Redis clients to listen to (every shard), or None when all writes go through this process"""
+        self.clients = clients
+        self.max_watchers = max_watchers
+        self.check_interval = check_interval
+        self.enabled = not clients  # Notifications cannot be missed, set by the listener while it is subscribed
+        self.notifying = True  # Keyspace events are on, as far as the listener could tell
+        self.listener = None
+        self._watchers = {}  # account_id -> set of events
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def _event(self):
+        """New wake-up event"""
+        return threading.Event()
+
+    def _start(self):
+        """Starts listening to keyspace notifications (lock held)"""
+        self.listener = InvalidationListener(self.clients, self)
+        self.notifying = self.listener.notifying
+
+    def add(self, account_id):
+        """Registers a watcher of the account, returns its event or None if max_watchers are watching (0: no limit)"""
+        with self._lock:
+            if self.max_watchers and self._count >= self.max_watchers:
+                return None
+            if self.clients and self.listener is None:
+                self._start()
+            event = self._event()
+            self._watchers.setdefault(account_id, set()).add(event)
+            self._count += 1
+            return event
+
+    def remove(self, account_id, event):
+        """Unregisters a watcher"""
+        with self._lock:
+            events = self._watchers.get(account_id)
+            if events is None or event not in events:
+                return
+            events.discard(event)
+            if not events:
+                del self._watchers[account_id]
+            self._count -= 1
+
+    def invalidate(self, account_id):
+        """Wakes the watchers of a changed account"""
+        with self._lock:
+            events = list(self._watchers.get(account_id, ()))
+        for event in events:
+            event.set()
+
+    def clear(self):
+        """Wakes every watcher, after notifications may have been missed"""
+        with self._lock:
+            events = [event for events in self._watchers.values() for event in events]
+        for event in events:
+            event.set()
+
+    def wait(self, event):
+        """Waits until the watched account may have changed, returns False after check_interval without news"""
+        changed = event.wait(self.check_interval) or not (self.enabled and self.notifying)
+        event.clear()  # Before the read, so a write racing it wakes the watcher again
+        return changed
+
+    def __len__(self):
+        """Number of watchers"""
+        return self._count
+
+    def stop(self):
+        """Stops listening"""
+        if self.listener:
+            self.listener.stop()
+
+class AsyncBalanceWatchers(BalanceWatchers):
+    """BalanceWatchers for the asyncio server, with asyncio events and one listener task per redis.asyncio client
+
+    Everything runs on the event loop, so the lock is never contended.
+    """
+
+    def _event(self):
+        """New wake-up event"""
+        return asyncio.Event()
+
+    def _start(self):
+        """Starts one listener task per client (lock held)"""
+        self._subscribed = set()
+        self._stopped = False
+        self.listener = [asyncio.ensure_future(self._listen(index)) for index in range(len(self.clients))]
+
+    async def _enable_notifications(self, client):
+        """Turns on the keyspace events watchers need, as InvalidationListener does, watchers poll if they cannot be"""
+        try:
+            current = next(iter((await client.config_get("notify-keyspace-events")).values()), "")
+            current = current.decode() if isinstance(current, bytes) else current
+            missing = "".join(flag for flag in KEYSPACE_EVENTS if flag not in current)
+            if missing:
+                await client.config_set("notify-keyspace-events", current + missing)
+        except redis.ResponseError as e:
+            self.notifying = False
+            print(f"Could not enable keyspace notifications ({e}), balance watchers poll every {self.check_interval}s.")
+
+    def _set_subscribed(self, index, subscribed):
+        """Tracks live subscriptions, notifications are only trusted while every node is subscribed"""
+        if subscribed:
+            self._subscribed.add(index)
+        else:
+            self._subscribed.discard(index)
+        self.clear()
+        self.enabled = len(self._subscribed) == len(self.clients)
+
+    async def _listen(self, index):
+        """Subscription loop for one client, reconnects after connection errors"""
+        client = self.clients[index]
+        await self._enable_notifications(client)
+        while not self._stopped:
+            pubsub = client.pubsub()
+            try:
+                await pubsub.psubscribe(KEYSPACE_PATTERN)
+                while not self._stopped:
+                    message = await pubsub.get_message(timeout=1.0)
+                    if message is None:
+                        continue
+                    if message["type"] == "psubscribe":
+                        self._set_subscribed(index, True)
+                    elif message["type"] == "pmessage":
+                        self.invalidate(message["channel"].split(b":", 1)[1].decode())
+            except redis.RedisError:
+                self._set_subscribed(index, False)
+                await asyncio.sleep(1.0)
+            finally:
+                await pubsub.aclose()
+
+    async def wait(self, event):
+        """Waits until the watched account may have changed, returns False after check_interval without news"""
+        try:
+            await asyncio.wait_for(event.wait(), self.check_interval)
+            changed = True
+        except asyncio.TimeoutError:
+            changed = not (self.enabled and self.notifying)
+        event.clear()
+        return changed
+
+    def stop(self):
+        """Stops the listener tasks"""
+        if self.listener:
+            self._stopped = True
+            for task in self.listener:
+                task.cancel()